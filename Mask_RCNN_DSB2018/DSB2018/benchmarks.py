@@ -0,0 +1,715 @@
+"""
+Micro-benchmarks for the training data pipeline and the inference post-processing.
+All benchmarks run on synthetic data, so no dataset or trained weights are needed.
+
+Usage: python benchmarks.py <name> [<name> ...], e.g. python benchmarks.py augmentation
+"""
+import sys
+sys.path.append('../')
+
+import os
+import time
+import copy
+import tempfile
+import multiprocessing
+import numpy as np
+import cv2
+import scipy.ndimage
+import tensorflow as tf
+
+import config
+import model as modellib
+import utils
+import submit
+import tta
+import pipeline
+import model_shards
+import functions as f
+import dsb2018_utils as du
+from detections import Detections
+
+
+def synthetic_labels(shape, n_instances, max_size = 30, seed = 0):
+    """Random rectangular instances as an int16 label image of the given shape"""
+    rng = np.random.RandomState(seed)
+    labels = np.zeros(shape, dtype = np.int16)
+    for i in range(n_instances):
+        y, x = rng.randint(0, shape[0] - max_size), rng.randint(0, shape[1] - max_size)
+        labels[y:y + rng.randint(3, max_size), x:x + rng.randint(3, max_size)] = i + 1
+    return labels
+
+
+def synthetic_image(labels):
+    """Grey level image, brighter inside instances, as a [H, W, 3] uint8 array"""
+    image = np.where(labels > 0, 200, 20).astype(np.uint8)
+    return np.stack([image] * 3, axis = -1)
+
+
+def benchmark_augmentation(n_samples = 64, batch_size = 8, shape = (512, 512), n_instances = 400):
+    """
+    Samples/sec on a single core of:
+    - masks: the original per-sample path, a new XY_ImageDataGenerator per sample and
+      random_transform on the [H, W, N] mask stack
+    - labels: per-sample random_transform_labels on the label image
+    - batched: XY_BatchImageDataGenerator.random_transform_labels_batch
+    """
+    cv2.setNumThreads(1)
+
+    augmentation_dict = {'dim_ordering': 'tf',
+                         'horizontal_flip': True,
+                         'vertical_flip': True,
+                         'rots' : True,
+                         'gaussian_blur': [-0.2, 0.2]}
+
+    labels = synthetic_labels(shape, n_instances)
+    image = synthetic_image(labels)
+    masks = utils.labels_to_masks(labels, n_instances).astype(np.uint8)
+
+    def run_masks():
+        for _ in range(n_samples):
+            aug = modellib.XY_ImageDataGenerator(**augmentation_dict)
+            aug.random_transform(image, masks)
+
+    def run_labels():
+        aug = modellib.XY_ImageDataGenerator(**augmentation_dict)
+        for _ in range(n_samples):
+            aug.random_transform_labels(image, labels)
+
+    def run_batched():
+        aug = modellib.XY_BatchImageDataGenerator(**augmentation_dict)
+        for _ in range(n_samples // batch_size):
+            aug.random_transform_labels_batch([image] * batch_size, [labels] * batch_size)
+
+    print('Augmentation of {} samples of shape {} with {} instances (1 core)'.format(n_samples, shape, n_instances))
+    for name, fn in [('masks', run_masks), ('labels', run_labels), ('batched', run_batched)]:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print('{:>10}: {:8.1f} samples/sec'.format(name, n_samples / elapsed))
+
+
+def synthetic_results(labels, n_instances, shift = 0):
+    """
+    Result dict of the instances of labels, shifted by shift pixels, as returned by tta.TTATransform.invert()
+    (rois, scores, class_ids, crops, mask_extents, image_shape), with their masks [N, H, W] as well
+    """
+    labels = np.roll(labels, shift, axis = 1)
+    masks = np.moveaxis(utils.labels_to_masks(labels, n_instances), -1, 0).astype(np.int)
+    rois = utils.extract_bboxes_from_labels(labels, n_instances)
+    return {'rois': rois,
+            'scores': np.linspace(0.7, 1., n_instances).astype(np.float32),
+            'class_ids': np.ones(n_instances, dtype = np.int32),
+            'crops': [m[y1 : y2, x1 : x2] for m, (y1, x1, y2, x2) in zip(masks, rois)],
+            'mask_extents': rois,
+            'image_shape': labels.shape[:2],
+            'masks': masks}
+
+
+def benchmark_tta_aggregation(n_images = 5, n_augmentations = 9, shape = (256, 256), n_instances = 40):
+    """
+    Size of the voting input and wall time of reduce_via_voting when the results of 
+    n_augmentations test time augmentations of n_images images are combined:
+    - duplicated: the previous aggregation, which added each augmentation once per image in the batch
+    - once: AugmentationResults, which adds each augmentation exactly once
+    """
+    labels = [synthetic_labels(shape, n_instances, seed = i) for i in range(n_images)]
+    augment_results = [[synthetic_results(l, n_instances, shift = a % 3) for l in labels] for a in range(n_augmentations)]
+
+    results_once = submit.AugmentationResults(n_images)
+    results_duplicated = submit.AugmentationResults(n_images)
+    for res in augment_results:
+        results_once.add(res)
+        for _ in res:
+            results_duplicated.add(res)
+
+    print('Voting over {} augmentations of {} images of shape {} with {} instances'.format(n_augmentations, n_images, shape, n_instances))
+    for name, results_augment in [('duplicated', results_duplicated), ('once', results_once)]:
+        start = time.time()
+        for i in range(n_images):
+            submit.reduce_via_voting(results_augment.image_results(i), 0.3, 0.5, {}, False, n_votes = results_augment.n_votes)
+        elapsed = time.time() - start
+        print('{:>10}: {:3d} result sets, {:6d} instances, {:8.2f} sec'.format(name, results_augment.n_votes, 
+                                                                        results_augment.n_instances(), elapsed))
+
+
+def benchmark_detections(n_augmentations = 9, shape = (520, 696), n_instances = 300):
+    """
+    Seconds to gather the results of n_augmentations test time augmentations of one image, and select 
+    half of the instances:
+    - dicts: du.concatenate_list_of_dicts() of the result dicts, deepcopy and du.reduce_dict()
+    - detections: detections.Detections, which keeps the masks as crops
+    """
+    labels = synthetic_labels(shape, n_instances)
+    results = [synthetic_results(labels, n_instances, shift = a % 3) for a in range(n_augmentations)]
+
+    def run_dicts():
+        img_results = copy.deepcopy(du.concatenate_list_of_dicts(results))
+        return du.reduce_dict(img_results, np.arange(0, img_results['rois'].shape[0], 2))
+
+    def run_detections():
+        detections = Detections(shape)
+        for r in results:
+            detections.append(r['rois'], r['class_ids'], r['scores'], np.moveaxis(r['masks'], 0, -1))
+        return detections[np.arange(0, len(detections), 2)]
+
+    print('Gathering {} augmentations of an image of shape {} with {} instances'.format(n_augmentations, shape, n_instances))
+    for name, fn in [('dicts', run_dicts), ('detections', run_detections)]:
+        start = time.time()
+        fn()
+        print('{:>10}: {:8.2f} sec'.format(name, time.time() - start))
+
+
+def benchmark_semantic_voting(n_augmentations = 9, shape = (520, 696), n_instances = 300):
+    """
+    Size of the semantic masks carried into the merging + voting of n_augmentations test time augmentations
+    of one image, when replicated once per instance as before or shared per augmentation 
+    (detections.Detections), and wall time of combining them (submit.combine_results())
+    """
+    labels = synthetic_labels(shape, n_instances)
+    semantic_mask = scipy.ndimage.morphology.binary_dilation(labels > 0).astype(np.float32)
+    results_augment = submit.AugmentationResults(1)
+    for a in range(n_augmentations):
+        r = synthetic_results(labels, n_instances, shift = a % 3)
+        r['semantic_masks'] = np.roll(semantic_mask, a % 3, axis = 1)
+        results_augment.add([r])
+
+    start = time.time()
+    submit.combine_results(results_augment, 0.3, 0.5, {}, False, True)
+    elapsed = time.time() - start
+
+    print('Voting over {} augmentations of an image of shape {} with {} instances'.format(n_augmentations, shape, n_instances))
+    print('semantic masks: replicated {:8.1f} MB, shared {:8.1f} MB'.format(results_augment.n_instances() * semantic_mask.nbytes / 1e6, 
+                                                                          n_augmentations * semantic_mask.nbytes / 1e6))
+    print('combine_results: {:8.2f} sec'.format(elapsed))
+
+
+def benchmark_tta_inversion(n_images = 4, shape = (512, 512), n_instances = 300, crop_size = 28):
+    """
+    Seconds to reverse the flips/rotations test time augmentations of the raw detections of n_images:
+    - full: unmold the masks in the augmented image, flip/rotate the [H, W, N] mask stack back
+      and recompute the bboxes on the full size masks
+    - crops: tta.TTATransform.invert(), which inverts the boxes and the mask crops before unmolding once
+    """
+    rng = np.random.RandomState(0)
+    transforms = tta.get_transforms('flips_rotations', None)
+    labels = synthetic_labels(shape, n_instances)
+    raw = {'rois': utils.extract_bboxes_from_labels(labels, n_instances),
+           'class_ids': np.ones(n_instances, dtype = np.int32),
+           'scores': np.ones(n_instances, dtype = np.float32),
+           'mask_crops': rng.rand(n_instances, crop_size, crop_size).astype(np.float32)}
+    raw['rois'][:, 2:] = np.maximum(raw['rois'][:, 2:], raw['rois'][:, :2] + 1)
+
+    def run_full():
+        for _ in range(n_images):
+            for t in transforms:
+                masks = np.stack([utils.unmold_mask(m, b, shape) for m, b in zip(raw['mask_crops'], raw['rois'])], axis = -1)
+                masks = t.invert_image(masks, shape)
+                utils.extract_bboxes(masks)
+                np.moveaxis(masks, -1, 0)
+
+    def run_crops():
+        for _ in range(n_images):
+            for t in transforms:
+                t.invert(raw, shape, shape)
+
+    print('Reversing {} flips/rotations of {} images of shape {} with {} instances'.format(len(transforms), n_images, shape, n_instances))
+    for name, fn in [('full', run_full), ('crops', run_crops)]:
+        start = time.time()
+        fn()
+        print('{:>10}: {:8.2f} sec'.format(name, time.time() - start))
+
+
+def _combine_semantic_full(boxes, scores, masks, semantic_masks, n_dilate, n_erode):
+    """Reference submit.combine_semantic(), processing each mask on the full image"""
+    box_labels = du.maskrcnn_boxes_to_labels(boxes, scores, semantic_masks.shape)
+    for i in range(masks.shape[-1]):
+        original_overlap = np.multiply(masks[:, :, i], semantic_masks)
+        eroded_mask = scipy.ndimage.morphology.binary_erosion(masks[:, :, i], iterations = n_erode) if n_erode > 0 else masks[:, :, i]
+        eroded_plus_overlap = ((eroded_mask + original_overlap) > 0).astype(np.int64)
+        dilated_mask = scipy.ndimage.morphology.binary_dilation(masks[:, :, i], iterations = n_dilate) if n_dilate > 0 else masks[:, :, i]
+        dilated_overlap = np.multiply(dilated_mask, np.multiply(box_labels == (i + 1), semantic_masks))
+        masks[:, :, i] = ((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int64)
+    return masks
+
+
+def _dilate_masks_full(masks, boxes, scores, n_dilate):
+    """Reference submit.dilate_masks(), processing each mask on the full image"""
+    box_labels = du.maskrcnn_boxes_to_labels(boxes, scores, masks.shape[:2])
+    return np.stack([np.multiply(box_labels == (i + 1), scipy.ndimage.morphology.binary_dilation(masks[:, :, i], iterations = n_dilate)) 
+                     for i in range(masks.shape[-1])], axis = -1)
+
+
+def benchmark_crop_morphology(shape = (1040, 1388), n_instances = 200, n_dilate = 2, n_erode = 1):
+    """
+    Seconds of the morphology of the post-processing on a crowded image, processing each mask 
+    on the full image (full) or within its extent padded by the dilation radius (crop):
+    - combine_semantic: submit.combine_semantic()
+    - dilate: the dilate path of predict_model() (submit.dilate_masks())
+    Checks that both give the same masks.
+    """
+    labels = synthetic_labels(shape, n_instances)
+    n_instances = labels.max()
+    masks = np.stack([labels == i for i in range(1, n_instances + 1)], axis = -1).astype(np.uint8)
+    boxes = utils.extract_bboxes(masks)
+    scores = np.random.RandomState(0).rand(n_instances).astype(np.float32)
+    # Semantic mask bleeding a little beyond the instances
+    semantic_masks = scipy.ndimage.morphology.binary_dilation(labels > 0, iterations = 2).astype(np.int64)
+    # Boxes slightly larger than the masks, as predicted
+    boxes = np.concatenate([np.maximum(boxes[:, :2] - 2, 0), np.minimum(boxes[:, 2:] + 2, shape)], axis = 1)
+
+    param_dict = {'n_dilate': n_dilate, 'n_erode': n_erode}
+    print('Morphology of {} instances on an image of shape {}, n_dilate = {}, n_erode = {}'.format(n_instances, shape, n_dilate, n_erode))
+
+    for name, fn_full, fn_crop in [('combine_semantic', 
+                                    lambda: _combine_semantic_full(boxes, scores, masks.copy(), semantic_masks, n_dilate, n_erode),
+                                    lambda: submit.combine_semantic(boxes, scores, masks.copy(), semantic_masks, param_dict)),
+                                   ('dilate', 
+                                    lambda: _dilate_masks_full(masks, boxes, scores, n_dilate),
+                                    lambda: submit.dilate_masks(masks, boxes, scores, n_dilate))]:
+        start = time.time()
+        full = fn_full()
+        time_full = time.time() - start
+
+        start = time.time()
+        crop = fn_crop()
+        time_crop = time.time() - start
+
+        assert np.array_equal(full, crop)
+        print('{:>16}: full {:8.2f} sec, crop {:8.2f} sec'.format(name, time_full, time_crop))
+
+
+def _greedy_clusters_reference(boxes, threshold):
+    """Clusters of the original du.combine_boxes(), which recomputed the IoU with every remaining box after each join"""
+    boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    ixs = np.arange(boxes.shape[0])
+    cluster = np.zeros(boxes.shape[0], dtype = np.int64)
+    k = 0
+    while len(ixs) > 0:
+        i = ixs[0]
+        cluster[i] = k
+        while True:
+            iou = utils.compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+            join_ixs = np.where(iou > threshold)[0] + 1
+            if len(join_ixs) == 0:
+                ixs = np.delete(ixs, 0)
+                break
+            cluster[ixs[join_ixs]] = k
+            boxes[i] = [min(boxes[i, 0], np.min(boxes[ixs[join_ixs], 0])), min(boxes[i, 1], np.min(boxes[ixs[join_ixs], 1])),
+                        max(boxes[i, 2], np.max(boxes[ixs[join_ixs], 2])), max(boxes[i, 3], np.max(boxes[ixs[join_ixs], 3]))]
+            ixs = np.delete(ixs, join_ixs)
+        k += 1
+    return cluster
+
+
+def synthetic_votes(n_boxes, n_objects = 500, shape = (1040, 1388), max_size = 30, jitter = 2, seed = 0):
+    """
+    n_boxes boxes (rounded to a multiple of n_objects): jittered votes of n_objects objects, e.g. from 
+    the models and test time augmentations of an ensemble, with random mask crops as in a detections.Detections
+    """
+    rng = np.random.RandomState(seed)
+    n_votes = max(1, n_boxes // n_objects)
+    size = rng.randint(6, max_size, (n_objects, 2))
+    corner = np.stack([rng.randint(jitter, shape[0] - max_size - jitter, n_objects), 
+                       rng.randint(jitter, shape[1] - max_size - jitter, n_objects)], axis = 1)
+    corner = np.repeat(corner, n_votes, axis = 0) + rng.randint(-jitter, jitter + 1, (n_objects * n_votes, 2))
+    size = np.repeat(size, n_votes, axis = 0)
+    boxes = np.concatenate([corner, corner + size], axis = 1).astype(np.int32)
+    crops = [(rng.rand(h, w) > 0.2).astype(np.uint8) for h, w in size]
+    scores = rng.rand(boxes.shape[0]).astype(np.float32)
+    return boxes, scores, crops
+
+
+def benchmark_combine_boxes(n_boxes = [10000, 30000, 70000], threshold = 0.3, max_reference = 70000):
+    """
+    Seconds to cluster and combine n_boxes boxes of one image (jittered votes of the same objects):
+    - reference: clustering of the original du.combine_boxes() (only up to max_reference boxes)
+    - greedy, union_find: du.cluster_boxes() with each method
+    - combine: du.combine_box_crops() (greedy), which also sums the mask crops of each cluster within its extent
+    Checks that the greedy clusters are those of the reference.
+    """
+    print('Combining boxes, IoU threshold {}'.format(threshold))
+    for n in n_boxes:
+        boxes, scores, crops = synthetic_votes(n)
+        timings = []
+
+        if n <= max_reference:
+            start = time.time()
+            reference = _greedy_clusters_reference(boxes, threshold)
+            timings.append('reference {:7.2f} sec'.format(time.time() - start))
+
+        for method in ['greedy', 'union_find']:
+            start = time.time()
+            cluster, _ = du.cluster_boxes(boxes, threshold, method)
+            timings.append('{} {:7.2f} sec ({} clusters)'.format(method, time.time() - start, cluster.max() + 1))
+            if method == 'greedy' and n <= max_reference:
+                assert np.array_equal(cluster, reference)
+
+        start = time.time()
+        du.combine_box_crops(boxes, scores, np.concatenate([boxes[:, :2], boxes[:, :2] + [c.shape for c in crops]], axis = 1), crops, threshold)
+        timings.append('combine {:7.2f} sec'.format(time.time() - start))
+
+        print('{:>7} boxes: {}'.format(boxes.shape[0], ', '.join(timings)))
+
+
+def _encode_labels(labels):
+    """Post-processing stage of benchmark_pipeline: run-length encode the instances of labels"""
+    masks = utils.labels_to_masks(labels, int(labels.max())).astype(np.uint8)
+    return f.numpy2encoding_no_overlap_threshold(masks, 'image', np.ones(masks.shape[-1]))
+
+
+def benchmark_pipeline(n_batches = 16, shape = (512, 512), n_instances = 200, model_time = 0.2, n_workers = 4):
+    """
+    Seconds to run n_batches through loading (synthetic labels), a forward pass (sleeping model_time)
+    and post-processing (run-length encoding) with pipeline.run_pipeline():
+    - inline: post-processing in the calling thread, after each forward pass
+    - pipelined: post-processing in a pool of n_workers processes, overlapping the forward passes
+    """
+    def load_fn(k):
+        return synthetic_labels(shape, n_instances, seed = k)
+
+    def model_fn(labels):
+        time.sleep(model_time)
+        return labels
+
+    print('Pipeline of {} batches of shape {} with {} instances, model time {} sec'.format(n_batches, shape, n_instances, model_time))
+    for name, workers in [('inline', None), ('pipelined', pipeline.create_worker_pool(n_workers))]:
+        start = time.time()
+        for _ in pipeline.run_pipeline(n_batches, load_fn, model_fn, _encode_labels, workers = workers, n_loaders = 2):
+            pass
+        print('{:>10}: {:8.2f} sec'.format(name, time.time() - start))
+        if workers is not None:
+            workers.close()
+            workers.join()
+
+
+class DetectionBenchmarkConfig(config.Config):
+    NAME = 'benchmark'
+    # Several foreground classes, to exercise the per-class NMS
+    NUM_CLASSES = 1 + 3
+    IMAGE_MAX_DIM = 512
+    IMAGES_PER_GPU = 4
+    DETECTION_MAX_INSTANCES = 500
+
+
+def synthetic_classifications(config, n_rois = 2000, n_objects = 300, seed = 0):
+    """
+    Random inputs of the DetectionLayer for one image, with ROIs clustered around n_objects:
+    rois [N, 4] normalized, probs [N, num_classes], deltas [N, num_classes, 4]
+    """
+    rng = np.random.RandomState(seed)
+    h, w = config.IMAGE_SHAPE[:2]
+    centers = rng.uniform(0, 1, (n_objects, 2))
+    sizes = rng.uniform(4, 40, (n_objects, 2)) / np.array([h, w])
+    k = rng.randint(0, n_objects, n_rois)
+    yx = centers[k] + rng.normal(0, 0.2, (n_rois, 2)) * sizes[k]
+    hw = sizes[k] * rng.uniform(0.8, 1.25, (n_rois, 2))
+    rois = np.clip(np.concatenate([yx - hw / 2, yx + hw / 2], axis = 1), 0, 1)
+    probs = rng.dirichlet(np.ones(config.NUM_CLASSES) * 0.3, n_rois)
+    deltas = rng.normal(0, 1, (n_rois, config.NUM_CLASSES, 4))
+    return rois.astype(np.float32), probs.astype(np.float32), deltas.astype(np.float32)
+
+
+def _matched_detections(detections1, detections2, iou_threshold = 0.9):
+    """
+    Number of detections1 [N, (y1, x1, y2, x2, class_id, score)] matched one to one (greedily, by score)
+    to a detection of detections2 of the same class with a box IoU >= iou_threshold
+    """
+    if len(detections1) == 0 or len(detections2) == 0:
+        return 0
+    overlaps = utils.compute_overlaps(detections1[:, :4].astype(np.float64), detections2[:, :4].astype(np.float64))
+    overlaps[detections1[:, 4][:, None] != detections2[:, 4][None, :]] = 0
+    n_matched = 0
+    for i in np.argsort(-detections1[:, 5]):
+        j = np.argmax(overlaps[i])
+        if overlaps[i, j] >= iou_threshold:
+            n_matched += 1
+            overlaps[:, j] = 0
+    return n_matched
+
+
+def benchmark_detection_layer(n_batches = 10, n_rois = 2000, n_objects = 300, 
+                              max_image_mismatches = 0.1, min_matched = 0.98):
+    """
+    Parity and timing of the in-graph modellib.refine_detections_graph() against the
+    NumPy modellib.refine_detections() that the DetectionLayer used to run in a tf.py_func.
+    Boxes may differ by a pixel where float32 and float64 round differently, which may flip an
+    NMS decision, so up to max_image_mismatches of the images may have different detections.
+    Their detections must still match (same class, box IoU >= 0.9) for min_matched of them.
+    """
+    config = DetectionBenchmarkConfig()
+    batch_size = config.BATCH_SIZE
+    h, w = config.IMAGE_SHAPE[:2]
+    inputs = [[synthetic_classifications(config, n_rois, n_objects, seed = batch_size * k + b) for b in range(batch_size)]
+              for k in range(n_batches)]
+    windows = np.tile(np.array([[16, 0, h - 16, w]], dtype = np.float32), [batch_size, 1])
+
+    start = time.time()
+    expected = []
+    for batch in inputs:
+        for b, (rois, probs, deltas) in enumerate(batch):
+            expected.append(modellib.refine_detections(rois, probs, deltas, windows[b], config))
+    numpy_time = time.time() - start
+
+    graph = tf.Graph()
+    with graph.as_default():
+        rois_ph = tf.placeholder(tf.float32, [None, None, 4])
+        probs_ph = tf.placeholder(tf.float32, [None, None, config.NUM_CLASSES])
+        deltas_ph = tf.placeholder(tf.float32, [None, None, config.NUM_CLASSES, 4])
+        window_ph = tf.placeholder(tf.float32, [None, 4])
+        detections_op = modellib.refine_detections_graph(rois_ph, probs_ph, deltas_ph, window_ph, config)
+
+    with tf.Session(graph = graph) as sess:
+        def run(batch):
+            return sess.run(detections_op, {rois_ph: np.stack([x[0] for x in batch]),
+                                            probs_ph: np.stack([x[1] for x in batch]),
+                                            deltas_ph: np.stack([x[2] for x in batch]),
+                                            window_ph: windows})
+        # Warm up
+        run(inputs[0])
+        start = time.time()
+        detections = np.concatenate([run(batch) for batch in inputs], axis = 0)
+        graph_time = time.time() - start
+
+    n_identical = 0
+    n_image_mismatches = 0
+    max_box_diff = 0
+    # Detections of the mismatched images, and how many of them are matched across the two
+    n_mismatched_detections = 0
+    n_matched = 0
+    for numpy_detections, graph_detections in zip(expected, detections):
+        graph_detections = graph_detections[graph_detections[:, 5] > 0]
+        # Detections are sorted by score in both, and the scores are distinct floats. A box off by
+        # a pixel may change the outcome of the NMS, so the detections of images that differ are matched
+        if not (np.array_equal(numpy_detections[:, 5].astype(np.float32), graph_detections[:, 5]) and
+                np.array_equal(numpy_detections[:, 4], graph_detections[:, 4])):
+            n_image_mismatches += 1
+            n_mismatched_detections += max(len(numpy_detections), len(graph_detections))
+            n_matched += _matched_detections(numpy_detections, graph_detections)
+            continue
+        box_diff = np.abs(numpy_detections[:, :4] - graph_detections[:, :4])
+        max_box_diff = max(max_box_diff, np.max(box_diff)) if len(box_diff) > 0 else max_box_diff
+        n_identical += np.sum(np.all(box_diff == 0, axis = 1))
+
+    n_detections = sum([len(d) for d in expected])
+    print('Detection layer on {} images of {} ROIs, {} classes'.format(len(expected), n_rois, config.NUM_CLASSES))
+    print('{:>10}: {:8.3f} sec'.format('numpy', numpy_time))
+    print('{:>10}: {:8.3f} sec'.format('graph', graph_time))
+    print('Parity: {} images with different detections ({} / {} of their detections matched), {} / {} detections '
+          'with identical boxes, max box difference {} px'.format(n_image_mismatches, n_matched, n_mismatched_detections, 
+                                                                  n_identical, n_detections, max_box_diff))
+
+    assert max_box_diff <= 1
+    assert n_image_mismatches <= max_image_mismatches * len(expected)
+    assert n_matched >= min_matched * n_mismatched_detections
+
+
+def _proposals_batch_slice(layer, inputs):
+    """ProposalLayer.call() as it was with utils.batch_slice: a copy of the subgraphs per image"""
+    config = layer.config
+    scores = inputs[0][:, :, 1]
+    deltas = inputs[1] * np.reshape(config.RPN_BBOX_STD_DEV, [1, 1, 4])
+    anchors = layer.anchors
+    ix = tf.nn.top_k(scores, min(6000, anchors.shape[0]), sorted = True).indices
+    scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y), config.IMAGES_PER_GPU)
+    deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y), config.IMAGES_PER_GPU)
+    anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x), config.IMAGES_PER_GPU)
+    boxes = utils.batch_slice([anchors, deltas], modellib.apply_box_deltas_graph, config.IMAGES_PER_GPU)
+    height, width = config.IMAGE_SHAPE[:2]
+    window = np.array([0, 0, height, width]).astype(np.float32)
+    boxes = utils.batch_slice(boxes, lambda x: modellib.clip_boxes_graph(x, window), config.IMAGES_PER_GPU)
+    normalized_boxes = boxes / np.array([[height, width, height, width]])
+
+    def nms(normalized_boxes, scores):
+        indices = tf.image.non_max_suppression(normalized_boxes, scores, layer.proposal_count, layer.nms_threshold)
+        proposals = tf.gather(normalized_boxes, indices)
+        padding = tf.maximum(layer.proposal_count - tf.shape(proposals)[0], 0)
+        return tf.pad(proposals, [(0, padding), (0, 0)])
+    return utils.batch_slice([normalized_boxes, scores], nms, config.IMAGES_PER_GPU)
+
+
+def benchmark_proposal_layer(batch_sizes = [1, 2, 4, 8, 16], n_runs = 5):
+    """
+    Graph size, graph build time and step time of the ProposalLayer against batch size, for
+    the batched layer and the reference built with utils.batch_slice (_proposals_batch_slice()).
+    Also checks that both give the same proposals.
+    """
+    config = DetectionBenchmarkConfig()
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                                             config.BACKBONE_SHAPES, config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    rng = np.random.RandomState(0)
+
+    print('Proposal layer with {} anchors, {} proposals'.format(anchors.shape[0], config.POST_NMS_ROIS_INFERENCE))
+    print('{:>6} {:>12} {:>8} {:>10} {:>10}'.format('batch', 'layer', 'ops', 'build sec', 'step sec'))
+    for batch_size in batch_sizes:
+        config.IMAGES_PER_GPU = batch_size
+        logits = rng.normal(0, 2, (batch_size, anchors.shape[0], 2))
+        rpn_probs = (np.exp(logits) / np.sum(np.exp(logits), axis = 2, keepdims = True)).astype(np.float32)
+        rpn_bbox = rng.normal(0, 1, (batch_size, anchors.shape[0], 4)).astype(np.float32)
+
+        outputs = []
+        for name in ['batched', 'batch_slice']:
+            graph = tf.Graph()
+            with graph.as_default():
+                layer = modellib.ProposalLayer(proposal_count = config.POST_NMS_ROIS_INFERENCE,
+                                               nms_threshold = config.RPN_NMS_THRESHOLD,
+                                               anchors = anchors, config = config)
+                inputs = [tf.constant(rpn_probs), tf.constant(rpn_bbox)]
+                start = time.time()
+                proposals = layer.call(inputs) if name == 'batched' else _proposals_batch_slice(layer, inputs)
+                build_time = time.time() - start
+                n_ops = len(graph.get_operations())
+
+            with tf.Session(graph = graph) as sess:
+                outputs.append(sess.run(proposals))
+                start = time.time()
+                for _ in range(n_runs):
+                    sess.run(proposals)
+                step_time = (time.time() - start) / n_runs
+
+            print('{:>6} {:>12} {:>8} {:>10.3f} {:>10.3f}'.format(batch_size, name, n_ops, build_time, step_time))
+
+        assert np.allclose(outputs[0], outputs[1])
+
+
+def synthetic_detection_targets(config, batch_size, n_gt = 20, n_crowd = 2, n_proposals = 300, seed = 0):
+    """
+    Random inputs of the DetectionTargetLayer: per image n_gt GT boxes and n_crowd crowd boxes (negative
+    class IDs), zero padded to config.MAX_GT_INSTANCES, with boolean mini masks, and n_proposals proposals
+    (zero padded) made of two jittered copies of each GT box (positive ROIs) and 3.5 small random boxes
+    per GT box (mostly negative ROIs). All ROIs fit in config.TRAIN_ROIS_PER_IMAGE, so that the sampling
+    keeps all of them. Returns proposals, gt_class_ids, gt_boxes, gt_masks
+    """
+    rng = np.random.RandomState(seed)
+    n_boxes = n_gt + n_crowd
+    proposals = np.zeros((batch_size, n_proposals, 4), dtype = np.float32)
+    gt_class_ids = np.zeros((batch_size, config.MAX_GT_INSTANCES), dtype = np.int32)
+    gt_boxes = np.zeros((batch_size, config.MAX_GT_INSTANCES, 4), dtype = np.float32)
+    gt_masks = rng.rand(batch_size, config.MINI_MASK_SHAPE[0], config.MINI_MASK_SHAPE[1], config.MAX_GT_INSTANCES) > 0.5
+    for b in range(batch_size):
+        corners = rng.uniform(0, 0.8, (n_boxes, 2))
+        boxes = np.concatenate([corners, corners + rng.uniform(0.05, 0.2, (n_boxes, 2))], axis = 1)
+        gt_boxes[b, :n_boxes] = boxes
+        gt_class_ids[b, :n_gt] = rng.randint(1, config.NUM_CLASSES, n_gt)
+        gt_class_ids[b, n_gt : n_boxes] = -1
+
+        positives = np.repeat(boxes[:n_gt], 2, axis = 0) + rng.normal(0, 0.002, (2 * n_gt, 4))
+        corners = rng.uniform(0, 0.98, (7 * n_gt // 2, 2))
+        negatives = np.concatenate([corners, corners + 0.01], axis = 1)
+        rois = np.concatenate([positives, negatives], axis = 0)
+        proposals[b, :len(rois)] = rois[rng.permutation(len(rois))]
+    return proposals, gt_class_ids, gt_boxes, gt_masks
+
+
+def _sorted_detection_targets(outputs, b):
+    """Detection targets (rois, class_ids, deltas, masks) of image b without padding, sorted by ROI"""
+    rois = outputs[0][b]
+    keep = np.any(rois != 0, axis = 1)
+    order = np.lexsort(rois[keep].T[::-1])
+    return [o[b][keep][order] for o in outputs]
+
+
+def benchmark_detection_target_layer(batch_sizes = [1, 2, 4, 8, 16], n_runs = 5):
+    """
+    Graph size, graph build time and step time of the DetectionTargetLayer against batch size, for
+    the batched layer and the reference built with utils.batch_slice of modellib.detection_targets_graph().
+    Also checks that both give the same targets. The ROIs are sampled in a random order, so the targets
+    of each image are compared sorted by ROI.
+    """
+    config = DetectionBenchmarkConfig()
+
+    print('Detection target layer with {} ROIs per image'.format(config.TRAIN_ROIS_PER_IMAGE))
+    print('{:>6} {:>12} {:>8} {:>10} {:>10}'.format('batch', 'layer', 'ops', 'build sec', 'step sec'))
+    for batch_size in batch_sizes:
+        config.IMAGES_PER_GPU = batch_size
+        data = synthetic_detection_targets(config, batch_size, seed = batch_size)
+
+        outputs = []
+        for name in ['batched', 'batch_slice']:
+            graph = tf.Graph()
+            with graph.as_default():
+                inputs = [tf.constant(x) for x in data]
+                start = time.time()
+                if name == 'batched':
+                    targets = modellib.DetectionTargetLayer(config).call(inputs)
+                else:
+                    targets = utils.batch_slice(inputs, lambda w, x, y, z: modellib.detection_targets_graph(w, x, y, z, config),
+                                                config.IMAGES_PER_GPU)
+                build_time = time.time() - start
+                n_ops = len(graph.get_operations())
+
+            with tf.Session(graph = graph) as sess:
+                outputs.append(sess.run(targets))
+                start = time.time()
+                for _ in range(n_runs):
+                    sess.run(targets)
+                step_time = (time.time() - start) / n_runs
+
+            print('{:>6} {:>12} {:>8} {:>10.3f} {:>10.3f}'.format(batch_size, name, n_ops, build_time, step_time))
+
+        for b in range(batch_size):
+            batched, reference = [_sorted_detection_targets(o, b) for o in outputs]
+            assert len(batched[0]) == len(reference[0]) > 0
+            assert np.allclose(batched[0], reference[0])
+            assert np.array_equal(batched[1], reference[1])
+            assert np.allclose(batched[2], reference[2], atol = 1e-5)
+            assert np.array_equal(batched[3], reference[3])
+
+
+def _time_detection(settings, batch_size, n_runs, shape = (520, 696), n_instances = 200):
+    """
+    Seconds per model.detect() of a batch of batch_size synthetic images, for a randomly initialised
+    inference MaskRCNN created with the CPU settings (mask_rcnn_config kwargs) applied
+    """
+    from dsb2018_config import mask_rcnn_config
+    from settings import apply_cpu_settings
+    _config = mask_rcnn_config(images_per_gpu = batch_size, model_dir = tempfile.mkdtemp(), **settings)
+    apply_cpu_settings(_config)
+    model = modellib.MaskRCNN(mode = 'inference', config = _config, model_dir = _config.MODEL_DIR)
+
+    images = [synthetic_image(synthetic_labels(shape, n_instances, seed = k)) for k in range(batch_size)]
+    # Warm up
+    model.detect(images)
+    start = time.time()
+    for _ in range(n_runs):
+        model.detect(images)
+    return (time.time() - start) / n_runs
+
+
+def benchmark_cpu_threads(settings = None, batch_size = 4, n_runs = 3):
+    """
+    Sweeps the CPU execution settings of mask_rcnn_config (see settings.apply_cpu_settings())
+    over a fixed batch. Each setting runs in a fresh process, as the Keras session can only be set
+    once per process, spawned with the OpenMP environment of the setting (see mask_rcnn_config.openmp_environ())
+    """
+    n_cores = multiprocessing.cpu_count()
+    if settings is None:
+        settings = [{},
+                    {'intra_op_threads': n_cores, 'inter_op_threads': 1},
+                    {'intra_op_threads': n_cores, 'inter_op_threads': 2},
+                    {'intra_op_threads': max(1, n_cores // 2), 'inter_op_threads': 2},
+                    {'intra_op_threads': n_cores, 'inter_op_threads': 2, 'omp_threads': n_cores, 'kmp_blocktime': 1},
+                    {'intra_op_threads': max(1, n_cores // 2), 'inter_op_threads': 1,
+                     'cpu_cores': list(range(max(1, n_cores // 2))), 'omp_threads': max(1, n_cores // 2)}]
+
+    from dsb2018_config import mask_rcnn_config
+
+    print('Detection of a batch of {} images on {} cores'.format(batch_size, n_cores))
+    context = multiprocessing.get_context('spawn')
+    for setting in settings:
+        with model_shards.spawn_environ(mask_rcnn_config(**setting).openmp_environ()):
+            pool = context.Pool(1)
+        with pool:
+            seconds = pool.apply(_time_detection, (setting, batch_size, n_runs))
+        print('{:8.2f} sec/batch {:8.2f} images/sec  {}'.format(seconds, batch_size / seconds, setting if len(setting) > 0 else 'TensorFlow defaults'))
+
+
+def main():
+    names = sys.argv[1:] if len(sys.argv) > 1 else ['augmentation']
+    for name in names:
+        globals()['benchmark_' + name]()
+
+
+if __name__ == '__main__':
+    main()
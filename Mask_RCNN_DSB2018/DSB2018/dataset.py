@@ -116,6 +116,9 @@ class DSB2018_Dataset(utils.Dataset):
     def get_cache_dir(self, is_mask):
         return os.path.join(data_dir, '_'.join(('maskrcnn_mask_cache' if is_mask else 'maskrcnn_image_cache', str(self.invert_type), str(self.to_grayscale))))
 
+    def get_label_cache_dir(self):
+        return os.path.join(data_dir, '_'.join(('maskrcnn_label_cache', str(self.invert_type), str(self.to_grayscale))))
+
     def load_image(self, image_id):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
@@ -245,6 +248,45 @@ class DSB2018_Dataset(utils.Dataset):
 
         return mask   
 
+    def load_labels(self, image_id):
+        """ 
+        Returns:
+            labels: An int16/int32 array of shape [height, width], instance i
+                has label i + 1 and 0 is background (see utils.masks_to_labels).
+            class_ids: a 1D array of class IDs of the instances.
+        Labels are cached on disk next to the mask cache as they are much
+        smaller than the mask stack.
+        """
+        labels = None
+
+        use_cache = (self.image_info[image_id]['is_mosaic'] is False) and \
+                    ((self.cache == DSB2018_Dataset.Cache.DISK) or (self.cache == DSB2018_Dataset.Cache.DISK_MASKS))
+
+        if use_cache:
+
+            labels_file = os.path.join(self.get_label_cache_dir(), ''.join((self.image_info[image_id]['name'], '.npz')))
+
+            if not os.path.exists(self.get_label_cache_dir()):
+                os.makedirs(self.get_label_cache_dir())
+
+            if os.path.exists(labels_file):
+                labels_load = np.load(labels_file)
+                labels = labels_load['labels']
+                num_instances = int(labels_load['num_instances'])
+
+        if labels is None:
+
+            mask = self.load_mask_from_file(image_id)
+            labels = utils.masks_to_labels(mask)
+            num_instances = mask.shape[-1]
+
+            if use_cache:
+                np.savez(labels_file, labels = labels, num_instances = num_instances)
+
+        class_ids = np.ones(num_instances, dtype=np.int32)
+
+        return labels, class_ids
+
     def invert_img(self, img, cutoff=.5):
         '''Invert image if mean value is greater than cutoff.'''
 
@@ -320,4 +362,4 @@ def main():
     return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Columnar container of the detections of one image, gathered from any number of sources
+(the models of an ensemble, or the test time augmentations of a model).
+
+Each column (rois, scores, class_ids, source, mask_extents) is a preallocated array that is grown
+geometrically, so appending a set of detections costs O(its size) amortised. Masks are stored
+sparsely, as the crop of each mask within its extent, and selections only index the columns:
+the mask crops and semantic masks are shared, never copied.
+"""
+import numpy as np
+
+import dsb2018_utils as du
+
+
+class Detections(object):
+
+    def __init__(self, image_shape, capacity = 256):
+        self.image_shape = tuple(image_shape[:2])
+        self.n = 0
+        self._rois = np.zeros((capacity, 4), dtype = np.int32)
+        self._scores = np.zeros(capacity, dtype = np.float32)
+        self._class_ids = np.zeros(capacity, dtype = np.int32)
+        self._source = np.zeros(capacity, dtype = np.int32)
+        self._mask_extents = np.zeros((capacity, 4), dtype = np.int32)
+        # [h, w] uint8 crop of each mask within its extent
+        self.crops = []
+        # [H, W] semantic mask of each source (None if it has none)
+        self.semantic_masks = []
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def n_sources(self):
+        return len(self.semantic_masks)
+
+    @property
+    def rois(self):
+        return self._rois[:self.n]
+
+    @property
+    def scores(self):
+        return self._scores[:self.n]
+
+    @property
+    def class_ids(self):
+        return self._class_ids[:self.n]
+
+    @property
+    def source(self):
+        """[N] index of the source (see append()) of each detection"""
+        return self._source[:self.n]
+
+    @property
+    def mask_extents(self):
+        """[N, (y1, x1, y2, x2)] extents of the masks, i.e. the windows of their crops"""
+        return self._mask_extents[:self.n]
+
+    def _reserve(self, n):
+        """Grows the columns (by doubling) so that n more detections fit"""
+        capacity = self._rois.shape[0]
+        if self.n + n <= capacity:
+            return
+        capacity = max(2 * capacity, self.n + n)
+        for name in ['_rois', '_scores', '_class_ids', '_source', '_mask_extents']:
+            column = getattr(self, name)
+            grown = np.zeros((capacity, ) + column.shape[1:], dtype = column.dtype)
+            grown[:self.n] = column[:self.n]
+            setattr(self, name, grown)
+
+    def _append_columns(self, rois, scores, class_ids, source, mask_extents, crops):
+        n = len(crops)
+        self._reserve(n)
+        self._rois[self.n : self.n + n] = rois
+        self._scores[self.n : self.n + n] = scores
+        self._class_ids[self.n : self.n + n] = class_ids
+        self._source[self.n : self.n + n] = source
+        self._mask_extents[self.n : self.n + n] = mask_extents
+        self.crops.extend(crops)
+        self.n += n
+
+    def append(self, rois, class_ids, scores, masks, semantic_mask = None):
+        """
+        Appends the detections of a new source, e.g. a result of model.detect().
+        masks: [H, W, N] instance masks, semantic_mask: optional [H, W] semantic mask of the source
+        Returns the index of the source
+        """
+        mask_extents = du.mask_extents(masks)
+        crops = [masks[y1 : y2, x1 : x2, i].astype(np.uint8) for i, (y1, x1, y2, x2) in enumerate(mask_extents)]
+        return self.append_crops(rois, class_ids, scores, crops, mask_extents, semantic_mask)
+
+    def append_crops(self, rois, class_ids, scores, crops, mask_extents, semantic_mask = None):
+        """
+        Appends the detections of a new source whose masks are already cropped, e.g. a result of
+        tta.TTATransform.invert(), without going through [H, W, N] masks.
+        crops: list of N [h, w] masks within their mask_extents [N, (y1, x1, y2, x2)]
+        Returns the index of the source
+        """
+        source = self.n_sources
+        crops = [crop.astype(np.uint8, copy = False) for crop in crops]
+        self._append_columns(rois, np.reshape(scores, -1), np.reshape(class_ids, -1), source, 
+                             np.reshape(mask_extents, (-1, 4)), crops)
+        self.semantic_masks.append(semantic_mask)
+        return source
+
+    def extend(self, other):
+        """Appends the detections (and sources) of other"""
+        assert other.image_shape == self.image_shape
+        self._append_columns(other.rois, other.scores, other.class_ids, other.source + self.n_sources,
+                             other.mask_extents, other.crops)
+        self.semantic_masks.extend(other.semantic_masks)
+
+    @classmethod
+    def concatenate(cls, detections):
+        """Concatenates a list of Detections of the same image"""
+        output = cls(detections[0].image_shape, capacity = max(1, sum([len(d) for d in detections])))
+        for d in detections:
+            output.extend(d)
+        return output
+
+    def __getitem__(self, index):
+        """Selection by a boolean mask or an array of indices. The sources are kept"""
+        index = np.arange(self.n)[index]
+        output = Detections(self.image_shape, capacity = max(1, len(index)))
+        output._append_columns(self.rois[index], self.scores[index], self.class_ids[index], self.source[index],
+                               self.mask_extents[index], [self.crops[i] for i in index])
+        output.semantic_masks = list(self.semantic_masks)
+        return output
+
+    def masks(self):
+        """Returns the [H, W, N] uint8 masks"""
+        masks = np.zeros(self.image_shape + (self.n, ), dtype = np.uint8)
+        for i, (y1, x1, y2, x2) in enumerate(self.mask_extents):
+            masks[y1 : y2, x1 : x2, i] = self.crops[i]
+        return masks
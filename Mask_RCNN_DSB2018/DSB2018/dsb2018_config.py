@@ -57,7 +57,13 @@ class mask_rcnn_config(config.Config):
                  augmentation_crop_min_scale = 0.8,
                  augmentation_dict = {'dim_ordering': 'tf', 'horizontal_flip': True, 'vertical_flip': True},
                  fn_load = 'load_image_gt_augment',
-                 mask_size_dir = None):
+                 augmentation_batch = False,
+                 mask_size_dir = None,
+                 intra_op_threads = 0,
+                 inter_op_threads = 0,
+                 cpu_cores = None,
+                 omp_threads = None,
+                 kmp_blocktime = None):
 
         self.train_data_root = train_data_root
         self.val_data_root = val_data_root
@@ -80,7 +86,8 @@ class mask_rcnn_config(config.Config):
         self.USE_MINI_MASK = use_mini_mask
         self.MINI_MASK_SHAPE = (mini_mask_shape, mini_mask_shape)  # (height, width) of the mini-mask
     
-        self.GPU_COUNT = len(get_available_gpus())
+        # One 'GPU' on CPU-only machines, i.e. a single model tower
+        self.GPU_COUNT = max(1, len(get_available_gpus()))
         self.IMAGES_PER_GPU = images_per_gpu
          # Effective batch size
         self.BATCH_SIZE = self.IMAGES_PER_GPU * self.GPU_COUNT
@@ -186,17 +193,47 @@ class mask_rcnn_config(config.Config):
         self.augmentation_crop_max_scale = augmentation_crop_max_scale
         self.augmentation_crop_min_scale = augmentation_crop_min_scale
         self.fn_load = fn_load
+        # Load and augment a whole batch at a time in data_generator (see model.load_image_gt_batch)
+        self.augmentation_batch = augmentation_batch
 
         self.NAME = self.get_name()
 
-        # Set up mask size saving if requested
-        if mask_size_dir is not None:
-            self.mask_size_filename = os.path.join(mask_size_dir, ''.join((self.NAME, '.npy')))
-            if not os.path.exists(self.mask_size_filename):
-                mask_size = np.array([])
-                np.save(self.mask_size_filename, mask_size)
-        else:
-            self.mask_size_filename = None
+        # Set up mask size statistics if requested. Each data generator
+        # process writes its own histogram file into mask_size_dir, see
+        # model.load_mask_size_statistics to merge them
+        if mask_size_dir is not None and not os.path.exists(mask_size_dir):
+            os.makedirs(mask_size_dir)
+        self.mask_size_dir = mask_size_dir
+
+        # CPU execution settings, applied by settings.apply_cpu_settings() when a model is created.
+        # They do not change the model, so are not part of NAME.
+        # Threads of the TensorFlow intra-op (within an op) and inter-op (across ops) pools, 0: one per core
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        # List of the cores the process is pinned to (None: not pinned)
+        self.cpu_cores = cpu_cores
+        # OpenMP/MKL threads and KMP_BLOCKTIME (ms an OpenMP thread spins after its work), for MKL builds
+        # of TensorFlow. None leaves the environment as is. They only take effect in the environment
+        # TensorFlow starts with, see openmp_environ()
+        self.omp_threads = omp_threads
+        self.kmp_blocktime = kmp_blocktime
+
+
+    def openmp_environ(self):
+        """
+        Environment variables of the OpenMP settings. They must be set before TensorFlow is imported:
+        exported before starting Python, or in the environment a process is spawned with
+        (see model_shards.spawn_environ())
+        """
+        environ = {}
+        if self.omp_threads is not None:
+            environ['OMP_NUM_THREADS'] = str(self.omp_threads)
+            environ['MKL_NUM_THREADS'] = str(self.omp_threads)
+            if self.cpu_cores is not None:
+                environ['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
+        if self.kmp_blocktime is not None:
+            environ['KMP_BLOCKTIME'] = str(self.kmp_blocktime)
+        return environ
 
 
     def to_string(self, x):
@@ -1,4 +1,6 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
 from utils import *
 
 
@@ -214,6 +216,24 @@ def maskrcnn_boxes_to_labels(boxes, scores, mask_shape):
     return box_labels
 
 
+def mask_extents(masks, pad = 0):
+    """
+    Returns the [N, (y1, x1, y2, x2)] extents of the pixels of masks [H, W, N], padded by pad 
+    and clipped to the image. Empty masks have an empty extent (0, 0, 0, 0).
+    """
+    H, W = masks.shape[:2]
+    rows = np.any(masks, axis = 1)
+    cols = np.any(masks, axis = 0)
+
+    extents = np.stack([np.maximum(np.argmax(rows, axis = 0) - pad, 0),
+                        np.maximum(np.argmax(cols, axis = 0) - pad, 0),
+                        np.minimum(H - np.argmax(rows[::-1], axis = 0) + pad, H),
+                        np.minimum(W - np.argmax(cols[::-1], axis = 0) + pad, W)], axis = 1)
+    extents[~np.any(rows, axis = 0)] = 0
+
+    return extents
+
+
 def run_length_decode(rel, H, W, fill_value = 255, index_offset = 0):
     mask = np.zeros((H * W), np.uint8)
     if rel != '':
@@ -237,68 +257,243 @@ def labels_from_rles(mask_rles, mask_shape):
     return labels, masks
 
 
-def combine_boxes(boxes, scores, masks, threshold, semantic_masks = None):
+def consecutive_labels(labels):
+    """
+    Renumbers the instances of a label image (0 = background) to 1 -> N.
+    Returns the renumbered labels (flattened) and N
+    """
+    u, labels = np.unique(np.concatenate([[0], labels.ravel()]), return_inverse = True)
+    return labels[1:], len(u) - 1
+
+
+def dsb2018_score(true_labels, pred_labels, thresholds = np.arange(0.5, 1.0, 0.05)):
+    """
+    DSB2018 metric for one image: the mean over IoU thresholds of TP / (TP + FP + FN), where a
+    prediction matches a true instance if their IoU is above the threshold.
+    The IoUs of all (true, pred) pairs come from a single bincount of the label pairs, and as 
+    matches at IoU > 0.5 are unique all thresholds are evaluated at once.
+    true_labels, pred_labels: [H, W] label images (0 = background)
+    """
+    true_labels, n_true = consecutive_labels(true_labels)
+    pred_labels, n_pred = consecutive_labels(pred_labels)
+
+    if n_true == 0 or n_pred == 0:
+        return float(n_true == n_pred)
+
+    # Pixel counts of each (true, pred) label pair, including the background
+    counts = np.bincount(true_labels * (n_pred + 1) + pred_labels, minlength = (n_true + 1) * (n_pred + 1)).reshape(n_true + 1, n_pred + 1)
+    area_true = np.sum(counts, axis = 1)[1:]
+    area_pred = np.sum(counts, axis = 0)[1:]
+    intersection = counts[1:, 1:]
+    iou = intersection / (area_true[:, None] + area_pred[None, :] - intersection)
+
+    matched_iou = iou[iou > 0.5]
+    tp = np.sum(matched_iou[None, :] > np.asarray(thresholds)[:, None], axis = 1)
+    fp = n_pred - tp
+    fn = n_true - tp
+
+    return np.mean(tp / (tp + fp + fn))
+
+
+def _greedy_clusters(boxes, area, threshold):
+    """
+    Clusters of combine_boxes(method = 'greedy'): the first remaining box absorbs every remaining box
+    with IoU > threshold, growing to their union, until it absorbs no more (its area is kept as the
+    area of the original box). The candidates are looked up in the boxes sorted by y1, rather than
+    recomputing the IoU with every remaining box.
+    """
+    n = boxes.shape[0]
+    order = np.argsort(boxes[:, 0], kind = 'stable')
+    y1_sorted = boxes[order, 0]
+    max_height = np.max(boxes[:, 2] - boxes[:, 0])
+
+    cluster = np.full(n, -1, dtype = np.int64)
+    first = []
+    for i in range(n):
+        if cluster[i] >= 0:
+            continue
+        k = len(first)
+        first.append(i)
+        cluster[i] = k
+        box = boxes[i].copy()
+
+        while True:
+            # Only boxes overlapping the (grown) box can have IoU > threshold >= 0
+            if threshold >= 0:
+                lo = np.searchsorted(y1_sorted, box[0] - max_height, side = 'right')
+                hi = np.searchsorted(y1_sorted, box[2], side = 'left')
+                candidates = order[lo : hi]
+            else:
+                candidates = order
+            candidates = candidates[cluster[candidates] < 0]
+
+            iou = compute_iou(box, boxes[candidates], area[i], area[candidates])
+            join_ixs = candidates[iou > threshold]
+            if len(join_ixs) == 0:
+                break
+
+            cluster[join_ixs] = k
+            box = np.array([min(box[0], np.min(boxes[join_ixs, 0])),
+                            min(box[1], np.min(boxes[join_ixs, 1])),
+                            max(box[2], np.max(boxes[join_ixs, 2])),
+                            max(box[3], np.max(boxes[join_ixs, 3]))], dtype = boxes.dtype)
+
+    return cluster, np.array(first, dtype = np.int64)
+
+
+def _candidate_pairs(boxes, chunk_size = 4096):
+    """
+    Yields (i, j) arrays of the pairs of boxes that may overlap, in chunks. The boxes are bucketed in 
+    a grid of cells as large as the largest box, so that overlapping boxes have their (y1, x1) corners 
+    in the same or adjacent cells.
+    """
+    n = boxes.shape[0]
+    cell = max(1., float(np.max(boxes[:, 2:] - boxes[:, :2])))
+    cy = np.floor(boxes[:, 0] / cell).astype(np.int64)
+    cx = np.floor(boxes[:, 1] / cell).astype(np.int64)
+    cy = cy - cy.min() + 1
+    cx = cx - cx.min() + 1
+    stride = cx.max() + 2
+    cell_ids = cy * stride + cx
+
+    order = np.argsort(cell_ids, kind = 'stable')
+    sorted_ids = cell_ids[order]
+
+    # Each pair of adjacent cells once
+    for dy, dx in [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]:
+        target = sorted_ids + dy * stride + dx
+        lo = np.arange(1, n + 1) if (dy, dx) == (0, 0) else np.searchsorted(sorted_ids, target, side = 'left')
+        hi = np.searchsorted(sorted_ids, target, side = 'right')
+
+        for start in range(0, n, chunk_size):
+            i = np.arange(start, min(start + chunk_size, n))
+            counts = np.maximum(hi[i] - lo[i], 0)
+            ii = np.repeat(i, counts)
+            jj = np.repeat(lo[i], counts) + np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+            yield order[ii], order[jj]
+
+
+def _union_find_clusters(boxes, area, threshold):
+    """
+    Clusters of combine_boxes(method = 'union_find'): the connected components of the pairs of 
+    boxes with IoU > threshold. The IoU is computed once, for the pairs of _candidate_pairs().
+    """
+    assert threshold >= 0, 'union_find requires threshold >= 0'
+    n = boxes.shape[0]
+
+    pairs_i = []
+    pairs_j = []
+    for ii, jj in _candidate_pairs(boxes):
+        y1 = np.maximum(boxes[ii, 0], boxes[jj, 0])
+        y2 = np.minimum(boxes[ii, 2], boxes[jj, 2])
+        x1 = np.maximum(boxes[ii, 1], boxes[jj, 1])
+        x2 = np.minimum(boxes[ii, 3], boxes[jj, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            iou = intersection / (area[ii] + area[jj] - intersection)
+
+        keep = iou > threshold
+        pairs_i.append(ii[keep])
+        pairs_j.append(jj[keep])
+
+    pairs_i = np.concatenate(pairs_i)
+    pairs_j = np.concatenate(pairs_j)
+    graph = scipy.sparse.coo_matrix((np.ones(len(pairs_i), dtype = np.int8), (pairs_i, pairs_j)), shape = (n, n))
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed = False)
+
+    # Number the clusters in the order of their first box
+    first = np.full(labels.max() + 1, n, dtype = np.int64)
+    np.minimum.at(first, labels, np.arange(n))
+    rank = np.argsort(first)
+    relabel = np.empty_like(rank)
+    relabel[rank] = np.arange(len(rank))
+
+    return relabel[labels], first[rank]
+
+
+def cluster_boxes(boxes, threshold, method = 'greedy'):
+    """
+    Clusters boxes [N, (y1, x1, y2, x2)] by IoU > threshold.
+    method: 'greedy' grows clusters from the first remaining box (the original combine_boxes() behaviour),
+            'union_find' takes the connected components of the box pairs with IoU > threshold of the 
+            original boxes, which does not depend on the order of the boxes (the clusters differ from 
+            greedy's as joins are transitive but boxes do not grow)
+    Returns the [N] cluster of each box, numbered in the order of their first box, and the [K] index 
+    of the first box of each cluster
+    """
+    boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    if method == 'greedy':
+        return _greedy_clusters(boxes, area, threshold)
+    elif method == 'union_find':
+        return _union_find_clusters(boxes, area, threshold)
+    raise ValueError('Unknown clustering method {}'.format(method))
+
+
+def combine_box_crops(boxes, scores, mask_extents, crops, threshold, semantic_index = None, method = 'greedy'):
+    """
+    Combines boxes if their IOU is above threshold (see cluster_boxes()), with the masks given sparsely
+    as their crops within mask_extents [N, (y1, x1, y2, x2)] (see detections.Detections).
+    The masks of each combined box are summed within the union of their extents only.
+    Returns idx (the first box of each combined box), boxes, scores (the mean score), vote_extents,
+    votes (the [h, w] sums of the masks within vote_extents), n_joins and, if semantic_index is 
+    provided, semantic_counts (see combine_boxes())
+    """
+    assert boxes.shape[0] > 0
+    boxes = boxes.astype(np.float32)
+    cluster, idx = cluster_boxes(boxes, threshold, method)
+    n_clusters = len(idx)
+
+    n_joins = np.bincount(cluster, minlength = n_clusters).astype(np.float64)
+    combined_scores = np.bincount(cluster, weights = scores, minlength = n_clusters) / n_joins
+
+    combined_boxes = np.stack([np.full(n_clusters, np.inf), np.full(n_clusters, np.inf), 
+                               np.full(n_clusters, -np.inf), np.full(n_clusters, -np.inf)], axis = 1).astype(np.float32)
+    for c in range(4):
+        (np.minimum if c < 2 else np.maximum).at(combined_boxes[:, c], cluster, boxes[:, c])
+
+    # Union of the extents of the (non-empty) masks of each combined box
+    mask_extents = np.asarray(mask_extents, dtype = np.int64).reshape(-1, 4)
+    non_empty = (mask_extents[:, 2] > mask_extents[:, 0]) & (mask_extents[:, 3] > mask_extents[:, 1])
+    vote_extents = np.stack([np.full(n_clusters, np.iinfo(np.int64).max)] * 2 + [np.full(n_clusters, np.iinfo(np.int64).min)] * 2, axis = 1)
+    for c in range(4):
+        (np.minimum if c < 2 else np.maximum).at(vote_extents[:, c], cluster[non_empty], mask_extents[non_empty, c])
+    vote_extents[~np.isin(np.arange(n_clusters), cluster[non_empty])] = 0
+
+    votes = [np.zeros((y2 - y1, x2 - x1), dtype = np.int32) for y1, x1, y2, x2 in vote_extents]
+    for j in np.nonzero(non_empty)[0]:
+        y1, x1, y2, x2 = mask_extents[j]
+        Y1, X1 = vote_extents[cluster[j], :2]
+        votes[cluster[j]][y1 - Y1 : y2 - Y1, x1 - X1 : x2 - X1] += crops[j]
+
+    if semantic_index is not None:
+        semantic_counts = np.zeros((n_clusters, np.max(semantic_index) + 1), dtype = np.int32)
+        np.add.at(semantic_counts, (cluster, semantic_index), 1)
+        return idx, combined_boxes, combined_scores, vote_extents, votes, n_joins, semantic_counts
+    else:
+        return idx, combined_boxes, combined_scores, vote_extents, votes, n_joins
+
+
+def combine_boxes(boxes, scores, masks, threshold, semantic_index = None, method = 'greedy'):
     """
     Combines boxes if their IOU is above threshold.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     threshold: Float. IoU threshold to use for filtering.
+    semantic_index: optional [N] index of the semantic mask of each box (see detections.Detections.source). 
+                    If provided, also returns the [K, n_semantic_masks] number of boxes of each combined 
+                    box per semantic mask, from which its semantic mask is summed (see submit.vote_semantic())
+    method: how boxes are clustered, see cluster_boxes()
+    Dense version of combine_box_crops(), with masks [H, W, N] and the combined masks [H, W, K] summed.
     """
-    assert boxes.shape[0] > 0
-    if boxes.dtype.kind != "f":
-        boxes = boxes.astype(np.float32)
-
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
-    # Get indicies of boxes 
-    ixs = np.arange(boxes.shape[0])
-    n_joins = np.ones(ixs.shape)
-    ixs_pick = []
-
-    while len(ixs) > 0:
-
-        # Pick box and add its index to the list
-        i = ixs[0]
-        ixs_pick.append(i)
-
-        # Join this box to all other boxes with iou > threshold
-        search_completed = False
-
-        while not search_completed:
-            # Compute IoU of the picked box with the rest
-            iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-            # Identify boxes with IoU over the threshold. This
-            # returns indicies into ixs[1:], so add 1 to get
-            # indicies into ixs.
-            join_ixs = np.where(iou > threshold)[0] + 1
-            if len(join_ixs) > 0:
-                new_box = np.array([min([boxes[i, 0], np.min(boxes[ixs[join_ixs], 0])]),
-                                    min([boxes[i, 1], np.min(boxes[ixs[join_ixs], 1])]),
-                                    max([boxes[i, 2], np.max(boxes[ixs[join_ixs], 2])]),
-                                    max([boxes[i, 3], np.max(boxes[ixs[join_ixs], 3])])])
-                new_mask = np.sum(np.stack([masks[:, :, i]] + [masks[:, :, j] for j in ixs[join_ixs]], axis = -1), axis = -1)
-
-                if semantic_masks is not None:
-                    new_semantic_mask = np.sum(np.stack([semantic_masks[:, :, i]] + [semantic_masks[:, :, j] for j in ixs[join_ixs]], axis = -1), axis = -1)
-                    semantic_masks[:, :, i] = new_semantic_mask
-
-                boxes[i] = new_box
-                masks[:, :, i] = new_mask
-                scores[i] = (scores[i] + np.sum(scores[ixs[join_ixs]]))
-                n_joins[i] = n_joins[i] + len(join_ixs)
-                # Remove indicies of the overlapped boxes.
-                ixs = np.delete(ixs, join_ixs)
-            else:
-                search_completed = True
-                ixs = np.delete(ixs, 0)
-    ixs_pick = np.array(ixs_pick)
+    extents = mask_extents(masks)
+    crops = [masks[y1 : y2, x1 : x2, i] for i, (y1, x1, y2, x2) in enumerate(extents)]
+    output = combine_box_crops(boxes, scores, extents, crops, threshold, semantic_index, method)
+    idx, combined_boxes, combined_scores, vote_extents, votes, n_joins = output[:6]
 
-    if semantic_masks is not None:
-        return ixs_pick, boxes[ixs_pick], scores[ixs_pick] / n_joins[ixs_pick], masks[:, :, ixs_pick], n_joins[ixs_pick], semantic_masks[:, :, ixs_pick]
-    else:
-        return ixs_pick, boxes[ixs_pick], scores[ixs_pick] / n_joins[ixs_pick], masks[:, :, ixs_pick], n_joins[ixs_pick]
+    combined_masks = np.zeros(masks.shape[:2] + (len(idx), ), dtype = masks.dtype)
+    for k, (y1, x1, y2, x2) in enumerate(vote_extents):
+        combined_masks[y1 : y2, x1 : x2, k] = votes[k]
+
+    return (idx, combined_boxes, combined_scores, combined_masks, n_joins) + tuple(output[6:])
 
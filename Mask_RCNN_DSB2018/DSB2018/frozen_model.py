@@ -0,0 +1,199 @@
+"""
+Frozen inference graphs: a trained inference model exported as a single serialized GraphDef,
+with its weights baked in as constants, which loads without building the Keras model or
+reading the .h5 weights.
+
+export_frozen_graph(model, filename) writes
+- <filename>.pb: the frozen GraphDef
+- <filename>.json: the names of its input and output tensors (and of the Keras learning phase)
+
+load_frozen_model(filename, _config, model_name) returns a model_name instance (e.g. a
+modellib.SemanticMaskRCNN) whose keras_model is a FrozenGraph, so that detect() (and
+submit.detect_packed()) run as on the Keras model.
+See submit.export_model() and submit.create_model(..., frozen = True).
+
+The frozen graph can also be converted to a reduced precision (see PRECISIONS and
+reduce_precision()), written next to it as <filename>_<precision>.pb.
+"""
+import os
+import json
+import shutil
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import model as modellib
+
+
+def frozen_graph_path(weights_path):
+    """Filename of the frozen graph exported from the weights at weights_path (a .h5 file)"""
+    return os.path.splitext(weights_path)[0] + '.pb'
+
+
+def _names_path(filename):
+    return os.path.splitext(filename)[0] + '.json'
+
+
+# Reduced precisions of a frozen graph, as graph transforms (see reduce_precision()):
+# - float16: weights stored as float16 and cast to float32 where used. The TensorFlow CPU kernels compute
+#   in float32 (float16 is emulated, so slower), so this halves the size of the weights, not the compute
+# - int8_weights: weights stored as 8 bit, dequantized to float32 where used
+# - int8: 8 bit weights, and the convolutions and matrix products run on quantized activations
+PRECISIONS = {'float32': [],
+              'float16': None,
+              'int8_weights': ['quantize_weights(minimum_size=1024)'],
+              'int8': ['add_default_attributes', 'fold_constants(ignore_errors=true)',
+                       'fold_batch_norms', 'fold_old_batch_norms',
+                       'quantize_weights(minimum_size=1024)', 'quantize_nodes', 'sort_by_execution_order']}
+
+
+def precision_graph_path(filename, precision):
+    """Filename of the precision version of the frozen graph filename"""
+    if precision in [None, True, 'float32']:
+        return filename
+    return '_'.join((os.path.splitext(filename)[0], precision)) + '.pb'
+
+
+def _float16_weights(graph_def, minimum_size = 1024):
+    """
+    Stores the float32 constants of at least minimum_size elements as float16, each followed by a
+    Cast back to float32 under its original name, so that the graph computes as before
+    """
+    output = tf.GraphDef()
+    for node in graph_def.node:
+        if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+            output.node.extend([node])
+            continue
+        value = tf.make_ndarray(node.attr['value'].tensor)
+        if value.size < minimum_size:
+            output.node.extend([node])
+            continue
+
+        const = output.node.add()
+        const.op = 'Const'
+        const.name = node.name + '/float16'
+        const.device = node.device
+        const.attr['dtype'].type = tf.float16.as_datatype_enum
+        const.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float16)))
+
+        cast = output.node.add()
+        cast.op = 'Cast'
+        cast.name = node.name
+        cast.device = node.device
+        cast.input.append(const.name)
+        cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+        cast.attr['DstT'].type = tf.float32.as_datatype_enum
+    output.library.CopyFrom(graph_def.library)
+    output.versions.CopyFrom(graph_def.versions)
+    return output
+
+
+def reduce_precision(filename, precision):
+    """
+    Writes the precision (see PRECISIONS) version of the frozen graph filename.
+    Returns its filename
+    """
+    assert precision in PRECISIONS, 'Unknown precision {}'.format(precision)
+    output_filename = precision_graph_path(filename, precision)
+    if output_filename == filename:
+        return filename
+
+    with open(_names_path(filename)) as fp:
+        names = json.load(fp)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, 'rb') as fp:
+        graph_def.ParseFromString(fp.read())
+
+    if precision == 'float16':
+        graph_def = _float16_weights(graph_def)
+    else:
+        inputs = [name.split(':')[0] for name in names['inputs']]
+        outputs = [name.split(':')[0] for name in names['outputs']]
+        graph_def = TransformGraph(graph_def, inputs, outputs, PRECISIONS[precision])
+
+    with tf.gfile.GFile(output_filename, 'wb') as fp:
+        fp.write(graph_def.SerializeToString())
+    shutil.copyfile(_names_path(filename), _names_path(output_filename))
+
+    return output_filename
+
+
+def export_frozen_graph(model, filename):
+    """
+    Freezes the inference graph of model (a modellib.MaskRCNN in inference mode, with its weights loaded)
+    into filename. The graph must be serializable, i.e. without tf.py_func.
+    """
+    assert model.mode == 'inference', 'Only inference models can be frozen'
+    keras_model = model.keras_model
+    session = K.get_session()
+
+    output_names = [t.op.name for t in keras_model.outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+
+    with tf.gfile.GFile(filename, 'wb') as fp:
+        fp.write(graph_def.SerializeToString())
+
+    # The learning phase is a placeholder, unless it was fixed by K.set_learning_phase() before the build
+    learning_phase = K.learning_phase()
+    names = {'inputs': [t.name for t in keras_model.inputs],
+             'outputs': [t.name for t in keras_model.outputs],
+             'learning_phase': learning_phase.name if keras_model.uses_learning_phase and not isinstance(learning_phase, int) else None}
+    with open(_names_path(filename), 'w') as fp:
+        json.dump(names, fp, indent = 1)
+
+    return filename
+
+
+class FrozenGraph(object):
+    """Runs a frozen graph with the predict() interface of the Keras model it was exported from"""
+
+    def __init__(self, filename, session_config = None):
+        with open(_names_path(filename)) as fp:
+            names = json.load(fp)
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(filename, 'rb') as fp:
+            graph_def.ParseFromString(fp.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name = '')
+
+        self.inputs = [self.graph.get_tensor_by_name(name) for name in names['inputs']]
+        self.outputs = [self.graph.get_tensor_by_name(name) for name in names['outputs']]
+        self.feed_dict = {}
+        if names['learning_phase'] is not None:
+            self.feed_dict[self.graph.get_tensor_by_name(names['learning_phase'])] = False
+
+        self.session = tf.Session(graph = self.graph, config = session_config)
+
+    def predict(self, inputs, verbose = 0):
+        feed_dict = dict(zip(self.inputs, inputs))
+        feed_dict.update(self.feed_dict)
+        return self.session.run(self.outputs, feed_dict)
+
+    def close(self):
+        self.session.close()
+
+
+def model_shell(_config, model_name):
+    """
+    A model_name instance in inference mode, without building its Keras model: enough for find_last(),
+    mold_inputs() and the unmolding of the detections
+    """
+    model_class = getattr(modellib, model_name)
+    model = model_class.__new__(model_class)
+    model.mode = 'inference'
+    model.config = _config
+    model.model_dir = _config.MODEL_DIR
+    model.keras_model = None
+    return model
+
+
+def load_frozen_model(filename, _config, model_name = 'MaskRCNN', session_config = None):
+    """Returns a model_name instance in inference mode that runs the frozen graph of filename"""
+    model = model_shell(_config, model_name)
+    model.keras_model = FrozenGraph(filename, session_config)
+    return model
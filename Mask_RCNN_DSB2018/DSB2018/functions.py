@@ -1,3 +1,4 @@
+import os
 import numpy as np
 np.random.seed(1234)
 import pandas as pd
@@ -31,23 +32,38 @@ def numpy2encoding_no_overlap(predicts, img_name):
     return ImageId, EncodedPixels
 
 
+def no_overlap_threshold(predicts, threshold = 30):
+    """
+    Drops the instances of predicts [H, W, N] smaller than the (image size dependent) threshold, 
+    and assigns overlapping pixels to the first instance that covers them
+    """
+    this_threshold = threshold + (threshold * (min(np.product(predicts.shape[:2]), (512 * 512)) - (256 * 256)) / (512 * 512))
+    valid = np.sum(predicts, axis = (0, 1)) >= this_threshold
+    predicts = predicts[:, :, valid]
+
+    if predicts.shape[-1] > 0:
+        overlap = np.sum(predicts, axis=2) >= 2
+        first = np.argmax(predicts[overlap], axis=-1)
+        predicts[overlap] = 0
+        predicts[overlap, first] = 1
+
+    return predicts, valid
+
+
+def numpy2labels_no_overlap_threshold(predicts, threshold = 30):
+    """Label image [H, W] of the instances that numpy2encoding_no_overlap_threshold() encodes"""
+    predicts, _ = no_overlap_threshold(predicts, threshold)
+    if predicts.shape[-1] == 0:
+        return np.zeros(predicts.shape[:2], dtype = np.int32)
+    return np.where(np.any(predicts, axis=2), np.argmax(predicts, axis=2) + 1, 0).astype(np.int32)
+
+
 def numpy2encoding_no_overlap_threshold(predicts, img_name, scores, threshold = 30):
 
     if predicts.shape[-1] > 0:
 
-        this_threshold = threshold + (threshold * (min(np.product(predicts.shape[:2]), (512 * 512)) - (256 * 256)) / (512 * 512))
-        valid = np.sum(predicts, axis = (0, 1)) >= this_threshold
-        predicts = predicts[:, :, valid]
+        predicts, valid = no_overlap_threshold(predicts, threshold)
         scores = scores[valid]
-
-        sum_predicts = np.sum(predicts, axis=2)
-        rows, cols = np.where(sum_predicts>=2)
-    
-        for i in zip(rows, cols):
-            instance_indicies = np.where(np.any(predicts[i[0],i[1],:]))[0]
-            highest = instance_indicies[0]
-            predicts[i[0],i[1],:] = predicts[i[0],i[1],:]*0
-            predicts[i[0],i[1],highest] = 1
     
         ImageId = []
         EncodedPixels = []
@@ -70,3 +86,64 @@ def write2csv(file, ImageId, EncodedPixels):
     df = pd.DataFrame({ 'ImageId' : ImageId , 'EncodedPixels' : EncodedPixels})
     df.to_csv(file, index=False, columns=['ImageId', 'EncodedPixels'])
 
+
+class SubmissionWriter(object):
+    """
+    Streams a submission csv (same format as write2csv()): the rows of each image are appended 
+    as they are produced, and the file is flushed every flush_every images.
+    resume: if the file exists, keep the images already written (see written) instead of truncating it.
+            The rows of the last image in the file are dropped, as they may be incomplete.
+    """
+
+    def __init__(self, filename, flush_every = 10, resume = False):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.written = set()
+        self.n_unflushed = 0
+
+        lines = []
+        if resume and os.path.exists(filename):
+            with open(filename) as f:
+                lines = f.readlines()[1:]
+            # Drop an incomplete last line, then the rows of the last image
+            if len(lines) > 0 and not lines[-1].endswith('\n'):
+                lines = lines[:-1]
+            if len(lines) > 0:
+                last_image = lines[-1].split(',')[0]
+                lines = [line for line in lines if line.split(',')[0] != last_image]
+            self.written = set([line.split(',')[0] for line in lines])
+
+        # Rewrite the kept rows via a temporary file, then append to it
+        with open(filename + '.tmp', 'w') as f:
+            f.write('ImageId,EncodedPixels\n')
+            f.writelines(lines)
+        os.replace(filename + '.tmp', filename)
+        self.file = open(filename, 'a')
+
+    def __contains__(self, img_name):
+        return img_name in self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, ImageId, EncodedPixels):
+        """Appends the rows (ImageId, EncodedPixels) of one image"""
+        self.file.writelines(['{},{}\n'.format(img_name, rle) for img_name, rle in zip(ImageId, EncodedPixels)])
+        self.written.update(ImageId)
+        self.n_unflushed += 1
+        if self.n_unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.n_unflushed = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
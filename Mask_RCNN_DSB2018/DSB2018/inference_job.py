@@ -0,0 +1,128 @@
+"""
+Resumable, checkpointed inference runs.
+
+An InferenceJob keeps its outputs in <checkpoint_dir>/<job_id>/, where job_id is a hash of the
+run parameters, so that a rerun with the same parameters picks up where an interrupted run stopped:
+- shard_<k>.csv: submission rows (see functions.SubmissionWriter), shard_size images per shard
+- manifest.jsonl: one line {"image": <ImageId>, "shard": <k>} per finished image, appended
+  once the rows of the image are flushed to its shard
+
+A rerun only writes to new shards, and rows that are not in the manifest are ignored, so a crash
+at any point loses at most the images that were not yet checkpointed.
+"""
+import os
+import json
+import hashlib
+
+import functions as f
+
+
+def job_id(params):
+    """Hash of the run parameters params (a dict, values converted with str() if not json)"""
+    return hashlib.md5(json.dumps(params, sort_keys = True, default = str).encode()).hexdigest()[:16]
+
+
+class InferenceJob(object):
+
+    def __init__(self, checkpoint_dir, params, shard_size = 500, checkpoint_every = 10):
+        self.job_dir = os.path.join(checkpoint_dir, job_id(params))
+        self.shard_size = shard_size
+        self.checkpoint_every = checkpoint_every
+        os.makedirs(self.job_dir, exist_ok = True)
+
+        with open(os.path.join(self.job_dir, 'params.json'), 'w') as fp:
+            json.dump(params, fp, sort_keys = True, default = str, indent = 1)
+
+        # Images finished by previous runs: {ImageId: shard}
+        self.done = self.read_manifest()
+        if len(self.done) > 0:
+            print('Resuming {}: {} images already done'.format(self.job_dir, len(self.done)))
+
+        self.manifest = open(os.path.join(self.job_dir, 'manifest.jsonl'), 'a')
+        self.shard = max(self.done.values()) + 1 if len(self.done) > 0 else 0
+        self.writer = None
+        self.n_shard_images = 0
+        self.pending = []
+
+    def shard_filename(self, shard):
+        return os.path.join(self.job_dir, 'shard_{}.csv'.format(shard))
+
+    def read_manifest(self):
+        done = {}
+        filename = os.path.join(self.job_dir, 'manifest.jsonl')
+        if os.path.exists(filename):
+            with open(filename) as fp:
+                for line in fp:
+                    # Ignore an incomplete last line
+                    if line.endswith('\n'):
+                        entry = json.loads(line)
+                        done[entry['image']] = entry['shard']
+        return done
+
+    def __contains__(self, img_name):
+        return img_name in self.done
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, ImageId, EncodedPixels):
+        """Appends the rows of one or more images, as returned by f.numpy2encoding_no_overlap_threshold()"""
+        if self.writer is None:
+            self.writer = f.SubmissionWriter(self.shard_filename(self.shard), flush_every = self.checkpoint_every)
+
+        self.writer.write(ImageId, EncodedPixels)
+        img_names = sorted(set(ImageId), key = ImageId.index)
+        self.pending.extend(img_names)
+        self.n_shard_images += len(img_names)
+
+        if len(self.pending) >= self.checkpoint_every or self.n_shard_images >= self.shard_size:
+            self.checkpoint()
+
+        if self.n_shard_images >= self.shard_size:
+            self.writer.close()
+            self.writer = None
+            self.shard += 1
+            self.n_shard_images = 0
+
+    def checkpoint(self):
+        """Flushes the current shard, then records its pending images in the manifest"""
+        if self.writer is not None:
+            self.writer.flush()
+        self.manifest.writelines([json.dumps({'image': img_name, 'shard': self.shard}) + '\n' for img_name in self.pending])
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.done.update({img_name: self.shard for img_name in self.pending})
+        self.pending = []
+
+    def close(self):
+        self.checkpoint()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.manifest.close()
+
+    def rows(self):
+        """Returns the ImageId, EncodedPixels of the finished images, merged from the shards in manifest order"""
+        rows = {}
+        for shard in sorted(set(self.done.values())):
+            with open(self.shard_filename(shard)) as fp:
+                for line in fp.readlines()[1:]:
+                    img_name, rle = line.rstrip('\n').split(',')
+                    if self.done.get(img_name) == shard:
+                        rows.setdefault(img_name, []).append(rle)
+
+        ImageId = []
+        EncodedPixels = []
+        for img_name in self.done:
+            ImageId += [img_name] * len(rows[img_name])
+            EncodedPixels += rows[img_name]
+
+        return ImageId, EncodedPixels
+
+    def merge(self, submission_filename):
+        """Writes the rows of the finished images into submission_filename"""
+        ImageId, EncodedPixels = self.rows()
+        f.write2csv(submission_filename, ImageId, EncodedPixels)
@@ -0,0 +1,196 @@
+"""
+Multi-process model sharding for CPU inference.
+
+A ShardPool runs one model in n_shards worker processes, each optionally pinned to its own group
+of cores (see settings.apply_cpu_settings()), so that an ensemble uses every core of a
+many-core machine rather than the threads of a single TensorFlow session.
+
+The parent writes each batch of images into a shared memory slot of a shard and only sends the
+layout of the batch through a queue; the shard runs submit.detect_packed(..., unmold_masks = False)
+on it and sends back the raw detections, which the parent reverses and votes on as usual.
+Each shard has slots_per_shard slots, so the parent fills the next batch of a shard while the
+shard runs the current one.
+"""
+import os
+import copy
+import queue
+import contextlib
+import multiprocessing
+from collections import deque
+import numpy as np
+
+
+def core_groups(n_groups, cores_per_group = None):
+    """
+    Splits the cores of the machine into n_groups lists of cores_per_group cores (by default as
+    many as fit), wrapping around if there are more groups than cores.
+    Returns a list of n_groups lists of core ids, or of None (no pinning) if cores_per_group is 0
+    """
+    if cores_per_group == 0:
+        return [None] * n_groups
+    n_cores = multiprocessing.cpu_count()
+    cores_per_group = cores_per_group if cores_per_group is not None else max(1, n_cores // n_groups)
+    return [[(g * cores_per_group + c) % n_cores for c in range(cores_per_group)] for g in range(n_groups)]
+
+
+@contextlib.contextmanager
+def spawn_environ(environ):
+    """
+    Sets the environment variables environ within the context, e.g. for the processes spawned in it
+    to start TensorFlow with the OpenMP settings of mask_rcnn_config.openmp_environ()
+    """
+    saved = os.environ.copy()
+    os.environ.update(environ)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def shard_config(_config, cores):
+    """
+    Copy of _config for a shard pinned to cores (None: not pinned), with as many intra-op threads and,
+    unless set, OpenMP threads as cores
+    """
+    _config = copy.copy(_config)
+    if cores is not None:
+        _config.cpu_cores = cores
+        _config.intra_op_threads = len(cores)
+        _config.inter_op_threads = 1
+        _config.omp_threads = _config.omp_threads if _config.omp_threads is not None else len(cores)
+    return _config
+
+
+def _shard_main(model_spec, cores, buffers, requests, results):
+    """Worker process of a shard: creates the model, then runs the batches of requests until None"""
+    import submit
+
+    _config, model_name, epoch, frozen = model_spec
+    model = submit.create_model(shard_config(_config, cores), model_name, epoch, frozen)
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, slot, layout, mask_scale = request
+        try:
+            images = [np.frombuffer(buffers[slot], dtype = dtype, count = int(np.prod(shape)), offset = offset).reshape(shape)
+                      for offset, shape, dtype in layout]
+            results.put((request_id, slot, submit.detect_packed(model, images, mask_scale, unmold_masks = False)))
+        except Exception as e:
+            results.put((request_id, slot, e))
+
+
+class ShardResult(object):
+    """Pending result of ShardPool.submit(), with the interface of multiprocessing's AsyncResult"""
+
+    def __init__(self, pool, request_id):
+        self.pool = pool
+        self.request_id = request_id
+
+    def ready(self):
+        self.pool.poll()
+        return self.request_id in self.pool.results
+
+    def get(self):
+        while not self.ready():
+            self.pool.poll(block = True)
+        result = self.pool.results.pop(self.request_id)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class ShardPool(object):
+    """
+    n_shards worker processes running the model of model_spec = (config, model_name, epoch, frozen),
+    as created by submit.create_model(). Shard k is pinned to cores[k] (see core_groups()) if given.
+    buffer_size: bytes of each shared memory slot, i.e. the maximum size of a batch of images.
+    Has a config attribute, so can be used as the model of a submit.DynamicBatcher.
+    """
+
+    def __init__(self, model_spec, n_shards = 1, cores = None, slots_per_shard = 2, buffer_size = 64 * 2**20):
+        self.config = model_spec[0]
+        self.buffer_size = buffer_size
+        cores = cores if cores is not None else [None] * n_shards
+        assert len(cores) == n_shards
+
+        # Spawn, rather than fork, the shards: the parent may already hold a TensorFlow runtime
+        context = multiprocessing.get_context('spawn')
+        self.buffers = [[context.RawArray('B', buffer_size) for _ in range(slots_per_shard)] for _ in range(n_shards)]
+        self.free_slots = [deque(range(slots_per_shard)) for _ in range(n_shards)]
+        self.requests = [context.Queue() for _ in range(n_shards)]
+        self.results_queue = context.Queue()
+        self.processes = [context.Process(target = _shard_main,
+                                          args = (model_spec, cores[k], self.buffers[k], self.requests[k], self.results_queue),
+                                          daemon = True)
+                          for k in range(n_shards)]
+        # The OpenMP settings of a shard (MKL builds of TensorFlow) are set through the environment it is
+        # spawned with, as they must be before TensorFlow is imported
+        for p, shard_cores in zip(self.processes, cores):
+            with spawn_environ(shard_config(self.config, shard_cores).openmp_environ()):
+                p.start()
+
+        # {request_id: shard} of the batches being run, and {request_id: raw results} of the finished ones
+        self.running = {}
+        self.results = {}
+        self.n_requests = 0
+
+    def poll(self, block = False):
+        """Collects the results sent back by the shards (waits for one if block)"""
+        while len(self.running) > 0:
+            try:
+                request_id, slot, result = self.results_queue.get(block = block, timeout = 1 if block else None)
+            except queue.Empty:
+                # Check that the shards are still alive
+                if block and not all([p.is_alive() for p in self.processes]):
+                    raise RuntimeError('A model shard died')
+                return
+            self.free_slots[self.running.pop(request_id)].append(slot)
+            self.results[request_id] = result
+            block = False
+
+    def submit(self, images, mask_scale = None):
+        """
+        Queues the detection of images (a batch of at most config.BATCH_SIZE) on the least loaded shard.
+        Returns a ShardResult, whose get() returns the list of raw result dicts of detect_packed()
+        """
+        # Pick the shard with the most free slots, waiting for one if they are all busy
+        self.poll()
+        while max([len(slots) for slots in self.free_slots]) == 0:
+            self.poll(block = True)
+        shard = int(np.argmax([len(slots) for slots in self.free_slots]))
+        slot = self.free_slots[shard].popleft()
+
+        # Copy the images into the shared memory slot, and send their layout
+        buffer = self.buffers[shard][slot]
+        layout = []
+        offset = 0
+        for image in images:
+            image = np.ascontiguousarray(image)
+            assert offset + image.nbytes <= self.buffer_size, 'Batch larger than the shard buffer_size ({} bytes)'.format(self.buffer_size)
+            np.frombuffer(buffer, dtype = image.dtype, count = image.size, offset = offset)[:] = image.ravel()
+            layout.append((offset, image.shape, image.dtype.str))
+            # Keep the offsets aligned
+            offset += -(-image.nbytes // 64) * 64
+
+        request_id = self.n_requests
+        self.n_requests += 1
+        self.running[request_id] = shard
+        self.requests[shard].put((request_id, slot, layout, mask_scale))
+        return ShardResult(self, request_id)
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        # Discard the results of the batches still running (e.g. after an error): a shard only
+        # exits once the results it sent have been read
+        for p in self.processes:
+            while p.is_alive():
+                try:
+                    self.results_queue.get(timeout = 1)
+                except queue.Empty:
+                    pass
+            p.join()
+        self.running = {}
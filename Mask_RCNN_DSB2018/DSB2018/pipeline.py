@@ -0,0 +1,66 @@
+"""
+Three stage pipelined executor for inference: loading, forward pass and post-processing
+of successive batches overlap, so that throughput approaches that of the slowest stage
+rather than the sum of the stages.
+"""
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def create_worker_pool(n_workers = None):
+    """
+    Process pool for the post-processing stage of run_pipeline(). n_workers = None uses one
+    process per core, 0 runs the post-processing in the calling thread (returns None).
+    NB: create the pool before the model, so that the processes are not forked from a
+    process holding a TensorFlow session.
+    """
+    if n_workers == 0:
+        return None
+    return multiprocessing.Pool(n_workers)
+
+
+def run_pipeline(n_batches, load_fn, model_fn, postprocess_fn, workers = None, n_loaders = 2, max_pending = 4):
+    """
+    Runs postprocess_fn(model_fn(load_fn(i))) for i in range(n_batches), with:
+    - load_fn in a pool of n_loaders threads (reading and decoding images release the GIL)
+    - model_fn in the calling thread, which owns the model
+    - postprocess_fn in workers (see create_worker_pool()), or in the calling thread if None.
+      postprocess_fn and the outputs of model_fn are pickled, so postprocess_fn must be a
+      module level function (or a functools.partial of one)
+    At most max_pending batches are queued for each of the loading and post-processing
+    stages, bounding memory use.
+
+    Yields the outputs of postprocess_fn in batch order.
+    """
+    loaders = ThreadPoolExecutor(n_loaders)
+    loading = deque()
+    pending = deque()
+    n_loading = 0
+
+    try:
+        for i in range(n_batches):
+
+            # Keep up to max_pending batches loading ahead of the model
+            while n_loading < n_batches and len(loading) < max_pending:
+                loading.append(loaders.submit(load_fn, n_loading))
+                n_loading += 1
+
+            output = model_fn(loading.popleft().result())
+
+            if workers is None:
+                yield postprocess_fn(output)
+                continue
+
+            pending.append(workers.apply_async(postprocess_fn, (output, )))
+
+            # Yield finished batches in order, and block the model when
+            # post-processing falls max_pending batches behind
+            while len(pending) > max_pending or (len(pending) > 0 and pending[0].ready()):
+                yield pending.popleft().get()
+
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+    finally:
+        loaders.shutdown(wait = False)
@@ -0,0 +1,97 @@
+"""
+Persistent store of the raw network outputs, so that the post-processing
+(nms_threshold, voting_threshold, n_dilate, n_erode...) can be re-run without the network.
+
+The store is a single HDF5 file laid out as /<model_key>/<image_name>/<augmentation>/, where
+model_key identifies the weights (config NAME and epoch) and augmentation is the name of the
+tta.TTATransform. Each augmentation group holds the raw detections of
+model.detect(..., unmold_masks = False):
+rois [N, 4] int32, class_ids [N] int32, scores [N] float32, mask_crops [N, 28, 28] float32
+and, for semantic models, the full resolution semantic mask (as uint8 if it is binary).
+Masks are gzip compressed and stored without loss, so that the post-processing of the stored
+predictions is exactly that of the live run.
+"""
+import numpy as np
+import h5py
+
+
+def model_key(_config, epoch = None, img_pad = 0, frozen = False):
+    """
+    Key of the raw predictions of the weights of _config.NAME at epoch (None: last), run with
+    frozen (see submit.create_model()): the reduced precision graphs get their own keys
+    """
+    key = '/'.join((_config.NAME, str(epoch) if epoch is not None else 'last'))
+    if frozen not in [False, True, None, 'float32']:
+        key += '_' + frozen
+    return key + '_pad{}'.format(img_pad) if img_pad > 0 else key
+
+
+class RawPredictionStore(object):
+
+    def __init__(self, filename, mode = 'a'):
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def group_name(self, model_key, image_name, aug_name):
+        return '/'.join((model_key, image_name, aug_name))
+
+    def has(self, model_key, image_name, aug_names):
+        """True if the raw predictions of all augmentations aug_names of image_name are stored"""
+        return all([self.group_name(model_key, image_name, aug_name) in self.file for aug_name in aug_names])
+
+    def put(self, model_key, image_name, aug_name, result):
+        """
+        result: raw result dict of model.detect(..., unmold_masks = False) with the
+        aug_shape and image_shape of the image
+        """
+        name = self.group_name(model_key, image_name, aug_name)
+        if name in self.file:
+            del self.file[name]
+        group = self.file.create_group(name)
+
+        group.attrs['aug_shape'] = result['aug_shape'][:2]
+        group.attrs['image_shape'] = result['image_shape'][:2]
+
+        group.create_dataset('rois', data = result['rois'].astype(np.int32))
+        group.create_dataset('class_ids', data = result['class_ids'].astype(np.int32))
+        group.create_dataset('scores', data = result['scores'].astype(np.float32))
+        crops = result['mask_crops'].astype(np.float32)
+        if crops.shape[0] > 0:
+            group.create_dataset('mask_crops', data = crops, compression = 'gzip',
+                                 chunks = (min(64, crops.shape[0]),) + crops.shape[1:])
+        else:
+            group.create_dataset('mask_crops', data = crops)
+
+        if 'semantic_masks' in result:
+            semantic_masks = np.asarray(result['semantic_masks'])
+            group.attrs['semantic_dtype'] = semantic_masks.dtype.str
+            if np.all((semantic_masks == 0) | (semantic_masks == 1)):
+                semantic_masks = semantic_masks.astype(np.uint8)
+            group.create_dataset('semantic_masks', data = semantic_masks, compression = 'gzip')
+
+        self.file.flush()
+
+    def get(self, model_key, image_name, aug_name):
+        """Returns the raw result dict stored by put()"""
+        group = self.file[self.group_name(model_key, image_name, aug_name)]
+
+        result = {'aug_shape': tuple(group.attrs['aug_shape']),
+                  'image_shape': tuple(group.attrs['image_shape']),
+                  'rois': group['rois'][()],
+                  'class_ids': group['class_ids'][()],
+                  'scores': group['scores'][()],
+                  'mask_crops': group['mask_crops'][()].astype(np.float32)}
+
+        if 'semantic_masks' in group:
+            result['semantic_masks'] = group['semantic_masks'][()].astype(group.attrs['semantic_dtype'])
+
+        return result
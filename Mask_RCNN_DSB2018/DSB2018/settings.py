@@ -26,6 +26,44 @@ if os.name == 'nt' and len(local_device_protos) > 2:
 K.set_image_dim_ordering('tf')
 K.set_image_data_format('channels_last')
 
+
+def session_config(_config):
+    """tf.ConfigProto with the thread pools of _config (a mask_rcnn_config)"""
+    return tensorflow.ConfigProto(intra_op_parallelism_threads = _config.intra_op_threads,
+                                  inter_op_parallelism_threads = _config.inter_op_threads,
+                                  allow_soft_placement = True)
+
+
+# CPU settings applied to this process (see apply_cpu_settings())
+_cpu_settings = None
+
+def apply_cpu_settings(_config):
+    """
+    Applies the CPU execution settings of _config to the process: core pinning and the Keras session.
+    Call before building a model. The Keras session is only replaced the first time, as the models
+    already built live in it.
+    TensorFlow is already imported, so the OpenMP settings (see mask_rcnn_config.openmp_environ()) 
+    can only be checked against the environment it started with.
+    """
+    global _cpu_settings
+    cpu_settings = (_config.intra_op_threads, _config.inter_op_threads, _config.cpu_cores)
+    if _cpu_settings is not None:
+        if cpu_settings != _cpu_settings:
+            print('CPU settings {} already applied, ignoring {}'.format(_cpu_settings, cpu_settings))
+        return
+    _cpu_settings = cpu_settings
+
+    if _config.cpu_cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, _config.cpu_cores)
+
+    for name, value in _config.openmp_environ().items():
+        if os.environ.get(name) != value:
+            print('{}={} has no effect once TensorFlow is imported (environment: {}), export it before starting Python'.format(name, value, os.environ.get(name)))
+
+    # Keep the default session (e.g. the GPU session above) unless threads are set
+    if _config.intra_op_threads > 0 or _config.inter_op_threads > 0:
+        set_session(tensorflow.Session(config = session_config(_config)))
+
 # Directory set up
 base_dir = 'D:/Kaggle/Data_Science_Bowl_2018' if os.name == 'nt' else os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 
@@ -5,12 +5,18 @@ from dataset import DSB2018_Dataset
 import numpy as np
 import model as modellib
 import functions as f
-from settings import test_dir, submissions_dir
+from settings import test_dir, submissions_dir, apply_cpu_settings, session_config
 import utils
 import dsb2018_utils as du
+import tta
+import prediction_store as ps
+from detections import Detections
+import pipeline
+import inference_job
+import frozen_model
+import model_shards
 import scipy
 import cv2
-from copy import deepcopy
 from tqdm import tqdm
 
 import visualize
@@ -19,261 +25,445 @@ import matplotlib.pyplot as plt
 import train
 import getpass
 import time
+import functools
+import shutil
+from collections import OrderedDict, deque
                     
 
-def combine_results(_results, N, iou_threshold, voting_threshold, param_dict, use_nms, use_semantic):
+class AugmentationResults(object):
+    """
+    Accumulates the (reversed) detections of each test time augmentation for a batch of images,
+    as one detections.Detections per image with the augmentations as sources.
+    Each augmentation is added exactly once, and counts as one vote when combining results.
+    """
+
+    def __init__(self, n_images):
+        self.n_images = n_images
+        self.n_votes = 0
+        self._detections = [None] * n_images
+
+    def add(self, results):
+        """
+        results: list of n_images result dicts of tta.TTATransform.invert() (rois, scores, class_ids,
+                 crops, mask_extents, image_shape and optionally semantic_masks [H, W]) for one augmentation
+        """
+        assert len(results) == self.n_images, 'Expected one set of results per image'
+        for i, r in enumerate(results):
+            if self._detections[i] is None:
+                self._detections[i] = Detections(r['image_shape'])
+            self._detections[i].append_crops(r['rois'], r['class_ids'], r['scores'], r['crops'], r['mask_extents'], r.get('semantic_masks'))
+        self.n_votes += 1
+
+    def image_results(self, i):
+        """Returns the Detections of the n_votes augmentations of image i"""
+        return self._detections[i]
 
+    def n_instances(self):
+        """Total number of detections over all images and augmentations"""
+        return sum([len(d) for d in self._detections if d is not None])
+
+
+def combine_results(results_augment, iou_threshold, voting_threshold, param_dict, use_nms, use_semantic, dense = True):
+    """
+    Reduces the AugmentationResults of each image to a single set of results 
+    via non-maximum suppression or merging + voting
+    dense: see detections_result()
+    """
     results = []
-    for i in range(N):
+    for i in range(results_augment.n_images):
 
-        img_results = du.concatenate_list_of_dicts([rf[i] for rf in _results])
         if use_nms:
-            img_results = reduce_via_nms(img_results, threshold)
+            img_results = reduce_via_nms(results_augment.image_results(i), iou_threshold, use_semantic, dense)
         else:
-            img_results = reduce_via_voting(img_results, iou_threshold, voting_threshold, param_dict, use_semantic, n_votes = len(_results))
-
-        # Reshape masks
-        img_results['masks'] = np.moveaxis(img_results['masks'], 0, -1)
-        img_results['class_ids'] = img_results['class_ids'].reshape(-1, )
-        img_results['scores'] = img_results['scores'].reshape(-1, )
+            img_results = reduce_via_voting(results_augment.image_results(i), iou_threshold, voting_threshold, param_dict, use_semantic, n_votes = results_augment.n_votes, dense = dense)
 
         results.append(img_results)
 
     return results
 
 
-def apply_flips_rotations(_config, images, param_dict):
+def rescale_masks(masks, scale):
+    """
+    Convert masks -> labels before applying scipy.ndimage.zoom() once,
+    then convert the resulting labels -> masks.
+    Large speed up for masks where number of masks is great.
+    """
+    labels = du.maskrcnn_mask_to_labels(masks)
+    rescaled_labels = scipy.ndimage.zoom(masks, scale, order = 0)
+    return du.maskrcnn_labels_to_mask(rescaled_labels).astype(np.uint8)
+
+
+def detect_raw(model, images, transforms, use_semantic = False, store = None, store_keys = None, stats = None):
+    """
+    Runs the transforms (tta.TTATransform) of images through model.detect(..., unmold_masks = False).
+    Returns raw[transform][image] raw result dicts, with the aug_shape and image_shape of each image.
+    store: optional prediction_store.RawPredictionStore, with store_keys the (model_key, image_name) 
+           of each image. The raw results are read from the store if it holds all of them, and written 
+           to it otherwise. model may be None if they are all stored.
+    stats: optional ForwardStats counting the forward passes
+    """
+    if store is not None and all([store.has(key, name, [t.name for t in transforms]) for key, name in store_keys]):
+        return [[store.get(key, name, t.name) for key, name in store_keys] for t in transforms]
+    assert model is not None, 'Raw predictions missing from {}'.format(store.filename if store is not None else None)
+
+    # Flatten every (augmentation, image) pair into one list so that they are packed into 
+    # as few full batches as possible
+    flat_images = [t.apply(img) for t in transforms for img in images]
+    flat_mask_scale = [t.mask_scale for t in transforms for img in images]
+
+    # Detect, keeping the masks as the small masks of the network so that augmentations are
+    # reversed on the boxes and mask crops
+    flat_results = detect_packed(model, flat_images, flat_mask_scale, unmold_masks = False, stats = stats)
+
+    raw = []
+    k = 0
+    for t in transforms:
+        res = []
+        for i, img in enumerate(images):
+            flat_results[k]['aug_shape'] = flat_images[k].shape[:2]
+            flat_results[k]['image_shape'] = img.shape[:2]
+            if store is not None:
+                store.put(store_keys[i][0], store_keys[i][1], t.name, flat_results[k])
+            res.append(flat_results[k])
+            k += 1
+        raw.append(res)
+
+    return raw
+
 
-    images_flip = [images, 
-                [np.fliplr(img) for img in images], 
-                [np.flipud(img) for img in images],
-                [np.flipud(np.fliplr(img)) for img in images],
-                [np.rot90(img, 1, (0, 1)) for img in images],
-                [np.rot90(img, 3, (0, 1)) for img in images]]
+def unmold_raw(r, param_dict = {}, use_semantic = False, dense = True):
+    """
+    Converts a raw result (without augmentation) to the result of model.detect()
+    dense: see detections_result()
+    """
+    detections = Detections(r['image_shape'], capacity = max(1, r['rois'].shape[0]))
+    if use_semantic:
+        # The semantic post-processing works on the full size masks
+        masks, _ = utils.unmold_masks(r['mask_crops'], r['rois'], r['image_shape'])
+        masks = combine_semantic(r['rois'], r['scores'], masks, r['semantic_masks'], param_dict)
+        detections.append(r['rois'], r['class_ids'], r['scores'], masks, r['semantic_masks'])
+    else:
+        crops, extents = utils.unmold_mask_crops(r['mask_crops'], r['rois'])
+        detections.append_crops(r['rois'], r['class_ids'], r['scores'], crops, extents)
 
-    output = {'images': images_flip,
-              'mask_scale': [None] * len(images_flip),
-              'fn_reverse': 'reverse_flips_rotations'}
+    return detections_result(detections, dense)
 
-    return output
 
+def reverse_augmentations(raw, transforms, use_semantic = False):
+    """
+    Reverses the augmentations of raw[transform][image] (see detect_raw()), collecting each augmentation once.
+    Semantic masks are expanded to one per mask instance once reversed.
+    Returns an AugmentationResults
+    """
+    results_augment = AugmentationResults(len(raw[0]))
+    for t, res in zip(transforms, raw):
+        results_augment.add([t.invert(r, r['aug_shape'], r['image_shape'], use_semantic) for r in res])
+    return results_augment
 
-def reverse_flips_rotations(results_flip, images, use_semantic):
 
-    for i in range(len(images)):
+def maskrcnn_detect_augmentations(_config, model, images, tta_groups, threshold, voting_threshold = 0.5, param_dict = {}, use_nms = False, use_semantic = False, store = None, store_keys = None):
+    """
+    Augments images with the test time augmentations of the groups tta_groups (see tta.TTA_GROUPS) 
+    and combines results via non-maximum suppression if use_nms is True, otherwises uses merging + voting
+    store, store_keys: see detect_raw()
+    """
 
-        results_flip[1][i]['masks'] = np.fliplr(results_flip[1][i]['masks'])
-        results_flip[2][i]['masks'] = np.flipud(results_flip[2][i]['masks'])
-        results_flip[3][i]['masks'] = np.fliplr(np.flipud(results_flip[3][i]['masks']))
-        results_flip[4][i]['masks'] = np.rot90(results_flip[4][i]['masks'], -1, (0, 1))
-        results_flip[5][i]['masks'] = np.rot90(results_flip[5][i]['masks'], -3, (0, 1))
+    # NB: augmentations must include the original (unaugmented) image, if requested
+    transforms = tta.get_transforms(tta_groups, _config, param_dict)
 
-        if use_semantic:
+    raw = detect_raw(model, images, transforms, use_semantic = use_semantic, store = store, store_keys = store_keys)
 
-            results_flip[1][i]['semantic_masks'] = np.fliplr(results_flip[1][i]['semantic_masks'])
-            results_flip[2][i]['semantic_masks'] = np.flipud(results_flip[2][i]['semantic_masks'])
-            results_flip[3][i]['semantic_masks'] = np.fliplr(np.flipud(results_flip[3][i]['semantic_masks']))
-            results_flip[4][i]['semantic_masks'] = np.rot90(results_flip[4][i]['semantic_masks'], -1, (0, 1))
-            results_flip[5][i]['semantic_masks'] = np.rot90(results_flip[5][i]['semantic_masks'], -3, (0, 1))
-
-        # Recalculate bboxes
-        for j in range(len(results_flip)):
-            results_flip[j][i]['rois'] = utils.extract_bboxes(results_flip[j][i]['masks'])
-            # Reshape masks so that they can be concatenated correctly
-            results_flip[j][i]['masks'] = np.moveaxis(results_flip[j][i]['masks'], -1, 0)
-            if use_semantic:
-                results_flip[j][i]['semantic_masks'] = np.moveaxis(results_flip[j][i]['semantic_masks'], -1, 0)
+    results_augment = reverse_augmentations(raw, transforms, use_semantic)
 
-    return results_flip
+    # Carry out either non-maximum suppression or merge+voting to reduce results_augment for each image to a single set of results
+    results = combine_results(results_augment, threshold, voting_threshold, param_dict, use_nms, use_semantic)
+    
+    return results
 
 
-def apply_scaling(_config, images, param_dict):
+def detect_packed(model, images, mask_scale = None, unmold_masks = True, stats = None):
     """
-    Extract the images that would normally be fed into maskrcnn and rescale from here
-    NB: because of how maskrcnn resizes, images are scaled up to reach 
-    (_config.IMAGE_MIN_DIM, _config.IMAGE_MAX_DIM) as standard.
-    As a result, if we have scales > 1 the images will end up being scaled back down to the 
-    maximum anyway. So we can only generate different scaled inputs by scaling downwards.
-    Hence default scales set to 0.8, 0.9, 1.
+    Runs model.detect over any number of images by packing them into full batches of
+    model.config.BATCH_SIZE. Only the last batch is padded, by repeating its last image.
+    mask_scale: None, or a list of len(images) scales (None entries use the normal resize)
+    stats: optional ForwardStats counting the forward passes
+    Returns a list of len(images) result dicts, in the order of images.
     """
+    batch_size = model.config.BATCH_SIZE
+    mask_scale = mask_scale if mask_scale is not None else [None] * len(images)
 
-    assert 'scales' in param_dict.keys()
-    scales = param_dict['scales']
+    results = []
+    for i in range(0, len(images), batch_size):
+        batch_images = list(images[i : i + batch_size])
+        batch_mask_scale = list(mask_scale[i : i + batch_size])
+        n = len(batch_images)
 
-    # Note: output of utils is: image, window, scale, padding
-    model_inputs = [utils.resize_image(img, min_dim = _config.IMAGE_MIN_DIM, max_dim = _config.IMAGE_MAX_DIM, padding = _config.IMAGE_PADDING) for img in images]
+        # Pad the last batch
+        batch_images += [batch_images[-1]] * (batch_size - n)
+        batch_mask_scale += [batch_mask_scale[-1]] * (batch_size - n)
 
-    # Take the image window out of the model image inputs (the rest is padding)
-    model_images_ex_padding = [x[0][x[1][0] : x[1][2], x[1][1] : x[1][3]] for x in model_inputs]
-   
-    # Create output
-    output = {'images': [model_images_ex_padding for scale in scales],
-              'mask_scale': [[scale] * len(images) for scale in scales],
-              'fn_reverse': 'reverse_scaling'}
-    
-    return output
+        results.extend(model.detect(batch_images, verbose = 0, mask_scale = batch_mask_scale, unmold_masks = unmold_masks)[:n])
 
+        if stats is not None:
+            stats.add(batch_size, n)
 
-def reverse_scaling(results_scale, images, use_semantic):
-    # Reverse the scales
-    for i in range(len(images)):
-        for j in range(len(results_scale)):
+    return results
 
-            results_scale[j][i]['masks'] = scipy.ndimage.zoom(results_scale[j][i]['masks'], 
-                                                                  (images[i].shape[0] / results_scale[j][i]['masks'].shape[0], 
-                                                                   images[i].shape[1] / results_scale[j][i]['masks'].shape[1], 
-                                                                   1), order = 0)
-            results_scale[j][i]['rois'] = utils.extract_bboxes(results_scale[j][i]['masks'])
-            # Reshape masks so that they can be concatenated correctly
-            results_scale[j][i]['masks'] = np.moveaxis(results_scale[j][i]['masks'], -1, 0)
 
-            if use_semantic:
-                results_scale[j][i]['semantic_masks'] = scipy.ndimage.zoom(results_scale[j][i]['semantic_masks'], 
-                                                                  (images[i].shape[0] / results_scale[j][i]['semantic_masks'].shape[0], 
-                                                                   images[i].shape[1] / results_scale[j][i]['semantic_masks'].shape[1], 
-                                                                   1), order = 0)
-                # Reshape masks so that they can be concatenated correctly
-                results_scale[j][i]['semantic_masks'] = np.moveaxis(results_scale[j][i]['semantic_masks'], -1, 0)
+class ForwardStats(object):
+    """
+    Throughput counters of an inference run: the image slots of the batches run through the
+    network, and how many of them were wasted on padding
+    """
 
-    return results_scale
+    def __init__(self):
+        self.n_batches = 0
+        self.n_forwards = 0
+        self.n_wasted = 0
+        self.start = time.time()
 
+    def add(self, batch_size, n):
+        """Counts a batch of batch_size image slots, n of which are real images"""
+        self.n_batches += 1
+        self.n_forwards += batch_size
+        self.n_wasted += batch_size - n
 
-def rescale_masks(masks, scale):
+    def __str__(self):
+        elapsed = time.time() - self.start
+        return 'Forward passes: {} batches, {} images, {} ({:.1%}) wasted on padding, {:.2f} images/s'.format(
+            self.n_batches, self.n_forwards, self.n_wasted, self.n_wasted / max(1, self.n_forwards), 
+            (self.n_forwards - self.n_wasted) / max(elapsed, 1e-6))
+
+
+class DynamicBatcher(object):
     """
-    Convert masks -> labels before applying scipy.ndimage.zoom() once,
-    then convert the resulting labels -> masks.
-    Large speed up for masks where number of masks is great.
+    Queues the augmentations (transforms) of the images mapped to one model, and runs them 
+    through the model in full batches of model.config.BATCH_SIZE, whichever images they come from.
+    Only run(flush = True) pads a partial batch.
+    model: a model, or a model_shards.ShardPool running the model in other processes, in which case the
+           batches are submitted asynchronously and their results collected by later calls to run()
+    store, model_key: optional prediction_store.RawPredictionStore and key of the model, as in detect_raw()
+    stats: optional ForwardStats counting the forward passes
     """
-    labels = du.maskrcnn_mask_to_labels(masks)
-    rescaled_labels = scipy.ndimage.zoom(masks, scale, order = 0)
-    return du.maskrcnn_labels_to_mask(rescaled_labels).astype(np.uint8)
 
+    def __init__(self, model, transforms, use_semantic = False, store = None, model_key = None, stats = None):
+        self.model = model
+        self.transforms = transforms
+        self.use_semantic = use_semantic
+        self.store = store
+        self.model_key = model_key
+        self.stats = stats
+        # (img_name, transform index, image_shape, augmented image, mask_scale) waiting for a batch
+        self.queue = deque()
+        # {img_name: raw[transform]} of the images with augmentations still queued
+        self.raw = {}
+        self.completed = []
+        # (items, model_shards.ShardResult) of the batches submitted to a ShardPool, oldest first
+        self.in_flight = deque()
+
+    def __contains__(self, img_name):
+        return img_name in self.raw
+
+    def add(self, img_name, image):
+        aug_names = [t.name for t in self.transforms]
+        if self.store is not None and self.store.has(self.model_key, img_name, aug_names):
+            self.completed.append((img_name, [self.store.get(self.model_key, img_name, aug_name) for aug_name in aug_names]))
+            return
+        assert self.model is not None, 'Raw predictions missing from {}'.format(self.store.filename if self.store is not None else None)
+
+        self.raw[img_name] = [None] * len(self.transforms)
+        for k, t in enumerate(self.transforms):
+            self.queue.append((img_name, k, image.shape[:2], t.apply(image), t.mask_scale))
+
+    def run(self, flush = False):
+        """
+        Runs the full batches of the queue (and the remainder if flush).
+        Returns [(img_name, raw[transform])] for the images completed since the last call
+        """
+        batch_size = self.model.config.BATCH_SIZE if self.model is not None else 1
+
+        while len(self.queue) >= batch_size or (flush and len(self.queue) > 0):
+            items = [self.queue.popleft() for _ in range(min(batch_size, len(self.queue)))]
+            if isinstance(self.model, model_shards.ShardPool):
+                self.in_flight.append((items, self.model.submit([item[3] for item in items], [item[4] for item in items])))
+                if self.stats is not None:
+                    self.stats.add(batch_size, len(items))
+            else:
+                self.add_results(items, detect_packed(self.model, [item[3] for item in items], [item[4] for item in items], 
+                                                      unmold_masks = False, stats = self.stats))
+
+        # Collect the batches finished by the shards, in order (all of them if flush)
+        while len(self.in_flight) > 0 and (flush or self.in_flight[0][1].ready()):
+            items, result = self.in_flight.popleft()
+            self.add_results(items, result.get())
 
-def maskrcnn_detect_augmentations(_config, model, images, list_fn_apply, threshold, voting_threshold = 0.5, param_dict = {}, use_nms = False, use_semantic = False):
+        completed = self.completed
+        self.completed = []
+        return completed
+
+    def add_results(self, items, results):
+        for (img_name, k, image_shape, aug_image, _), r in zip(items, results):
+            r['aug_shape'] = aug_image.shape[:2]
+            r['image_shape'] = image_shape
+            if self.store is not None:
+                self.store.put(self.model_key, img_name, self.transforms[k].name, r)
+
+            self.raw[img_name][k] = r
+            if all([_r is not None for _r in self.raw[img_name]]):
+                self.completed.append((img_name, self.raw.pop(img_name)))
+
+
+def reduce_raw(raw, transforms, nms_threshold, voting_threshold, param_dict = {}, use_semantic = False, dense = True):
     """
-    Augments images subject to list_fn_apply and combines results via 
-    non-maximum suppression if use_nms is True, otherwises uses merging + voting
+    Reduces the raw results raw[transform] of one image (see detect_raw()) to a single result,
+    merging + voting over the augmentations transforms (empty if not augmented)
+    dense: see detections_result()
     """
+    if len(transforms) > 0:
+        results_augment = reverse_augmentations([[r] for r in raw], transforms, use_semantic)
+        return combine_results(results_augment, nms_threshold, voting_threshold, param_dict, False, use_semantic, dense)[0]
+    return unmold_raw(raw[0], param_dict, use_semantic, dense)
 
-    # Apply the augmentations requested
-    # NB: augmentations must include the original (unaugmented) image, if requested
-    # fn_apply returns: lists of images and corresponding mask_scale, fn_reverse
-    images_info = [globals()[fn_apply](_config, images, param_dict) for fn_apply in list_fn_apply]
 
-    results_augment = []
-    for img_info in images_info:
-        
-        # Each img_info set corresponds to a set of augmentations.
-        # It has the following information:
-        # 'images': the set of augmented images that we require predictions for (e.g. a set of 6 flips/rotations)
-        # 'mask_scale': the mask_scale that we want to apply when resizing images with resize_image_scaled() (if you want to use normal resizing set mask_scale = None)
-        # 'fn_reverse': the function to call to reverse the augmentations from the predicted masks
+def maskrcnn_detect(_config, model, images, param_dict = {}, use_semantic = False, store = None, store_keys = None):
+    """
+    store, store_keys: see detect_raw()
+    """
 
-        # Detect
-        if use_semantic:
-            # In this instance we need to detect with expand_semantic = True, 
-            # as because we are combining results over multiple augmentations 
-            # it is easier to have one semantic instance for each mask instance
-            res = [model.detect(img, verbose=0, mask_scale = mask_scale, expand_semantic = True) for img, mask_scale in zip(img_info['images'], img_info['mask_scale'])]
+    raw = detect_raw(model, images, [tta.TTATransform()], use_semantic = use_semantic, store = store, store_keys = store_keys)
+
+    return [unmold_raw(r, param_dict, use_semantic) for r in raw[0]]
+
+
+def vote_models(model_results, nms_threshold, voting_threshold, param_dict, use_semantic):
+    """
+    Combines the results of one image from each model of an ensemble via merging + voting,
+    each model having one vote. The model results are best reduced with dense = False 
+    (see detections_result()), so that their masks are gathered as crops
+    """
+    # Gather the detections of the models, keeping the semantic mask of each model once
+    image_shape = model_results[0]['detections'].image_shape if 'detections' in model_results[0] else model_results[0]['masks'].shape[:2]
+    detections = Detections(image_shape, capacity = max(1, sum([r['rois'].shape[0] for r in model_results])))
+    for r in model_results:
+        if 'detections' in r:
+            detections.extend(r['detections'])
         else:
-            res = [model.detect(img, verbose=0, mask_scale = mask_scale) for img, mask_scale in zip(img_info['images'], img_info['mask_scale'])]
+            detections.append(r['rois'], r['class_ids'], r['scores'], r['masks'], r.get('semantic_masks'))
 
-        # Reverse augmentations
-        res = globals()[img_info['fn_reverse']](res, images, use_semantic)
+    # Reduce via voting
+    return reduce_via_voting(detections, nms_threshold, voting_threshold, param_dict, use_semantic = use_semantic, n_votes = len(model_results))
 
-        # Append
-        for r in res:
-            results_augment.extend(res)
-    
-    # Concatenate lists of results
-    results_augment = du.concatenate_list_of_dicts(results_augment) 
 
-    if not isinstance(results_augment, list):
-        results_augment = [[results_augment]]
+def union_semantic(detections):
+    """Union [H, W] of the semantic masks of the sources of detections"""
+    return (np.sum(np.stack(detections.semantic_masks, axis = 0), axis = 0) > 0).astype(np.int)
 
-    # Carry out either non-maximum suppression or merge+voting to reduce results_augment for each image to a single set of results
-    results = combine_results(results_augment, len(images), threshold, voting_threshold, param_dict, use_nms, use_semantic)
-    
-    return results
+
+def detections_result(detections, dense = True):
+    """
+    Result dict of detections (a detections.Detections with a single source): rois, class_ids, scores and
+    - if dense, masks [H, W, N] and, if the source has one, semantic_masks [H, W]
+    - otherwise, the detections themselves, which vote_models() gathers without unmolding their masks
+    """
+    img_results = {'rois': detections.rois,
+                   'class_ids': detections.class_ids,
+                   'scores': detections.scores}
+    if not dense:
+        img_results['detections'] = detections
+        return img_results
+
+    img_results['masks'] = detections.masks()
+    if detections.semantic_masks[0] is not None:
+        img_results['semantic_masks'] = detections.semantic_masks[0]
+    return img_results
 
 
-def maskrcnn_detect(_config, model, images, param_dict = {}, use_semantic = False):
+def reduce_via_nms(detections, threshold, use_semantic = False, dense = True):
+    """
+    Reduces detections (a detections.Detections) via non-maximum suppression.
+    Returns a result dict (rois, class_ids, scores, masks [H, W, N] and, if use_semantic, semantic_masks [H, W])
+    dense: see detections_result()
+    """
+    selected = detections[utils.non_max_suppression(detections.rois, detections.scores, threshold)] if len(detections) > 0 else detections
 
-    results = model.detect(images, verbose=0)
+    # Reduce to single semantic mask
+    reduced = Detections(detections.image_shape, capacity = max(1, len(selected)))
+    reduced.append_crops(selected.rois, selected.class_ids, selected.scores, selected.crops, selected.mask_extents,
+                         union_semantic(detections) if use_semantic else None)
 
-    if use_semantic:
-        for r in results:
-            r['masks'] = combine_semantic(r['rois'], r['scores'], r['masks'], r['semantic_masks'], param_dict)
+    return detections_result(reduced, dense)
 
-    return results
 
+def vote_semantic(semantic_masks, semantic_counts, n_votes, voting_threshold):
+    """
+    Pixel-level vote on the semantic masks of merged instances.
+    semantic_masks: list of the S [H, W] semantic masks of the sources (models or augmentations) the instances came from
+    semantic_counts: [K, S] number of instances of each merged instance from each source 
+                     (see du.combine_boxes()), so that the semantic mask of a merged instance is 
+                     the sum of the semantic masks of its instances
+    Returns the [H, W] union of the semantic masks of the merged instances averaged over n_votes > voting_threshold
+    """
+    semantic_mask = np.zeros(semantic_masks[0].shape, dtype = np.bool_)
+
+    # Merged instances with the same counts have the same semantic mask, so it is only summed once
+    for counts in (np.unique(semantic_counts, axis = 0) if len(semantic_counts) > 0 else []):
+        ixs = np.nonzero(counts)[0]
+        semantic_mask |= (np.tensordot(counts[ixs], np.stack([semantic_masks[k] for k in ixs], axis = 0), axes = 1) / n_votes) > voting_threshold
 
-def reduce_via_nms(img_results, threshold):
-    nms_idx = utils.non_max_suppression(img_results['rois'], img_results['scores'].reshape(-1, ), threshold)
-    return du.reduce_dict(img_results, nms_idx)
+    return semantic_mask.astype(np.int)
 
 
-def reduce_via_voting(img_results, threshold, voting_threshold, param_dict, use_semantic, n_votes):
+def reduce_via_voting(detections, threshold, voting_threshold, param_dict, use_semantic, n_votes, dense = True):
     """
     Merges masks from different sets of results if their bboxes overlap by > threshold.
     Then takes a pixel-level vote on which pixels should be included in each mask (> voting threshold).
+    detections: detections.Detections of one image from n_votes sources
+    param_dict['cluster_method']: how boxes are clustered, 'greedy' (default) or 'union_find' (see du.cluster_boxes())
+    Returns a result dict (rois, class_ids, scores, masks [H, W, N] and, if use_semantic, semantic_masks [H, W])
+    dense: see detections_result()
     """
-    results = deepcopy(img_results)
-   
+    cluster_method = param_dict['cluster_method'] if 'cluster_method' in param_dict else 'greedy'
+
     # Reduce only if masks exist
-    if results['rois'].shape[0] > 0:
+    if len(detections) > 0:
 
-        # Combine masks with overlaps greater than threshold
+        # Combine masks with overlaps greater than threshold, summing them within the extent of each combined mask
         if use_semantic:
-            idx, boxes, scores, masks, n_joins, semantic_masks = du.combine_boxes(results['rois'], results['scores'].reshape(-1, ), np.moveaxis(results['masks'], 0, -1), threshold, np.moveaxis(results['semantic_masks'], 0, -1))
+            idx, boxes, scores, vote_extents, votes, n_joins, semantic_counts = du.combine_box_crops(detections.rois, detections.scores, detections.mask_extents, detections.crops, threshold, detections.source, cluster_method)
         else:
-            idx, boxes, scores, masks, n_joins = du.combine_boxes(results['rois'], results['scores'].reshape(-1, ), np.moveaxis(results['masks'], 0, -1), threshold)
+            idx, boxes, scores, vote_extents, votes, n_joins = du.combine_box_crops(detections.rois, detections.scores, detections.mask_extents, detections.crops, threshold, method = cluster_method)
 
         # Select masks based on voting threshold
-        avg_masks = masks / n_votes
-        masks = (np.multiply(masks, avg_masks > voting_threshold) > 0).astype(np.int)
-        valid_masks = np.sum(masks, axis = (0, 1)) > 0
+        votes = [(np.multiply(v, v / n_votes > voting_threshold) > 0) for v in votes]
+        valid_masks = np.array([np.any(v) for v in votes], dtype = np.bool_)
 
-        # Reduce to masks that are still valid
+        # Reduce to masks that are still valid, keeping the votes as the crops of the merged masks.
+        # Each merged instance keeps the class of its first instance
         idx = idx[valid_masks]
         boxes = boxes[valid_masks]
-        masks = masks[:, :, valid_masks]
         scores = scores[valid_masks]
+        class_ids = detections.class_ids[idx.astype(np.int64)]
+        reduced = Detections(detections.image_shape, capacity = max(1, len(idx)))
+        reduced.append_crops(boxes, class_ids, scores, [votes[j] for j in np.nonzero(valid_masks)[0]], vote_extents[valid_masks])
 
         if use_semantic:
-            # Reduce semantic masks according to valid_masks and voting_threshold
-            avg_semantic_masks = semantic_masks / n_votes
-            semantic_masks = (avg_semantic_masks[:, :, valid_masks] > voting_threshold).astype(np.int)
-            # Reduce to single semantic mask
-            semantic_masks = (np.sum(semantic_masks, axis = -1) > 0).astype(np.int)
+            # Reduce to single semantic mask according to valid_masks and voting_threshold
+            semantic_masks = vote_semantic(detections.semantic_masks, semantic_counts[valid_masks], n_votes, voting_threshold)
 
-            masks = combine_semantic(boxes, scores, masks, semantic_masks, param_dict)
+            # The semantic post-processing works on the full size masks
+            masks = combine_semantic(boxes, scores, reduced.masks(), semantic_masks, param_dict)
+            reduced = Detections(detections.image_shape, capacity = max(1, len(idx)))
+            reduced.append(boxes, class_ids, scores, masks, semantic_masks)
 
-        #from visualize import plot_multiple_images; plot_multiple_images([np.sum(img_results['masks'], axis = 0), np.sum(masks, axis = 0)], nrows = 1, ncols = 2)
-    
-        # Assign results to img_results:
-
-        # Reduce dict to the relevant index to capture the relevant fields for anything
-        # you haven't changed
-        img_results = du.reduce_dict(img_results, idx if len(idx) > 0 else 0)
-
-        # Assign newly calculated fields
-        img_results['rois'] = boxes
-        img_results['masks'] = np.moveaxis(masks, -1, 0)
-        img_results['scores'] = scores
-        if use_semantic:
-            img_results['semantic_masks'] = semantic_masks
+        #from visualize import plot_multiple_images; plot_multiple_images([np.sum(detections.masks(), axis = -1), np.sum(reduced.masks(), axis = -1)], nrows = 1, ncols = 2)
 
     else:
-        # No masks predicted
+        # No masks predicted. Reduce to single semantic mask
+        reduced = Detections(detections.image_shape)
+        reduced.append_crops(detections.rois, detections.class_ids, detections.scores, [], detections.mask_extents,
+                             union_semantic(detections) if use_semantic else None)
 
-        # Reduce to single semantic mask
-        if use_semantic:
-            results['semantic_masks'] = (np.sum(results['semantic_masks'], axis = 0) > 0).astype(np.int)
-
-        img_results = results
-
-    return img_results
+    return detections_result(reduced, dense)
 
 
 def combine_semantic(boxes, scores, masks, semantic_masks, param_dict):
@@ -281,6 +471,8 @@ def combine_semantic(boxes, scores, masks, semantic_masks, param_dict):
     Each mask lies between an eroded version of itself and 
     a dilated version of itself, the pixels in between 
     being dictated by the overlap with semantic.
+    Each mask is only processed within its extent padded by n_dilate, outside of which
+    it stays empty.
     """
 
     n_dilate = param_dict['n_dilate'] if 'n_dilate' in param_dict else 1
@@ -290,22 +482,30 @@ def combine_semantic(boxes, scores, masks, semantic_masks, param_dict):
 
         # Make a mask of box labels
         box_labels = du.maskrcnn_boxes_to_labels(boxes, scores, semantic_masks.shape)
+
+        extents = du.mask_extents(masks, pad = n_dilate)
         
         for i in range(masks.shape[-1]):
 
+            y1, x1, y2, x2 = extents[i]
+            if y2 <= y1:
+                continue
+            mask = masks[y1 : y2, x1 : x2, i]
+            semantic_mask = semantic_masks[y1 : y2, x1 : x2]
+
             # Step 1: find the overlap with semantic. 
-            original_overlap = np.multiply(masks[:, :, i], semantic_masks)
+            original_overlap = np.multiply(mask, semantic_mask)
 
             # Step 2: erode the mask.
-            eroded_mask = scipy.ndimage.morphology.binary_erosion(masks[:, :, i], iterations = n_erode) if n_erode > 0 else masks[:, :, i]
+            eroded_mask = scipy.ndimage.morphology.binary_erosion(mask, iterations = n_erode) if n_erode > 0 else mask
             eroded_plus_overlap = ((eroded_mask + original_overlap) > 0).astype(np.int)
 
             # Step 3: dilate the mask within box boundaries and find overlap with semantic
-            dilated_mask = scipy.ndimage.morphology.binary_dilation(masks[:, :, i], iterations = n_dilate) if n_dilate > 0 else masks[:, :, i]
-            dilated_overlap = np.multiply(dilated_mask, np.multiply(box_labels == (i + 1), semantic_masks))
+            dilated_mask = scipy.ndimage.morphology.binary_dilation(mask, iterations = n_dilate) if n_dilate > 0 else mask
+            dilated_overlap = np.multiply(dilated_mask, np.multiply(box_labels[y1 : y2, x1 : x2] == (i + 1), semantic_mask))
 
             # Step 4: combine: new mask = eroded mask + original overlap + dilated overlap
-            masks[:, :, i] = ((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int)
+            masks[y1 : y2, x1 : x2, i] = ((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int)
 
         # from visualize import plot_multiple_images; plot_multiple_images([original_overlap, eroded_mask, eroded_plus_overlap, ((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int), masks[:, :, i]])
         # from visualize import plot_multiple_images; plot_multiple_images([original_overlap, eroded_mask, dilated_mask, ((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int), masks[:, :, i], np.abs(((eroded_plus_overlap + dilated_overlap) > 0).astype(np.int) - masks[:,:,i])], nrows = 2, ncols = 3)
@@ -313,12 +513,27 @@ def combine_semantic(boxes, scores, masks, semantic_masks, param_dict):
     return masks
 
 
-def create_model(_config, model_name, epoch = None):
-    # Recreate the model in inference mode
-    model = getattr(modellib, model_name)(mode="inference", 
-                                config=_config,
-                                model_dir=_config.MODEL_DIR)
+def dilate_masks(masks, boxes, scores, n_dilate = 1):
+    """
+    Dilates masks [H, W, N] by n_dilate within their box (see du.maskrcnn_boxes_to_labels()).
+    Each mask is only processed within its extent padded by n_dilate.
+    Returns the dilated [H, W, N] bool masks
+    """
+    box_labels = du.maskrcnn_boxes_to_labels(boxes, scores, masks.shape[:2])
+    # NB: binary_dilation with iterations < 1 dilates until nothing changes, i.e. over the whole image
+    extents = du.mask_extents(masks, pad = n_dilate if n_dilate > 0 else max(masks.shape[:2]))
+
+    dilated_masks = np.zeros(masks.shape, dtype = np.bool_)
+    for i in range(masks.shape[-1]):
+        y1, x1, y2, x2 = extents[i]
+        if y2 > y1:
+            dilated_mask = scipy.ndimage.morphology.binary_dilation(masks[y1 : y2, x1 : x2, i], iterations = n_dilate)
+            dilated_masks[y1 : y2, x1 : x2, i] = np.multiply(box_labels[y1 : y2, x1 : x2] == (i + 1), dilated_mask)
+
+    return dilated_masks
+
 
+def model_weights_path(model, epoch = None):
     # Get path to saved weights
     # Either set a specific path or find last trained weights
     # model_path = os.path.join(ROOT_DIR, ".h5 file name here")
@@ -327,126 +542,324 @@ def create_model(_config, model_name, epoch = None):
     else:
         model_path = model.find_last()[1]
 
-    # Load trained weights (fill in path to trained weights here)
     assert model_path != "", "Provide path to trained weights"
-    print("Loading weights from ", model_path)
-    model.load_weights(model_path, by_name=True)
+    return model_path
+
+
+def create_model(_config, model_name, epoch = None, frozen = False):
+    """
+    frozen: if True, loads the frozen inference graph written by export_model() instead of 
+            building the Keras model and loading its .h5 weights (see frozen_model.py).
+            A precision of frozen_model.PRECISIONS (e.g. 'float16') loads that version of the graph
+    """
+    start = time.time()
+    apply_cpu_settings(_config)
+
+    if frozen:
+        model = frozen_model.model_shell(_config, model_name)
+        model_path = frozen_model.precision_graph_path(frozen_model.frozen_graph_path(model_weights_path(model, epoch)), frozen)
+        print("Loading frozen graph from ", model_path)
+        model.keras_model = frozen_model.FrozenGraph(model_path, session_config(_config))
+    else:
+        # Recreate the model in inference mode
+        model = getattr(modellib, model_name)(mode="inference", 
+                                    config=_config,
+                                    model_dir=_config.MODEL_DIR)
+
+        # Load trained weights
+        model_path = model_weights_path(model, epoch)
+        print("Loading weights from ", model_path)
+        model.load_weights(model_path, by_name=True)
+
+    print("Model ready in {:.1f} sec".format(time.time() - start))
 
     return model
 
 
+def export_model(_config, model_name, epoch = None, precisions = []):
+    """
+    Freezes the inference model of model_name at epoch into a single graph next to its .h5 weights,
+    for create_model(..., frozen = True). Reports the cold start (model creation and first 
+    detection) of the Keras and the frozen models.
+    precisions: reduced precisions (see frozen_model.PRECISIONS) of the graph to write as well, 
+                for create_model(..., frozen = precision). See check_precision() for their accuracy
+    Call in a fresh process: the Keras model is built with the learning phase fixed to inference.
+    Returns the filename of the frozen graph
+    """
+    import keras.backend as K
+    K.set_learning_phase(0)
+
+    def first_detection(model):
+        # A blank image, as an image of the dataset would also be resized to IMAGE_SHAPE
+        images = [np.zeros(_config.IMAGE_SHAPE, dtype = np.uint8)] * _config.BATCH_SIZE
+        start = time.time()
+        model.detect(images, verbose = 0)
+        return time.time() - start
+
+    start = time.time()
+    model = create_model(_config, model_name, epoch)
+    keras_create_time = time.time() - start
+    keras_detect_time = first_detection(model)
+
+    filename = frozen_model.frozen_graph_path(model_weights_path(model, epoch))
+    frozen_model.export_frozen_graph(model, filename)
+    print("Exported frozen graph to ", filename)
+    for precision in precisions:
+        print("Exported {} graph to ".format(precision), frozen_model.reduce_precision(filename, precision))
+
+    start = time.time()
+    model = create_model(_config, model_name, epoch, frozen = True)
+    frozen_create_time = time.time() - start
+    frozen_detect_time = first_detection(model)
+    model.keras_model.close()
+
+    print("Cold start (sec): {:>10} {:>10} {:>10}".format('create', 'detect', 'total'))
+    for name, create_time, detect_time in [('keras', keras_create_time, keras_detect_time), 
+                                           ('frozen', frozen_create_time, frozen_detect_time)]:
+        print("{:>17} {:10.1f} {:10.1f} {:10.1f}".format(name, create_time, detect_time, create_time + detect_time))
+
+    return filename
+
+
+def _precision_predictions(_config, model_name, epoch, precision, dataset, size_threshold):
+    """
+    Predicts the label images of dataset with the precision version of the frozen graph of the model.
+    Runs in a process of its own (see check_precision()).
+    Returns the labels, seconds per image and peak resident memory (MB) of the process
+    """
+    import resource
+    model = create_model(_config, model_name, epoch, frozen = precision)
+
+    labels = []
+    seconds = 0
+    for i in range(0, len(dataset.image_ids), _config.BATCH_SIZE):
+        images = load_dataset_images(dataset, i, _config.BATCH_SIZE)
+        start = time.time()
+        results = detect_packed(model, images)
+        seconds += time.time() - start
+        labels += [f.numpy2labels_no_overlap_threshold(r['masks'], size_threshold) for r in results]
+    seconds /= max(1, len(labels))
+
+    # ru_maxrss is in KB on Linux
+    return labels, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def check_precision(_config, dataset, model_name = 'MaskRCNN', epoch = None, 
+                    precisions = ['float16', 'int8_weights', 'int8'], size_threshold = 30):
+    """
+    Accuracy, speed and memory of the reduced precision versions of the frozen graph of the model 
+    (see export_model()) on a labelled (validation) dataset, against the float32 graph. 
+    Each precision runs in a fresh process, for comparable timings and memory.
+    Returns a DataFrame with, for each precision, the mean DSB2018 score against the true labels 
+    and against the float32 predictions, seconds per image, peak memory and graph size
+    """
+    import multiprocessing
+    import pandas as pd
+
+    filename = frozen_model.frozen_graph_path(model_weights_path(frozen_model.model_shell(_config, model_name), epoch))
+    true_labels = [dataset.load_labels(image_id)[0] for image_id in dataset.image_ids]
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for precision in ['float32'] + [p for p in precisions if p != 'float32']:
+        with context.Pool(1) as pool:
+            labels, seconds, memory = pool.apply(_precision_predictions, (_config, model_name, epoch, precision, dataset, size_threshold))
+        if precision == 'float32':
+            float32_labels = labels
+
+        rows.append({'precision': precision,
+                     'score': np.mean([du.dsb2018_score(t, p) for t, p in zip(true_labels, labels)]),
+                     'score_vs_float32': np.mean([du.dsb2018_score(t, p) for t, p in zip(float32_labels, labels)]),
+                     'sec_per_image': seconds,
+                     'peak_memory_mb': memory,
+                     'graph_mb': os.path.getsize(frozen_model.precision_graph_path(filename, precision)) / 2**20})
+        print(rows[-1])
+
+    return pd.DataFrame(rows, columns = ['precision', 'score', 'score_vs_float32', 'sec_per_image', 'peak_memory_mb', 'graph_mb'])
+
+
 def load_dataset_images(dataset, i, batch_size):
-    # Load image
+    # Load images i to i + batch_size (fewer at the end of the dataset: partial batches are padded by detect_packed())
+    return [dataset.load_image(dataset.image_ids[idx]) for idx in range(i, min(i + batch_size, len(dataset.image_ids)))]
+
+
+def load_batch_images(dataset, image_ids, img_pad = 0):
+    """Loads the images of image_ids, reflect padded by img_pad if > 0"""
     images = []
-    for idx in range(i, i + batch_size):
-        if idx < len(dataset.image_ids):
-            images.append(dataset.load_image(dataset.image_ids[idx]))
-        else:
-            images.append(images[-1])
+    for image_id in image_ids:
+        img = dataset.load_image(image_id)
+        if img_pad > 0:
+            img = np.stack([np.pad(img[:, :, i], img_pad, mode = 'reflect') for i in range(img.shape[-1])], axis = -1)
+        images.append(img)
     return images
 
 
+def postprocess_batch(raw, transforms, image_infos, nms_threshold, voting_threshold, param_dict, use_semantic, 
+                      img_pad = 0, dilate = False, save_dir = None):
+    """
+    Post-processes the raw predictions raw[transform][image] of a batch of images (see detect_raw()):
+    reverses and combines the augmentations (if any transforms), removes the padding, dilates and 
+    run-length encodes the masks.
+    Runs in the post-processing processes of predict_model(), so only depends on its arguments.
+    Returns ImageId, EncodedPixels
+    """
+    if len(transforms) > 0:
+        r = combine_results(reverse_augmentations(raw, transforms, use_semantic), nms_threshold, voting_threshold, param_dict, False, use_semantic)
+    else:
+        r = [unmold_raw(_raw, param_dict, use_semantic) for _raw in raw[0]]
+
+    if dilate:
+        n_dilate = param_dict['n_dilate'] if 'n_dilate' in param_dict else 1
+
+    # Minimum instance size in the submission (see f.numpy2encoding_no_overlap_threshold)
+    size_threshold = param_dict['size_threshold'] if 'size_threshold' in param_dict else 30
+
+    ImageId = []
+    EncodedPixels = []
+
+    for j, image_info in enumerate(image_infos):
+
+        masks = r[j]['masks'] #[H, W, N] instance binary masks
+
+        if img_pad > 0:
+
+            if use_semantic:
+                r[j]['semantic_masks'] = r[j]['semantic_masks'][img_pad : -img_pad, img_pad : -img_pad]
+
+            masks = masks[img_pad : -img_pad, img_pad : -img_pad]
+            valid = np.sum(masks, axis = (0, 1)) > 0
+            masks = masks[:, :, valid]
+
+            # Shift the boxes of the remaining instances into the unpadded image
+            rois = r[j]['rois'][valid] - img_pad
+            rois[:, :2] = np.maximum(rois[:, :2], 0)
+            rois[:, 2:] = np.minimum(rois[:, 2:], np.array(masks.shape[:2]))
+
+            r[j]['masks'] = masks
+            r[j]['scores'] = r[j]['scores'][valid]
+            r[j]['class_ids'] = r[j]['class_ids'][valid]
+            r[j]['rois'] = rois
+
+        scores = r[j]['scores']
+        boxes = r[j]['rois']
+
+        if dilate:
+
+            # Dilate masks within boundary box perimeters
+            masks = dilate_masks(masks, boxes, scores, n_dilate)
+
+        ImageId_batch, EncodedPixels_batch = f.numpy2encoding_no_overlap_threshold(masks, image_info['name'], scores, threshold = size_threshold)
+        ImageId += ImageId_batch
+        EncodedPixels += EncodedPixels_batch
+
+        if save_dir is not None:
+            # Extract final masks from EncodedPixels_batch here and save
+            # using filename: (mosaic_id)_(mosaic_position)_(img_name).npy
+            save_model_predictions(save_dir, EncodedPixels_batch, masks.shape[:2], image_info)
+
+    return ImageId, EncodedPixels
+
+
 def predict_model(_config, dataset, model_name='MaskRCNN', epoch = None, 
                   augment_flips = False, augment_scale = False, 
                   param_dict = {},
                   nms_threshold = 0.3, voting_threshold = 0.5,
                   use_semantic = False,
                   img_pad = 0, dilate = False, 
-                  save_predictions = False, create_submission = True):
+                  save_predictions = False, create_submission = True,
+                  prediction_store = None, postprocess_only = False,
+                  n_loaders = 2, n_workers = None, checkpoint_dir = None, frozen = False):
+    """
+    prediction_store: optional filename of a prediction_store.RawPredictionStore in which the 
+                      raw network outputs are stored, and from which they are reused when present
+    postprocess_only: if True, only post-process the raw outputs of prediction_store, without the network
+    n_loaders, n_workers: threads loading images and processes post-processing the predictions 
+                          while the model runs (see pipeline.run_pipeline()). n_workers = None uses one 
+                          process per core, n_workers = 0 post-processes in sequence with the model
+    checkpoint_dir: if provided, the run is checkpointed in an inference_job.InferenceJob, so that a 
+                    rerun with the same parameters resumes an interrupted run
+    frozen: if True, runs the frozen graph of the model written by export_model() (see create_model())
+    """
 
     # Create save_dir
+    save_dir = None
     if save_predictions:
         save_dir = os.path.join(data_dir, _config.NAME, '_'.join(('submission', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))))
         os.makedirs(save_dir)
 
+    # Create the post-processing processes before the model
+    workers = pipeline.create_worker_pool(n_workers)
+
     # Recreate the model in inference mode
-    model = create_model(_config, model_name, epoch)
+    assert prediction_store is not None or not postprocess_only, 'postprocess_only requires a prediction_store'
+    model = create_model(_config, model_name, epoch, frozen) if not postprocess_only else None
+    store = ps.RawPredictionStore(prediction_store) if prediction_store is not None else None
+    store_model_key = ps.model_key(_config, epoch, img_pad, frozen)
       
     ImageId = []
     EncodedPixels = []
     
-    list_fn_apply = [] + (['apply_flips_rotations'] if augment_flips else []) + (['apply_scaling'] if augment_scale else [])
-    
-    if dilate:
-        n_dilate = param_dict['n_dilate'] if 'n_dilate' in param_dict else 1
-
-    # NB: we need to predict in batches of _config.BATCH_SIZE
-    # as there are layers within the model that have strides dependent on this.
-    for i in tqdm(range(0, len(dataset.image_ids), _config.BATCH_SIZE)):
-         # Load image
-        images = []
-        N = 0
-        for idx in range(i, i + _config.BATCH_SIZE):
-            if idx < len(dataset.image_ids):
-                N += 1
-                if img_pad > 0:
-                    img = dataset.load_image(dataset.image_ids[idx])                  
-                    images.append(np.stack([np.pad(img[:, :, i], img_pad, mode = 'reflect') for i in range(img.shape[-1])], axis = -1))
-                else:
-                    images.append(dataset.load_image(dataset.image_ids[idx]))
+    tta_groups = [] + (['flips_rotations'] if augment_flips else []) + (['scaling'] if augment_scale else [])
+    transforms = tta.get_transforms(tta_groups, _config, param_dict)
+
+    # Skip the images finished by an interrupted run of the same job
+    job = None
+    image_ids = dataset.image_ids
+    if checkpoint_dir is not None:
+        job = inference_job.InferenceJob(checkpoint_dir, 
+                                         {'fn': 'predict_model', 'NAME': _config.NAME, 'model_name': model_name, 'epoch': epoch,
+                                          'augment_flips': augment_flips, 'augment_scale': augment_scale, 'param_dict': param_dict,
+                                          'nms_threshold': nms_threshold, 'voting_threshold': voting_threshold, 
+                                          'use_semantic': use_semantic, 'img_pad': img_pad, 'dilate': dilate, 'frozen': frozen,
+                                          'images': [image_info['name'] for image_info in dataset.image_info]})
+        image_ids = [image_id for image_id in dataset.image_ids if dataset.image_info[image_id]['name'] not in job]
+
+    # NB: the model predicts in batches of _config.BATCH_SIZE as there are layers within the model
+    # that have strides dependent on this. detect_packed() packs the images (and their augmentations)
+    # into full batches, so the last batch of images is not padded here.
+    batches = [image_ids[i : i + _config.BATCH_SIZE] for i in range(0, len(image_ids), _config.BATCH_SIZE)]
+
+    def load_fn(k):
+        image_ids = batches[k]
+        images = load_batch_images(dataset, image_ids, img_pad) if not postprocess_only else [None] * len(image_ids)
+        return image_ids, images
+
+    stats = ForwardStats()
+
+    def model_fn(loaded):
+        image_ids, images = loaded
+        store_keys = [(store_model_key, dataset.image_info[image_id]['name']) for image_id in image_ids]
+        raw = detect_raw(model, images, transforms if len(transforms) > 0 else [tta.TTATransform()], 
+                         use_semantic = use_semantic, store = store, store_keys = store_keys, stats = stats)
+        return raw, [dataset.image_info[image_id] for image_id in image_ids]
+
+    postprocess_fn = functools.partial(_postprocess_batch, transforms = transforms, 
+                                       nms_threshold = nms_threshold, voting_threshold = voting_threshold, 
+                                       param_dict = param_dict, use_semantic = use_semantic, 
+                                       img_pad = img_pad, dilate = dilate, save_dir = save_dir)
+
+    try:
+        for ImageId_batch, EncodedPixels_batch in tqdm(pipeline.run_pipeline(len(batches), load_fn, model_fn, postprocess_fn, 
+                                                                             workers = workers, n_loaders = n_loaders), total = len(batches)):
+            if job is not None:
+                job.write(ImageId_batch, EncodedPixels_batch)
             else:
-                images.append(images[-1])
-
-        # Run detection
-        if len(list_fn_apply) > 0:
-            r = maskrcnn_detect_augmentations(_config, model, images, list_fn_apply, 
-                                              threshold = nms_threshold, voting_threshold = voting_threshold, 
-                                              param_dict = param_dict, 
-                                              use_nms = False, use_semantic = use_semantic)
-        else:
-            r = maskrcnn_detect(_config, model, images, param_dict = param_dict, use_semantic = use_semantic) 
-
-        # Reduce to N images
-        for j, idx in enumerate(range(i, i + _config.BATCH_SIZE)):      
-
-            if j < N:   
-
-                masks = r[j]['masks'] #[H, W, N] instance binary masks
-                scores = r[j]['scores']
-                boxes = r[j]['rois']
-
-                if img_pad > 0:
-
-                    if use_semantic:
-                        r[j]['semantic_masks'] = r[j]['semantic_masks'][img_pad : -img_pad, img_pad : -img_pad]
-
-                    masks = masks[img_pad : -img_pad, img_pad : -img_pad]
-                    valid = np.sum(masks, axis = (0, 1)) > 0
-                    masks = masks[:, :, valid]
-
-                    r[j]['masks'] = masks
-                    r[j]['scores'] = r[j]['scores'][valid]
-                    r[j]['class_ids'] = r[j]['class_ids'][valid]
-                    r[j]['rois'] = r[j]['rois'][valid]
-   
-                if dilate:
-
-                    # Dilate masks within boundary box perimeters
-                    box_labels = du.maskrcnn_boxes_to_labels(boxes, scores, masks.shape[:2])
-                    dilated_masks = []
-                    for i in range(masks.shape[-1]):
-                        dilated_mask = scipy.ndimage.morphology.binary_dilation(masks[:, :, i], iterations = n_dilate)
-                        #from visualize import plot_multiple_images, image_with_masks;                   
-                        #plot_multiple_images([image_with_masks(masks[:, :, i], [box_labels == (i + 1)]), np.multiply(box_labels == (i + 1), dilated_mask)])
-                        dilated_masks.append(np.multiply(box_labels == (i + 1), dilated_mask))
-
-                    masks = np.stack(dilated_masks, axis = -1)
-
-                img_name = dataset.image_info[idx]['name']
-        
-                ImageId_batch, EncodedPixels_batch = f.numpy2encoding_no_overlap_threshold(masks, img_name, scores)
                 ImageId += ImageId_batch
                 EncodedPixels += EncodedPixels_batch
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
+        if store is not None:
+            store.close()
+        if job is not None:
+            job.close()
 
-                if False:
-                    class_names = ['background', 'nucleus']
-                    visualize.display_instances((images[j] * 255).astype(np.uint8), r[j]['rois'], r[j]['masks'], r[j]['class_ids'], class_names, r[j]['scores'], figsize = (8, 8))
-                    
-                if save_predictions:
-                    # Extract final masks from EncodedPixels_batch here and save
-                    # using filename: (mosaic_id)_(mosaic_position)_(img_name).npy
-                    save_model_predictions(save_dir, EncodedPixels_batch, masks.shape[:2], dataset.image_info[idx])
+    print(stats)
 
+    if job is not None:
+        # Merge the shards of this and any previous runs
+        ImageId, EncodedPixels = job.rows()
 
     if create_submission:
         submission_filename = os.path.join(submissions_dir, '_'.join(('submission', _config.NAME, str(epoch), datetime.datetime.now().strftime('%Y%m%d%H%M%S'), '.csv')))
@@ -456,13 +869,20 @@ def predict_model(_config, dataset, model_name='MaskRCNN', epoch = None,
     return ImageId, EncodedPixels
 
 
+def _postprocess_batch(model_output, **kwargs):
+    """postprocess_batch() on the output (raw, image_infos) of the model stage of predict_model()"""
+    raw, image_infos = model_output
+    return postprocess_batch(raw, image_infos = image_infos, **kwargs)
+
+
 def predict_multiple_concat(configs, datasets, model_names, epoch = None, 
                   augment_flips = False, augment_scale = False, 
                   param_dict = {},
                   use_semantic = False,
                   nms_threshold = 0.3, voting_threshold = 0.5,
                   img_pad = 0, dilate = False, 
-                  save_predictions = False, create_submission = True):
+                  save_predictions = False, create_submission = True,
+                  prediction_store = None, postprocess_only = False):
 
     ImageId = []
     EncodedPixels = []
@@ -474,7 +894,8 @@ def predict_multiple_concat(configs, datasets, model_names, epoch = None,
                                                   param_dict = param_dict,
                                                   nms_threshold = nms_threshold, voting_threshold = voting_threshold,
                                                   img_pad = img_pad, dilate = dilate, 
-                                                  save_predictions = save_predictions, create_submission = False)
+                                                  save_predictions = save_predictions, create_submission = False,
+                                                  prediction_store = prediction_store, postprocess_only = postprocess_only)
         ImageId += _ImageId
         EncodedPixels += _EncodedPixels
 
@@ -497,12 +918,26 @@ def predict_voting(configs, datasets, model_names, epochs = None,
                   use_semantic = False,
                   nms_threshold = 0.3, voting_threshold = 0.5,
                   img_pad = 0, dilate = False, 
-                  save_predictions = False, create_submission = True):
+                  save_predictions = False, create_submission = True,
+                  prediction_store = None, postprocess_only = False,
+                  resume = False, checkpoint_dir = None, max_pending = 64, frozen = False,
+                  n_shards = 0, cores_per_shard = None):
     """
     Predicts an ensemble over multiple models via voting
     Presently assumes that augment_flips/scale/param_dict/threshold/use_semantic are the same 
     for all models you want to ensemble. Need to reformat to make these specific to each model.
     Allows for cases where a single model is made up of multiple submodels that apply to different images.
+    prediction_store, postprocess_only: see predict_model()
+    resume: if True, skip the images already in the interim submission of an interrupted run
+    checkpoint_dir: if provided, the run is checkpointed in an inference_job.InferenceJob rather than
+                    the interim submission, so that a rerun with the same parameters resumes an interrupted run
+    max_pending: maximum number of images held while waiting for the batches of all models. Beyond it, 
+                 the models holding the oldest image run a padded partial batch
+    frozen: if True, runs the frozen graphs of the models written by export_model() (see create_model())
+    n_shards: if > 0, each model runs in n_shards worker processes (a model_shards.ShardPool) instead of 
+              in this process, the images being shared with them through shared memory
+    cores_per_shard: cores each shard is pinned to (see model_shards.core_groups()), None: the cores are
+                     split evenly between the shards of all models, 0: no pinning
     """
 
     # Generalise the format of configs and datasets to cater for cases where a single model set may be
@@ -511,117 +946,123 @@ def predict_voting(configs, datasets, model_names, epochs = None,
     datasets = [dataset if isinstance(dataset, list) else [dataset] for dataset in datasets]
     model_names = [model_name if isinstance(model_name, list) else [model_name] for model_name in model_names]
     epochs = [epoch if isinstance(epoch, list) else [epoch] for epoch in epochs] if epochs is not None else [[None for d in dataset] for dataset in datasets]
-    config_batch_sizes = [[c.BATCH_SIZE for c in _config] for _config in configs]
-    batch_size = max([max([b for b in _config_batch_size]) for _config_batch_size in config_batch_sizes])
 
     # Create the models
-    models = [[create_model(c, m, e) for c, e, m in zip(_config, epoch, model_name)] for _config, epoch, model_name in zip(configs, epochs, model_names)]
+    assert prediction_store is not None or not postprocess_only, 'postprocess_only requires a prediction_store'
+    if n_shards > 0 and not postprocess_only:
+        # Each shard of each model gets its own group of cores
+        cores = model_shards.core_groups(n_shards * sum([len(_config) for _config in configs]), cores_per_shard)
+        models = []
+        for _config, epoch, model_name in zip(configs, epochs, model_names):
+            models.append([])
+            for c, e, m in zip(_config, epoch, model_name):
+                models[-1].append(model_shards.ShardPool((c, m, e, frozen), n_shards, cores[:n_shards]))
+                cores = cores[n_shards:]
+    else:
+        models = [[create_model(c, m, e, frozen) if not postprocess_only else None for c, e, m in zip(_config, epoch, model_name)] for _config, epoch, model_name in zip(configs, epochs, model_names)]
+    store = ps.RawPredictionStore(prediction_store) if prediction_store is not None else None
+    store_model_keys = [[ps.model_key(c, e, frozen = frozen) for c, e in zip(_config, epoch)] for _config, epoch in zip(configs, epochs)]
 
-    # Create a mapping for each model of image_path: model index
-    model_infos = merge_model_info(datasets)
+    # Create a mapping for each model set of image_path: (model index, image index), shared across batches
+    path_index = build_path_index(datasets)
 
     # Make sure that you have a full set of model mappings for each model set
-    assert np.all([len(m) == len(model_infos[0]) for m in model_infos[1:]])
+    assert np.all([len(m) == len(path_index[0]) for m in path_index[1:]])
 
-    img_paths = list(model_infos[0].keys())
+    img_paths = list(path_index[0].keys())
     img_paths.sort()
     img_paths = np.array(img_paths)
-    n_images = len(img_paths)
-
-    # Set up holders for the submission rles which you will accumulate
-    ImageId = []
-    EncodedPixels = []
 
-    list_fn_apply = [] + (['apply_flips_rotations'] if augment_flips else []) + (['apply_scaling'] if augment_scale else [])
-   
-    # NB: we need to predict in batches of _config.BATCH_SIZE
-    # as there are layers within the model that have strides dependent on this.
-    for i in tqdm(range(0, n_images, batch_size)):
+    # The submission rles are streamed to the interim submission (or the job shards) as they are produced
+    if checkpoint_dir is not None:
+        writer = inference_job.InferenceJob(checkpoint_dir, 
+                                            {'fn': 'predict_voting', 'NAME': [[c.NAME for c in _config] for _config in configs], 
+                                             'model_names': model_names, 'epochs': epochs,
+                                             'augment_flips': augment_flips, 'augment_scale': augment_scale, 'param_dict': param_dict,
+                                             'nms_threshold': nms_threshold, 'voting_threshold': voting_threshold, 
+                                             'use_semantic': use_semantic, 'frozen': frozen, 'images': list(img_paths)})
+    else:
+        interim_filename = os.path.join(submissions_dir, '_'.join(('submission_ensemble_interim', '.csv')))
+        writer = f.SubmissionWriter(interim_filename, resume = resume)
+
+    tta_groups = [] + (['flips_rotations'] if augment_flips else []) + (['scaling'] if augment_scale else [])
+
+    # Minimum instance size in the submission (see f.numpy2encoding_no_overlap_threshold)
+    size_threshold = param_dict['size_threshold'] if 'size_threshold' in param_dict else 30
+
+    # NB: the models predict in batches of _config.BATCH_SIZE as there are layers within the model
+    # that have strides dependent on this. Each model has its own DynamicBatcher, which fills full 
+    # batches with the images (and augmentations) mapped to it from the queue of all images, so 
+    # only the last batch of each model is padded.
+    stats = ForwardStats()
+    batchers = [[DynamicBatcher(model, tta.get_transforms(tta_groups, c, param_dict) if len(tta_groups) > 0 else [tta.TTATransform()], 
+                                use_semantic = use_semantic, store = store, model_key = key, stats = stats)
+                 for model, c, key in zip(_models, _config, keys)] 
+                for _models, _config, keys in zip(models, configs, store_model_keys)]
+
+    # Results of each model set for the images in flight, in submission order: {img_name: [result]}
+    pending = OrderedDict()
+
+    def run_batchers(flush = False, holding = None):
+        # Run the full batches of every model, and with flush the remainder of the models
+        # holding the image holding (all models if None)
+        for k, model_batchers in enumerate(batchers):
+            for batcher in model_batchers:
+                _flush = flush and (holding is None or holding in batcher)
+                for img_name, raw in batcher.run(flush = _flush):
+                    pending[img_name][k] = reduce_raw(raw, batcher.transforms if len(tta_groups) > 0 else [], 
+                                                      nms_threshold, voting_threshold, param_dict, use_semantic, dense = False)
+
+    def write_completed():
+        # Vote on the oldest images once every model set has predicted them
+        while len(pending) > 0 and all([r is not None for r in next(iter(pending.values()))]):
+            img_name, res = pending.popitem(last = False)
+
+            # Get masks via voting
+            img_results = vote_models(res, nms_threshold, voting_threshold, param_dict, use_semantic)
+
+            # Create submission rle entry
+            ImageId_batch, EncodedPixels_batch = f.numpy2encoding_no_overlap_threshold(img_results['masks'], img_name, img_results['scores'], threshold = size_threshold)
+            writer.write(ImageId_batch, EncodedPixels_batch)
+
+    try:
+        for img_path in tqdm(img_paths):
+
+            img_name = os.path.splitext(os.path.split(img_path)[-1])[0]
+
+            # Skip images already written by an interrupted run
+            if img_name in writer:
+                continue
 
-        batch_img_paths = img_paths[i : (i + batch_size)]
+            images, images_idx = gather_images(datasets, [img_path], path_index)
 
-        if len(batch_img_paths) != batch_size:
-            batch_img_paths = np.append(batch_img_paths, batch_img_paths[:(i + batch_size - len(img_paths))])
+            pending[img_name] = [None] * len(batchers)
+            for model_batchers, _images, idx in zip(batchers, images, images_idx):
+                model_batchers[idx[0]].add(img_name, _images[0])
 
-        images, images_idx = gather_images(datasets, batch_img_paths)
+            run_batchers()
 
-        images_model_set = [[model[_idx] for _idx in idx] for model, idx in zip(models, images_idx)]
-        configs_model_set = [[_config[_idx] for _idx in idx] for _config, idx in zip(configs, images_idx)]
-        identical_idx = [np.all([id == _idx[0] for id in _idx]) for _idx in images_idx]
+            write_completed()
 
-        # Run detection
-        res = []
-        for model, _images, _config, same_model in zip(images_model_set, images, configs_model_set, identical_idx):
+            # Bound the images held: pad a partial batch of the models holding the oldest image
+            while len(pending) > max_pending:
+                run_batchers(flush = True, holding = next(iter(pending.keys())))
+                write_completed()
 
-            # Check if we can run the whole batch through with one model
-            if same_model and _config[0].BATCH_SIZE == batch_size:
+        # Pad the last batch of each model
+        run_batchers(flush = True)
+        write_completed()
+    finally:
+        writer.close()
 
-                # Run detection
-                if len(list_fn_apply) > 0:
-                    r = maskrcnn_detect_augmentations(_config[0], model[0], _images, list_fn_apply, 
-                                                      threshold = nms_threshold, voting_threshold = voting_threshold, 
-                                                      param_dict = param_dict, 
-                                                      use_nms = False, use_semantic = use_semantic)
-                else:
-                    r = maskrcnn_detect(_config[0], model[0], _images, param_dict = param_dict, use_semantic = use_semantic) 
+        if store is not None:
+            store.close()
 
-            else:
+        for model in [model for _models in models for model in _models]:
+            if isinstance(model, model_shards.ShardPool):
+                model.close()
 
-                # The batch needs to be split into individual models
-                r = []
-                for _model, c, img in zip(model, _config, _images):
-
-                    # Artifically expand the batch if required by batch_size
-                    batch_img = [img] if c.BATCH_SIZE == 1 else [img] * c.BATCH_SIZE
-
-                    # Run detection
-                    if len(list_fn_apply) > 0:
-                        prediction = maskrcnn_detect_augmentations(c, _model, batch_img, list_fn_apply, 
-                                                            threshold = nms_threshold, voting_threshold = voting_threshold, 
-                                                            param_dict = param_dict, 
-                                                            use_nms = False, use_semantic = use_semantic)
-                    else:
-                        prediction = maskrcnn_detect(c, _model, batch_img, param_dict = param_dict, use_semantic = use_semantic)
-
-                    prediction = prediction[0] 
-
-                    r.append(prediction)
-
-            # r now contains the results for the images in the batch
-            res.append(r)
-        # Reduce to N images
-        for j, idx in enumerate(range(i, i + batch_size)):      
-
-            if idx < n_images:   
-
-                # Get masks via voting
-                
-                # First reshape masks so that they can be concatenated:
-                for r in res:
-                    r[j]['masks'] = np.moveaxis(r[j]['masks'], -1, 0)
-                    if use_semantic:
-                        # semantic_masks is flat. We need to expand to the r[j]['masks'] dimensions
-                        r[j]['semantic_masks'] = np.stack([r[j]['semantic_masks']] * max(1, r[j]['masks'].shape[0]), axis = 0)
-                
-                # Concatenate
-                img_results = du.concatenate_list_of_dicts([r[j] for r in res])
-
-                # Reduce via voting
-                img_results = reduce_via_voting(img_results, nms_threshold, voting_threshold, param_dict, use_semantic = use_semantic, n_votes = len(models))
-
-                # Reshape 
-                img_results['masks'] = np.moveaxis(img_results['masks'], 0, -1)
-                img_results['class_ids'] = img_results['class_ids'].reshape(-1, )
-                img_results['scores'] = img_results['scores'].reshape(-1, )
-
-                img_name = os.path.splitext(os.path.split(batch_img_paths[j])[-1])[0]
-        
-                # Create submission rle entry
-                ImageId_batch, EncodedPixels_batch = f.numpy2encoding_no_overlap_threshold(img_results['masks'], img_name, img_results['scores'])
-                ImageId += ImageId_batch
-                EncodedPixels += EncodedPixels_batch
-                # Print interim update
-                f.write2csv(os.path.join(submissions_dir, '_'.join(('submission_ensemble_interim', '.csv'))), ImageId, EncodedPixels)
+    print(stats)
         
     if create_submission:
         submission_filename = os.path.join(
@@ -629,55 +1070,44 @@ def predict_voting(configs, datasets, model_names, epochs = None,
             '_'.join(
                 ('submission_ensemble', datetime.datetime.now().strftime('%Y%m%d%H%M%S'), '.csv')))
 
-        f.write2csv(submission_filename, ImageId, EncodedPixels)
+        if checkpoint_dir is not None:
+            # Merge the shards of this and any previous runs
+            writer.merge(submission_filename)
+        else:
+            shutil.copyfile(interim_filename, submission_filename)
 
 
-def merge_model_info(datasets):
+def build_path_index(datasets):
     """
-    Create a single dictionary for each model set that 
-    holds the model index that each image needs to refer to
+    Create a single dictionary for each model set that maps each image path 
+    to the (model index, image index) of the model/dataset that it refers to.
+    Built once per ensemble, so that looking up an image is constant time.
     """
-    model_info = [{}] * len(datasets)
+    path_index = [{} for d in datasets]
     for d, dataset in enumerate(datasets):
         # We have multiple models/datasets making up the full set
         for j in range(len(dataset)):
             for i in range(len(dataset[j].image_ids)):
-                model_info[d][dataset[j].image_info[i]['path']] = j 
-
-    return model_info
+                path_index[d][dataset[j].image_info[i]['path']] = (j, i)
 
+    return path_index
 
-def index_by_path(datasets, img_path):
-
-    img_path_idx = [None] * len(datasets)
-
-    for i, dataset in enumerate(datasets):
-        for j, d in enumerate(dataset):
-            d_paths = [image_info['path'] for image_info in d.image_info]
-            if img_path in d_paths:
-                img_path_idx[i] = (j, d_paths.index(img_path))
-                continue
-    return img_path_idx
 
-
-def gather_images(datasets, batch_img_paths):
+def gather_images(datasets, batch_img_paths, path_index):
     """
     For a given batch of image paths, get the relevant raw data
     from the datasets.
+    path_index: see build_path_index()
     """
-    n_batch = len(batch_img_paths)
-
     images = [[] for d in datasets]
     image_idx = [[] for d in datasets]
 
     for img_path in batch_img_paths:
+        for j, index in enumerate(path_index):
 
-        img_path_idx = index_by_path(datasets, img_path) 
-
-        for j, path_idx in enumerate(img_path_idx):
-
-            images[j].extend(load_dataset_images(datasets[j][path_idx[0]], path_idx[1], 1))
-            image_idx[j].append(path_idx[0]) # the model/dataset that the image is mapped to
+            model_idx, i = index[img_path]
+            images[j].extend(load_dataset_images(datasets[j][model_idx], i, 1))
+            image_idx[j].append(model_idx) # the model/dataset that the image is mapped to
 
     return images, image_idx
 
@@ -700,6 +1130,12 @@ def save_model_predictions(save_dir, EncodedPixels_batch, mask_shape, image_info
     return 
 
 
+def export_experiment(fn_experiment, epoch = None, precisions = []):
+    """Exports the frozen inference graph of the model of fn_experiment (see export_model())"""
+    _config, _, model_name = fn_experiment(training=False)
+    return export_model(_config, model_name, epoch, precisions)
+
+
 def predict_experiment(fn_experiment, fn_predict = 'predict_model', **kwargs):
 
     if isinstance(fn_experiment, list):
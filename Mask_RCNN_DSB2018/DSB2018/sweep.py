@@ -0,0 +1,148 @@
+"""
+Offline sweep of the post-processing parameters over the raw predictions of a
+prediction_store.RawPredictionStore, scored with the DSB2018 metric on a labelled dataset.
+
+The raw predictions are first stored by running predict_model()/predict_voting() with
+prediction_store = <filename> (and img_pad = 0) on the labelled (validation) images. The sweep then evaluates
+every setting of a grid, e.g.
+
+    grid = {'nms_threshold': [0.3, 0.5],
+            'voting_threshold': [0.4, 0.5, 0.6],
+            'n_dilate': [0, 1],
+            'n_erode': [0, 1],
+            'size_threshold': [20, 30, 40]}
+
+without the network, in parallel over images.
+
+n_dilate and n_erode only take effect through the semantic post-processing (use_semantic = True),
+and n_dilate through the dilation of predict_model(..., dilate = True) (dilate = True).
+"""
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import functions as f
+import dsb2018_utils as du
+import prediction_store as ps
+import submit
+import tta
+
+
+def grid_settings(grid):
+    """Returns the list of settings (dicts) of the cartesian product of grid {name: list of values}"""
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def score_image(raw, settings, transforms, true_labels, param_dict = {}, use_semantic = False, dilate = False):
+    """
+    Scores the post-processing of the raw predictions of one image for each setting.
+    raw: list over models of raw[transform] results (see submit.detect_raw())
+    dilate: if True, dilates the masks by n_dilate as submit.postprocess_batch() does
+    Returns a [len(settings)] array of DSB2018 scores
+    """
+    # Reversing the augmentations does not depend on the settings, so is only done once
+    if len(transforms) > 0:
+        model_results = [submit.reverse_augmentations([[r] for r in _raw], transforms, use_semantic) for _raw in raw]
+
+    # The results of an ensemble are voted on as crops (see submit.detections_result())
+    dense = len(raw) == 1
+
+    scores = np.zeros(len(settings))
+    for k, setting in enumerate(settings):
+
+        _param_dict = dict(param_dict)
+        _param_dict.update({key: setting[key] for key in ['n_dilate', 'n_erode'] if key in setting})
+        nms_threshold = setting['nms_threshold'] if 'nms_threshold' in setting else 0.3
+        voting_threshold = setting['voting_threshold'] if 'voting_threshold' in setting else 0.5
+        size_threshold = setting['size_threshold'] if 'size_threshold' in setting else 30
+
+        if len(transforms) > 0:
+            res = [submit.combine_results(results_augment, nms_threshold, voting_threshold, _param_dict, False, use_semantic, dense)[0] for results_augment in model_results]
+        else:
+            res = [submit.unmold_raw(_raw[0], _param_dict, use_semantic, dense) for _raw in raw]
+
+        img_results = submit.vote_models(res, nms_threshold, voting_threshold, _param_dict, use_semantic) if len(res) > 1 else res[0]
+
+        masks = img_results['masks']
+        if dilate:
+            n_dilate = _param_dict['n_dilate'] if 'n_dilate' in _param_dict else 1
+            masks = submit.dilate_masks(masks, img_results['rois'], img_results['scores'], n_dilate)
+
+        pred_labels = f.numpy2labels_no_overlap_threshold(masks, size_threshold)
+        scores[k] = du.dsb2018_score(true_labels, pred_labels)
+
+    return scores
+
+
+# State of the sweep in each worker process, set by _init_worker()
+_worker = {}
+
+
+def _init_worker(prediction_store, dataset, model_keys, transforms, settings, param_dict, use_semantic, dilate):
+    _worker.update({'store': ps.RawPredictionStore(prediction_store, mode = 'r'),
+                    'dataset': dataset,
+                    'model_keys': model_keys,
+                    'transforms': transforms,
+                    'settings': settings,
+                    'param_dict': param_dict,
+                    'use_semantic': use_semantic,
+                    'dilate': dilate})
+
+
+def _score_image_id(image_id):
+    store = _worker['store']
+    dataset = _worker['dataset']
+    transforms = _worker['transforms']
+    aug_names = [t.name for t in transforms] if len(transforms) > 0 else [tta.TTATransform.name]
+
+    img_name = dataset.image_info[image_id]['name']
+    raw = [[store.get(key, img_name, aug_name) for aug_name in aug_names] for key in _worker['model_keys']]
+    true_labels, _ = dataset.load_labels(image_id)
+
+    return score_image(raw, _worker['settings'], transforms, true_labels, _worker['param_dict'], _worker['use_semantic'], _worker['dilate'])
+
+
+def run_sweep(prediction_store, dataset, configs, grid, epochs = None,
+              augment_flips = False, augment_scale = False, param_dict = {}, use_semantic = False,
+              dilate = False, n_processes = None):
+    """
+    Scores every setting of grid (see grid_settings()) on the images of dataset, using the raw
+    predictions of the models of configs (at epochs) in prediction_store.
+    configs, epochs: a config (and epoch), or lists of them for an ensemble voted as in predict_voting()
+    augment_flips, augment_scale, param_dict['scales']: the test time augmentations the raw predictions were stored with
+    dilate: post-process as predict_model(..., dilate = True), i.e. dilate the masks by n_dilate
+    n_processes: size of the process pool (None: one per core)
+
+    nms_threshold and voting_threshold do nothing without test time augmentations or an ensemble.
+    n_erode requires use_semantic, and n_dilate use_semantic or dilate, as they would not change the scores otherwise.
+
+    Returns a DataFrame with one row per setting and its mean score over the images, best first
+    """
+    configs = configs if isinstance(configs, list) else [configs]
+    epochs = epochs if isinstance(epochs, list) else [epochs] * len(configs)
+    model_keys = [ps.model_key(c, e) for c, e in zip(configs, epochs)]
+
+    assert use_semantic or 'n_erode' not in grid, 'n_erode requires use_semantic'
+    assert use_semantic or dilate or 'n_dilate' not in grid, 'n_dilate requires use_semantic or dilate'
+
+    tta_groups = [] + (['flips_rotations'] if augment_flips else []) + (['scaling'] if augment_scale else [])
+    transforms = tta.get_transforms(tta_groups, configs[0], param_dict)
+
+    settings = grid_settings(grid)
+    print('Sweeping {} settings over {} images'.format(len(settings), len(dataset.image_ids)))
+
+    pool = multiprocessing.Pool(n_processes, _init_worker,
+                                (prediction_store, dataset, model_keys, transforms, settings, param_dict, use_semantic, dilate))
+    try:
+        scores = np.stack(pool.map(_score_image_id, dataset.image_ids, chunksize = 4), axis = 0)
+    finally:
+        pool.close()
+        pool.join()
+
+    df = pd.DataFrame(settings)
+    df['score'] = np.mean(scores, axis = 0)
+    df['score_std'] = np.std(scores, axis = 0)
+
+    return df.sort_values('score', ascending = False).reset_index(drop = True)
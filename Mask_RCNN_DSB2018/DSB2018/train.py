@@ -7,13 +7,20 @@ import model as modellib
 from model import log
 import utils
 import random
-from settings import base_dir, train_dir, test_dir, supplementary_dir, stage2_test_dir
+from settings import base_dir, train_dir, test_dir, supplementary_dir, stage2_test_dir, apply_cpu_settings
 import getpass
 USER = getpass.getuser()
 
 
 TESTING  = False
 
+def create_model(_config, model_name, mode = "training"):
+    """Creates the model_name model, after applying the CPU settings of _config"""
+    apply_cpu_settings(_config)
+    return getattr(modellib, model_name)(mode=mode, config=_config,
+                                         model_dir=_config.MODEL_DIR)
+
+
 def load_weights(model, _config, init_with_override = None):
 
     init_with = _config.init_with if init_with_override is None else init_with_override  # imagenet, coco, or last
@@ -102,8 +109,7 @@ def train_resnet_semantic(training = True, architecture = 'resnet101'):
         dataset_val = None
 
         # Create model in training mode
-        model = getattr(modellib, model_name)(mode="training", config=_config,
-                                  model_dir=_config.MODEL_DIR)
+        model = create_model(_config, model_name)
         model = load_weights(model, _config)
     
         model.train(dataset_train, dataset_val,
@@ -169,8 +175,7 @@ def train_resnet_semantic_maskcount_balanced(training = True, architecture = 're
         dataset_val = None
 
         # Create model in training mode
-        model = getattr(modellib, model_name)(mode="training", config=_config,
-                                  model_dir=_config.MODEL_DIR)
+        model = create_model(_config, model_name)
         model = load_weights(model, _config)
     
         model.train(dataset_train, dataset_val,
@@ -257,8 +262,7 @@ def train_resnet_semantic_b_w_colour(training = True, architecture='resnet101'):
         dataset_val = None
 
         # Create model in training mode
-        bw_model = getattr(modellib, model_name)(mode="training", config=bw_config,
-                                    model_dir=bw_config.MODEL_DIR)
+        bw_model = create_model(bw_config, model_name)
         bw_model = load_weights(bw_model, bw_config)
             
         bw_model.train(dataset_train, dataset_val,
@@ -282,8 +286,7 @@ def train_resnet_semantic_b_w_colour(training = True, architecture='resnet101'):
         dataset_val = None
 
         # Create model in training mode
-        colour_model = getattr(modellib, model_name)(mode="training", config=colour_config,
-                                    model_dir=colour_config.MODEL_DIR)
+        colour_model = create_model(colour_config, model_name)
         colour_model = load_weights_from_model(colour_model, bw_model)
     
         # Clear bw_model
@@ -380,8 +383,7 @@ def train_resnet_semantic_b_w_colour_maskcount_balanced(training = True, archite
         dataset_val = None
 
         # Create model in training mode
-        bw_model = getattr(modellib, model_name)(mode="training", config=bw_config,
-                                    model_dir=bw_config.MODEL_DIR)
+        bw_model = create_model(bw_config, model_name)
         bw_model = load_weights(bw_model, bw_config)
             
         bw_model.train(dataset_train, dataset_val,
@@ -406,8 +408,7 @@ def train_resnet_semantic_b_w_colour_maskcount_balanced(training = True, archite
         dataset_val = None
 
         # Create model in training mode
-        colour_model = getattr(modellib, model_name)(mode="training", config=colour_config,
-                                    model_dir=colour_config.MODEL_DIR)
+        colour_model = create_model(colour_config, model_name)
         colour_model = load_weights_from_model(colour_model, bw_model)
     
         # Clear bw_model
@@ -509,8 +510,7 @@ def train_resnet_semantic_kfold(training = True, architecture = 'resnet101', k =
             dataset_val = None
 
             # Create model in training mode
-            model = getattr(modellib, model_name)(mode="training", config=_config,
-                                        model_dir=_config.MODEL_DIR)
+            model = create_model(_config, model_name)
             model = load_weights(model, _config)
     
             model.train(dataset_train, dataset_val,
@@ -607,8 +607,7 @@ def train_resnet_semantic_invert(training = True, architecture = 'resnet101'):
         dataset_val = None
 
         # Create model in training mode
-        model = getattr(modellib, model_name)(mode="training", config=_config,
-                                  model_dir=_config.MODEL_DIR)
+        model = create_model(_config, model_name)
         model = load_weights(model, _config)
     
         model.train(dataset_train, dataset_val,
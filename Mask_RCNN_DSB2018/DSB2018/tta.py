@@ -0,0 +1,205 @@
+"""
+Test time augmentations (TTA).
+
+Each transform declares how it is applied to an image and how it is inverted on the
+raw detections of the network: the boxes are mapped back analytically and only the
+small (typically 28x28) mask crops are flipped/rotated. The masks are then unmolded once,
+in the coordinates of the original image, as crops within their tight boxes.
+
+Transforms are grouped, and groups are registered by name in TTA_GROUPS, e.g.
+get_transforms('flips_rotations', config, param_dict).
+"""
+import numpy as np
+import scipy.ndimage
+
+import utils
+
+
+TTA_GROUPS = {}
+
+
+def register_tta_group(name):
+    """Decorator registering fn(config, param_dict) -> list of TTATransform under name"""
+    def register(fn):
+        TTA_GROUPS[name] = fn
+        return fn
+    return register
+
+
+def get_transforms(names, config, param_dict = {}):
+    """Returns the list of transforms of the groups in names (a name or a list of names)"""
+    names = [names] if isinstance(names, str) else names
+    return [t for name in names for t in TTA_GROUPS[name](config, param_dict)]
+
+
+class TTATransform(object):
+    """
+    Identity transform. Subclasses override apply() and the invert_* methods.
+    aug_shape is the shape of the augmented image the network saw,
+    image_shape the shape of the original image.
+    """
+    # Name of the augmentation, e.g. in a prediction_store.RawPredictionStore
+    name = 'identity'
+    # Scale passed to model.detect() via mask_scale (None: normal resize)
+    mask_scale = None
+
+    def apply(self, image):
+        return image
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        """boxes: [N, (y1, x1, y2, x2)] in the augmented image"""
+        return boxes
+
+    def invert_crops(self, crops):
+        """crops: [N, h, w] masks relative to their boxes"""
+        return crops
+
+    def invert_image(self, mask, image_shape):
+        """mask: [H, W] full size mask of the augmented image, e.g. a semantic mask"""
+        return mask
+
+    def invert(self, result, aug_shape, image_shape, use_semantic = False):
+        """
+        Inverts a result of model.detect(..., unmold_masks = False) on the augmented image.
+        Returns a result dict in the coordinates of the original image (of shape image_shape), with 
+        rois the tight boxes of the masks, crops the list of masks within them (their mask_extents, 
+        see detections.Detections.append_crops()) and, if use_semantic, the [H, W] semantic_masks
+        """
+        boxes = self.invert_boxes(result['rois'], aug_shape, image_shape)
+        crops, rois = utils.unmold_mask_crops(self.invert_crops(result['mask_crops']), boxes)
+
+        output = {'rois': rois,
+                  'class_ids': result['class_ids'],
+                  'scores': result['scores'],
+                  'crops': crops,
+                  'mask_extents': rois,
+                  'image_shape': tuple(image_shape[:2])}
+
+        if use_semantic:
+            output['semantic_masks'] = self.invert_image(result['semantic_masks'], image_shape)
+
+        return output
+
+
+class FlipLR(TTATransform):
+    name = 'fliplr'
+
+    def apply(self, image):
+        return np.fliplr(image)
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        w = aug_shape[1]
+        return np.stack([boxes[:, 0], w - boxes[:, 3], boxes[:, 2], w - boxes[:, 1]], axis = 1)
+
+    def invert_crops(self, crops):
+        return crops[:, :, ::-1]
+
+    def invert_image(self, mask, image_shape):
+        return np.fliplr(mask)
+
+
+class FlipUD(TTATransform):
+    name = 'flipud'
+
+    def apply(self, image):
+        return np.flipud(image)
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        h = aug_shape[0]
+        return np.stack([h - boxes[:, 2], boxes[:, 1], h - boxes[:, 0], boxes[:, 3]], axis = 1)
+
+    def invert_crops(self, crops):
+        return crops[:, ::-1]
+
+    def invert_image(self, mask, image_shape):
+        return np.flipud(mask)
+
+
+class FlipLRUD(TTATransform):
+    name = 'fliplrud'
+
+    def apply(self, image):
+        return np.flipud(np.fliplr(image))
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        h, w = aug_shape[:2]
+        return np.stack([h - boxes[:, 2], w - boxes[:, 3], h - boxes[:, 0], w - boxes[:, 1]], axis = 1)
+
+    def invert_crops(self, crops):
+        return crops[:, ::-1, ::-1]
+
+    def invert_image(self, mask, image_shape):
+        return np.fliplr(np.flipud(mask))
+
+
+class Rot90(TTATransform):
+    """np.rot90(image, k, (0, 1)) for k = 1 or 3"""
+
+    def __init__(self, k):
+        assert k in [1, 3]
+        self.k = k
+        self.name = 'rot90_{}'.format(k)
+
+    def apply(self, image):
+        return np.rot90(image, self.k, (0, 1))
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        if self.k == 1:
+            # Pixel (y, x) of the image is at (w - 1 - x, y) in the augmented image
+            w = aug_shape[0]
+            return np.stack([boxes[:, 1], w - boxes[:, 2], boxes[:, 3], w - boxes[:, 0]], axis = 1)
+        else:
+            # Pixel (y, x) of the image is at (x, h - 1 - y) in the augmented image
+            h = aug_shape[1]
+            return np.stack([h - boxes[:, 3], boxes[:, 0], h - boxes[:, 1], boxes[:, 2]], axis = 1)
+
+    def invert_crops(self, crops):
+        return np.rot90(crops, -self.k, (1, 2))
+
+    def invert_image(self, mask, image_shape):
+        return np.rot90(mask, -self.k, (0, 1))
+
+
+class Scale(TTATransform):
+    """
+    Feeds the network the image window it would normally see, rescaled by scale.
+    NB: because of how maskrcnn resizes, images are scaled up to reach
+    (config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM) as standard.
+    As a result, if we have scales > 1 the images will end up being scaled back down to the
+    maximum anyway. So we can only generate different scaled inputs by scaling downwards.
+    """
+
+    def __init__(self, scale, config):
+        self.mask_scale = scale
+        self.config = config
+        self.name = 'scale_{}'.format(scale)
+
+    def apply(self, image):
+        # Take the image window out of the model image input (the rest is padding)
+        image, window, _, _ = utils.resize_image(image, min_dim = self.config.IMAGE_MIN_DIM, max_dim = self.config.IMAGE_MAX_DIM, padding = self.config.IMAGE_PADDING)
+        return image[window[0] : window[2], window[1] : window[3]]
+
+    def invert_boxes(self, boxes, aug_shape, image_shape):
+        h_scale = image_shape[0] / aug_shape[0]
+        w_scale = image_shape[1] / aug_shape[1]
+        boxes = np.round(boxes * np.array([h_scale, w_scale, h_scale, w_scale])).astype(np.int32)
+        # Keep at least one pixel per box, within the image
+        shape = np.array(image_shape[:2])
+        boxes[:, :2] = np.minimum(boxes[:, :2], shape - 1)
+        boxes[:, 2:] = np.clip(boxes[:, 2:], boxes[:, :2] + 1, shape)
+        return boxes
+
+    def invert_image(self, mask, image_shape):
+        return scipy.ndimage.zoom(mask, (image_shape[0] / mask.shape[0], image_shape[1] / mask.shape[1]), order = 0)
+
+
+@register_tta_group('flips_rotations')
+def flips_rotations(config, param_dict):
+    return [TTATransform(), FlipLR(), FlipUD(), FlipLRUD(), Rot90(1), Rot90(3)]
+
+
+@register_tta_group('scaling')
+def scaling(config, param_dict):
+    """param_dict['scales'], e.g. [0.8, 0.9, 1] (see Scale)"""
+    assert 'scales' in param_dict.keys()
+    return [Scale(scale, config) for scale in param_dict['scales']]
@@ -17,14 +17,16 @@ import itertools
 import json
 import re
 import logging
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 import numpy as np
 import scipy.misc
 from scipy import ndimage
+import cv2
 from skimage import exposure
 from imgaug import augmenters as iaa
 import multiprocessing
 import copy
+import atexit
 
 # Import keras / tensorflow and set config
 import keras
@@ -240,6 +242,17 @@ def clip_boxes_graph(boxes, window):
     return clipped
 
 
+def batch_gather_graph(params, indices):
+    """Gathers the rows of each image of a batch at once.
+    params: [batch, N, ...]
+    indices: [batch, K] int32 indices into the second dimension of params
+    Returns [batch, K, ...], i.e. tf.gather(params[b], indices[b]) for each b
+    """
+    batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                       [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([batch_ix, indices], axis=2))
+
+
 class ProposalLayer(KE.Layer):
     """Receives anchor scores and selects a subset to pass as proposals
     to the second stage. Filtering is done based on anchor scores and
@@ -279,28 +292,20 @@ class ProposalLayer(KE.Layer):
         pre_nms_limit = min(6000, self.anchors.shape[0])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
-
-        # Apply deltas to anchors to get refined anchors.
-        # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        scores = batch_gather_graph(scores, ix)
+        deltas = batch_gather_graph(deltas, ix)
+        anchors = tf.gather(anchors, ix, name="pre_nms_anchors")
 
-        # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
+        # Apply deltas to anchors to get refined anchors, and clip to image
+        # boundaries. The boxes of the whole batch are processed at once.
+        # [batch, N, (y1, x1, y2, x2)]
         height, width = self.config.IMAGE_SHAPE[:2]
         window = np.array([0, 0, height, width]).astype(np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = apply_box_deltas_graph(tf.reshape(anchors, [-1, 4]),
+                                       tf.reshape(deltas, [-1, 4]))
+        boxes = clip_boxes_graph(boxes, window)
+        boxes = tf.reshape(boxes, tf.shape(anchors),
+                           name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
@@ -309,8 +314,9 @@ class ProposalLayer(KE.Layer):
         # Normalize dimensions to range of 0 to 1.
         normalized_boxes = boxes / np.array([[height, width, height, width]])
 
-        # Non-max suppression
-        def nms(normalized_boxes, scores):
+        # Non-max suppression, the only step that is run image by image
+        def nms(inputs):
+            normalized_boxes, scores = inputs
             indices = tf.image.non_max_suppression(
                 normalized_boxes, scores, self.proposal_count,
                 self.nms_threshold, name="rpn_non_max_suppression")
@@ -319,8 +325,7 @@ class ProposalLayer(KE.Layer):
             padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
             proposals = tf.pad(proposals, [(0, padding), (0, 0)])
             return proposals
-        proposals = utils.batch_slice([normalized_boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        proposals = tf.map_fn(nms, [normalized_boxes, scores], dtype=tf.float32)
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -473,9 +478,30 @@ def overlaps_graph(boxes1, boxes2):
     return overlaps
 
 
+def batch_overlaps_graph(boxes1, boxes2):
+    """Computes IoU overlaps between two sets of boxes of each image of a batch.
+    boxes1: [batch, N1, (y1, x1, y2, x2)], boxes2: [batch, N2, (y1, x1, y2, x2)].
+    Returns [batch, N1, N2]. Pairs of zero area boxes give NaN.
+    """
+    b1 = tf.expand_dims(boxes1, 2)
+    b2 = tf.expand_dims(boxes2, 1)
+    y1 = tf.maximum(b1[..., 0], b2[..., 0])
+    x1 = tf.maximum(b1[..., 1], b2[..., 1])
+    y2 = tf.minimum(b1[..., 2], b2[..., 2])
+    x2 = tf.minimum(b1[..., 3], b2[..., 3])
+    intersection = tf.maximum(x2 - x1, 0) * tf.maximum(y2 - y1, 0)
+    b1_area = (b1[..., 2] - b1[..., 0]) * (b1[..., 3] - b1[..., 1])
+    b2_area = (b2[..., 2] - b2[..., 0]) * (b2[..., 3] - b2[..., 1])
+    union = b1_area + b2_area - intersection
+    return intersection / union
+
+
 def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config):
     """Generates detection targets for one image. Subsamples proposals and
     generates target class IDs, bounding box deltas, and masks for each.
+    DetectionTargetLayer computes the same targets for the whole batch at
+    once, only sampling the ROIs of each image in a loop (see
+    sample_rois_graph()).
 
     Inputs:
     proposals: [N, (y1, x1, y2, x2)] in normalized coordinates. Might
@@ -607,6 +633,38 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     return rois, roi_gt_class_ids, deltas, masks
 
 
+def sample_rois_graph(positive_roi_bool, negative_roi_bool, config):
+    """Subsamples the ROIs of one image, as detection_targets_graph() does.
+    positive_roi_bool, negative_roi_bool: [N] which proposals are positive
+        and negative ROIs.
+
+    Returns:
+    indices: [TRAIN_ROIS_PER_IMAGE] int32 indices of the sampled positive
+        then negative ROIs in the proposals. Zero padded.
+    positive_count: number of positive ROIs sampled.
+    count: number of ROIs sampled.
+    """
+    positive_indices = tf.where(positive_roi_bool)[:, 0]
+    negative_indices = tf.where(negative_roi_bool)[:, 0]
+
+    # Subsample ROIs. Aim for 33% positive
+    # Positive ROIs
+    positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
+                         config.ROI_POSITIVE_RATIO)
+    positive_indices = tf.random_shuffle(positive_indices)[:positive_count]
+    positive_count = tf.shape(positive_indices)[0]
+    # Negative ROIs. Add enough to maintain positive:negative ratio.
+    r = 1.0 / config.ROI_POSITIVE_RATIO
+    negative_count = tf.cast(r * tf.cast(positive_count, tf.float32), tf.int32) - positive_count
+    negative_indices = tf.random_shuffle(negative_indices)[:negative_count]
+
+    indices = tf.cast(tf.concat([positive_indices, negative_indices], axis=0), tf.int32)
+    count = tf.shape(indices)[0]
+    indices = tf.pad(indices, [(0, tf.maximum(config.TRAIN_ROIS_PER_IMAGE - count, 0))])
+    indices = tf.reshape(indices, [config.TRAIN_ROIS_PER_IMAGE])
+    return indices, positive_count, count
+
+
 class DetectionTargetLayer(KE.Layer):
     """Subsamples proposals and generates target box refinment, class_ids,
     and masks for each.
@@ -643,16 +701,112 @@ class DetectionTargetLayer(KE.Layer):
         gt_class_ids = inputs[1]
         gt_boxes = inputs[2]
         gt_masks = inputs[3]
+        config = self.config
+        batch_size = tf.shape(proposals)[0]
+        num_rois = config.TRAIN_ROIS_PER_IMAGE
+
+        # Assertions
+        asserts = [
+            tf.Assert(tf.greater(tf.shape(proposals)[1], 0), [proposals],
+                      name="roi_assertion"),
+        ]
+        with tf.control_dependencies(asserts):
+            proposals = tf.identity(proposals)
+
+        # The whole batch is processed at once, so the zero padding of the
+        # proposals and GT boxes is masked rather than trimmed.
+        # COCO crowds (negative class IDs) are excluded from training.
+        proposal_valid = tf.reduce_any(tf.not_equal(proposals, 0), axis=2)
+        gt_valid = tf.reduce_any(tf.not_equal(gt_boxes, 0), axis=2)
+        crowd_bool = tf.logical_and(gt_valid, gt_class_ids < 0)
+        non_crowd_bool = tf.logical_and(gt_valid, gt_class_ids > 0)
+
+        # Overlaps [batch, proposals, gt_boxes], with the GT boxes and the
+        # crowd boxes only
+        overlaps = batch_overlaps_graph(proposals, gt_boxes)
+        tiles = [1, tf.shape(proposals)[1], 1]
+        crowd_overlaps = tf.where(tf.tile(tf.expand_dims(crowd_bool, 1), tiles),
+                                  overlaps, tf.zeros_like(overlaps))
+        overlaps = tf.where(tf.tile(tf.expand_dims(non_crowd_bool, 1), tiles),
+                            overlaps, -tf.ones_like(overlaps))
+        no_crowd_bool = (tf.reduce_max(crowd_overlaps, axis=2) < 0.001)
+
+        # Determine postive and negative ROIs
+        roi_iou_max = tf.reduce_max(overlaps, axis=2)
+        # 1. Positive ROIs are those with >= 0.5 IoU with a GT box
+        positive_roi_bool = tf.logical_and(proposal_valid, roi_iou_max >= 0.5)
+        # 2. Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
+        negative_roi_bool = tf.logical_and(proposal_valid,
+                                           tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))
+        # GT box of each proposal
+        gt_box_assignment = tf.cast(tf.argmax(overlaps, axis=2), tf.int32)
+
+        # Subsample the ROIs in a loop over the batch: the sampling works on
+        # sets of a different size in each image.
+        indices, positive_count, count = tf.map_fn(
+            lambda x: sample_rois_graph(x[0], x[1], config),
+            [positive_roi_bool, negative_roi_bool],
+            dtype=(tf.int32, tf.int32, tf.int32))
+        row = tf.expand_dims(tf.range(num_rois), 0)
+        positive = tf.reshape(row < tf.expand_dims(positive_count, 1), [-1])
+        valid = row < tf.expand_dims(count, 1)
+
+        # Gather the selected ROIs, and assign the positive ROIs to GT boxes
+        rois = batch_gather_graph(proposals, indices) * tf.expand_dims(tf.cast(valid, tf.float32), 2)
+        roi_gt_box_assignment = batch_gather_graph(gt_box_assignment, indices)
+        roi_gt_boxes = batch_gather_graph(gt_boxes, roi_gt_box_assignment)
+        roi_gt_class_ids = batch_gather_graph(gt_class_ids, roi_gt_box_assignment)
+        roi_gt_class_ids *= tf.cast(tf.reshape(positive, [batch_size, num_rois]), roi_gt_class_ids.dtype)
+
+        # Compute bbox refinement for positive ROIs. The other ROIs and their
+        # GT boxes are replaced with the unit box, so that their (zero)
+        # deltas and mask boxes stay finite.
+        unit_boxes = tf.tile(tf.constant([[0., 0., 1., 1.]]), [batch_size * num_rois, 1])
+        positive_rois = tf.where(positive, tf.reshape(rois, [-1, 4]), unit_boxes)
+        positive_gt_boxes = tf.where(positive, tf.reshape(roi_gt_boxes, [-1, 4]), unit_boxes)
+        deltas = utils.box_refinement_graph(positive_rois, positive_gt_boxes)
+        deltas /= config.BBOX_STD_DEV
+
+        # Compute mask targets
+        boxes = positive_rois
+        if config.USE_MINI_MASK:
+            # Transform ROI corrdinates from normalized image space
+            # to normalized mini-mask space.
+            y1, x1, y2, x2 = tf.split(positive_rois, 4, axis=1)
+            gt_y1, gt_x1, gt_y2, gt_x2 = tf.split(positive_gt_boxes, 4, axis=1)
+            gt_h = gt_y2 - gt_y1
+            gt_w = gt_x2 - gt_x1
+            y1 = (y1 - gt_y1) / gt_h
+            x1 = (x1 - gt_x1) / gt_w
+            y2 = (y2 - gt_y1) / gt_h
+            x2 = (x2 - gt_x1) / gt_w
+            boxes = tf.concat([y1, x1, y2, x2], 1)
+        # Permute masks to [batch * MAX_GT_INSTANCES, height, width, 1], and
+        # pick the right mask for each ROI
+        num_gt = tf.shape(gt_masks)[3]
+        transposed_masks = tf.reshape(tf.transpose(gt_masks, [0, 3, 1, 2]),
+                                      [-1, tf.shape(gt_masks)[1], tf.shape(gt_masks)[2], 1])
+        box_ids = tf.reshape(tf.expand_dims(tf.range(batch_size), 1) * num_gt + roi_gt_box_assignment, [-1])
+        masks = tf.image.crop_and_resize(tf.cast(transposed_masks, tf.float32), boxes,
+                                         box_ids,
+                                         config.MASK_SHAPE)
+        # Remove the extra dimension from masks.
+        masks = tf.squeeze(masks, axis=3)
+
+        # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
+        # binary cross entropy loss.
+        masks = tf.round(masks)
+
+        # Zero the bbox deltas and masks that are not used for negative ROIs
+        # and padding
+        masks = tf.where(positive, masks, tf.zeros_like(masks))
+        deltas = tf.reshape(deltas, [batch_size, num_rois, 4])
+        masks = tf.reshape(masks, [batch_size, num_rois, config.MASK_SHAPE[0], config.MASK_SHAPE[1]])
 
-        # Slice the batch and run a graph for each slice
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
-        outputs = utils.batch_slice(
-            [proposals, gt_class_ids, gt_boxes, gt_masks],
-            lambda w, x, y, z: detection_targets_graph(
-                w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
-        return outputs
+        outputs = [rois, roi_gt_class_ids, deltas, masks]
+        return [tf.identity(o, name=n) for o, n in zip(outputs, names)]
 
     def compute_output_shape(self, input_shape):
         return [
@@ -755,12 +909,94 @@ def refine_detections(rois, probs, deltas, window, config):
     return result
 
 
+def refine_detections_graph(rois, probs, deltas, window, config):
+    """Refine classified proposals and filter overlaps and return final
+    detections. In-graph, batched version of refine_detections().
+
+    Inputs:
+        rois: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+        probs: [batch, N, num_classes]. Class probabilities.
+        deltas: [batch, N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
+                bounding box deltas.
+        window: [batch, (y1, x1, y2, x2)] in image coordinates. The part of the image
+            that contains the image excluding the padding.
+
+    Returns detections shaped: [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+    in image coordinates, zero padded.
+    """
+    batch_size = tf.shape(probs)[0]
+    num_rois = tf.shape(probs)[1]
+    # Class IDs per ROI
+    class_ids = tf.cast(tf.argmax(probs, axis=2), tf.int32)
+    # Class probability of the top class of each ROI
+    class_scores = tf.reduce_max(probs, axis=2)
+    # Class-specific bounding box deltas
+    batch_ix = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, num_rois])
+    roi_ix = tf.tile(tf.expand_dims(tf.range(num_rois), 0), [batch_size, 1])
+    deltas_specific = tf.gather_nd(
+        deltas, tf.stack([batch_ix, roi_ix, class_ids], axis=2))
+    # Apply bounding box deltas to the ROIs of the whole batch
+    # Shape: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+    refined_rois = apply_box_deltas_graph(
+        tf.reshape(rois, [-1, 4]),
+        tf.reshape(deltas_specific * config.BBOX_STD_DEV, [-1, 4]))
+    refined_rois = tf.reshape(refined_rois, [batch_size, num_rois, 4])
+    # Convert coordiates to image domain
+    height, width = config.IMAGE_SHAPE[:2]
+    refined_rois *= np.array([height, width, height, width], dtype=np.float32)
+    # Clip boxes to the window of each image
+    wy1, wx1, wy2, wx2 = tf.split(tf.expand_dims(window, 1), 4, axis=2)
+    y1, x1, y2, x2 = tf.split(refined_rois, 4, axis=2)
+    refined_rois = tf.concat([tf.maximum(tf.minimum(y1, wy2), wy1),
+                              tf.maximum(tf.minimum(x1, wx2), wx1),
+                              tf.maximum(tf.minimum(y2, wy2), wy1),
+                              tf.maximum(tf.minimum(x2, wx2), wx1)], axis=2)
+    # Round since we're deadling with pixels now (half to even, as np.rint)
+    refined_rois = tf.round(refined_rois)
+
+    # Filter out background and low confidence boxes
+    keep = class_ids > 0
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep = tf.logical_and(
+            keep, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+
+    # Offset the boxes of each class so that boxes of different classes never
+    # overlap: a single NMS on the offset boxes is then a per-class NMS. The
+    # coordinates are integers, so the offset boxes are exact in float32.
+    class_offset = float(max(height, width) + 1)
+    roi_count = config.DETECTION_MAX_INSTANCES
+
+    def nms_image(inputs):
+        rois, class_ids, scores, keep = inputs
+        ixs = tf.where(keep)[:, 0]
+        rois = tf.gather(rois, ixs)
+        class_ids = tf.gather(class_ids, ixs)
+        scores = tf.gather(scores, ixs)
+        offset = tf.expand_dims(tf.cast(class_ids, tf.float32) * class_offset, 1)
+        # Apply per-class NMS and keep the top detections, by descending score
+        nms_keep = tf.image.non_max_suppression(
+            rois + offset, scores, roi_count, config.DETECTION_NMS_THRESHOLD)
+        # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
+        detections = tf.concat([tf.gather(rois, nms_keep),
+                                tf.cast(tf.gather(class_ids, nms_keep), tf.float32)[:, tf.newaxis],
+                                tf.gather(scores, nms_keep)[:, tf.newaxis]], axis=1)
+        # Pad with zeros if detections < DETECTION_MAX_INSTANCES
+        gap = roi_count - tf.shape(detections)[0]
+        return tf.pad(detections, [(0, gap), (0, 0)])
+
+    # NMS is the only step that is run image by image
+    detections = tf.map_fn(nms_image, [refined_rois, class_ids, class_scores, keep],
+                           dtype=tf.float32)
+    return detections
+
+
 class DetectionLayer(KE.Layer):
     """Takes classified proposal boxes and their bounding box deltas and
-    returns the final detection boxes.
+    returns the final detection boxes. Runs in-graph (see
+    refine_detections_graph()), so the graph can be serialized.
 
     Returns:
-    [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
+    [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in pixels
     """
 
     def __init__(self, config=None, **kwargs):
@@ -768,29 +1004,12 @@ class DetectionLayer(KE.Layer):
         self.config = config
 
     def call(self, inputs):
-        def wrapper(rois, mrcnn_class, mrcnn_bbox, image_meta):
-            detections_batch = []
-            _, _, window, _ = parse_image_meta(image_meta)
-            for b in range(self.config.BATCH_SIZE):
-                detections = refine_detections(
-                    rois[b], mrcnn_class[b], mrcnn_bbox[b], window[b], self.config)
-                # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-                gap = self.config.DETECTION_MAX_INSTANCES - detections.shape[0]
-                assert gap >= 0
-                if gap > 0:
-                    detections = np.pad(
-                        detections, [(0, gap), (0, 0)], 'constant', constant_values=0)
-                detections_batch.append(detections)
-
-            # Stack detections and cast to float32
-            # TODO: track where float64 is introduced
-            detections_batch = np.array(detections_batch).astype(np.float32)
-            # Reshape output
-            # [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
-            return np.reshape(detections_batch, [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6])
-
-        # Return wrapped function
-        return tf.py_func(wrapper, inputs, tf.float32)
+        rois, mrcnn_class, mrcnn_bbox, image_meta = inputs
+        _, _, window, _ = parse_image_meta_graph(image_meta)
+        detections = refine_detections_graph(
+            rois, mrcnn_class, mrcnn_bbox, window, self.config)
+        # [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in pixels
+        return tf.reshape(detections, [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6])
 
     def compute_output_shape(self, input_shape):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6)
@@ -1298,6 +1517,104 @@ def load_image_gt(dataset, config, image_id, augment=False,
     return image, image_meta, class_ids, bbox, mask
 
 
+class MaskSizeStatistics(object):
+    """Per-process collector of instance mask sizes seen by the data generator.
+
+    Sizes are binned into a fixed log2 histogram held in memory, so recording
+    a sample costs the same however long training has run. The histogram is
+    written to <mask_size_dir>/<NAME>_<pid>.npz every flush_every samples;
+    each worker process owns its own file, so there are no write races.
+    Use load_mask_size_statistics() to merge the files of a run.
+    """
+    # Bin edges in pixels: [0, 1), [1, 2), [2, 4), ..., [2^19, 2^20), [2^20, inf)
+    BIN_EDGES = np.concatenate([[0], 2 ** np.arange(21)])
+
+    def __init__(self, mask_size_dir, name, flush_every = 100):
+        self.filename = os.path.join(mask_size_dir, ''.join((name, '_', str(os.getpid()), '.npz')))
+        self.flush_every = flush_every
+        self.instance_histogram = np.zeros(len(self.BIN_EDGES), dtype = np.int64)
+        self.sample_histogram = np.zeros(len(self.BIN_EDGES), dtype = np.int64)
+        self.n_samples = 0
+        self.n_instances = 0
+        self.sum_instance_size = 0
+        self.sum_sample_mean = 0.
+        self.n_pending = 0
+
+    def _bin(self, sizes):
+        return np.searchsorted(self.BIN_EDGES, sizes, side = 'right') - 1
+
+    def add(self, mask_sizes):
+        """Record the instance sizes (in pixels) of one sample."""
+        mask_sizes = np.asarray(mask_sizes)
+        if mask_sizes.size > 0:
+            self.instance_histogram += np.bincount(self._bin(mask_sizes), minlength = len(self.BIN_EDGES))
+            sample_mean = np.mean(mask_sizes)
+            self.sample_histogram[self._bin(sample_mean)] += 1
+            self.n_instances += mask_sizes.size
+            self.sum_instance_size += int(np.sum(mask_sizes))
+            self.sum_sample_mean += sample_mean
+            self.n_samples += 1
+
+        self.n_pending += 1
+        if self.n_pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Write to a temporary file and rename so a reader never sees a partial file
+        tmp_filename = ''.join((self.filename, '.tmp.npz'))
+        np.savez(tmp_filename,
+                 bin_edges = self.BIN_EDGES,
+                 instance_histogram = self.instance_histogram,
+                 sample_histogram = self.sample_histogram,
+                 n_samples = self.n_samples,
+                 n_instances = self.n_instances,
+                 sum_instance_size = self.sum_instance_size,
+                 sum_sample_mean = self.sum_sample_mean)
+        os.replace(tmp_filename, self.filename)
+        self.n_pending = 0
+
+
+# One collector per (process, config name); worker processes are forked,
+# so the pid is part of the key
+_mask_size_statistics = {}
+
+
+def get_mask_size_statistics(config):
+    """Return this process's MaskSizeStatistics for config, or None if
+    config.mask_size_dir is not set.
+    """
+    if getattr(config, 'mask_size_dir', None) is None:
+        return None
+    key = (os.getpid(), config.NAME)
+    if key not in _mask_size_statistics:
+        statistics = MaskSizeStatistics(config.mask_size_dir, config.NAME)
+        atexit.register(statistics.flush)
+        _mask_size_statistics[key] = statistics
+    return _mask_size_statistics[key]
+
+
+def load_mask_size_statistics(mask_size_dir, name):
+    """Merge the per-process mask size files written for the config NAME.
+    Returns a dict of summed histograms and counts, with the mean instance
+    size and mean per-sample size.
+    """
+    statistics = {'instance_histogram': 0, 'sample_histogram': 0,
+                  'n_samples': 0, 'n_instances': 0,
+                  'sum_instance_size': 0, 'sum_sample_mean': 0.}
+    filenames = glob.glob(os.path.join(mask_size_dir, ''.join((glob.escape(name), '_*.npz'))))
+    for filename in filenames:
+        if filename.endswith('.tmp.npz'):
+            continue
+        with np.load(filename) as data:
+            statistics['bin_edges'] = data['bin_edges']
+            for key in ['instance_histogram', 'sample_histogram', 'n_samples', 'n_instances',
+                        'sum_instance_size', 'sum_sample_mean']:
+                statistics[key] = statistics[key] + data[key]
+    statistics['mean_instance_size'] = statistics['sum_instance_size'] / max(1, statistics['n_instances'])
+    statistics['mean_sample_size'] = statistics['sum_sample_mean'] / max(1, statistics['n_samples'])
+    return statistics
+
+
 def load_image_gt_augment(dataset, config, image_id, augment=False,
                   use_mini_mask=False, include_semantic=False):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
@@ -1316,138 +1633,138 @@ def load_image_gt_augment(dataset, config, image_id, augment=False,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
+    # Load image and instance labels
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    labels, class_ids = dataset.load_labels(image_id)
 
     # Random augmentation
     if augment:
-        # Random crop
-        if np.random.random() < config.augmentation_crop:
-            if np.all(np.array(image.shape[:2]) > 256):
-                image, mask = random_crop(image, mask, 
-                                        (np.random.randint(256, min(512, image.shape[0])), np.random.randint(256, min(512, image.shape[1]))), 2)
-            elif np.all(np.array(image.shape[:2]) > 220):
-                image, mask = random_crop(image, mask, 
-                                        (np.random.randint(220, min(256, image.shape[0])), np.random.randint(220, min(256, image.shape[1]))), 2)
+        image, labels = random_crop_gt(dataset, config, image_id, image, labels)
         # Random transform
-        aug = XY_ImageDataGenerator(**config.augmentation_dict)
-        image, mask = aug.random_transform(image, mask)
-        # Remove any blank masks after random transform
-        valid = np.sum(mask, axis = (0, 1)) > 0
-        mask = mask[:, :, valid]
-        class_ids = class_ids[valid]
+        aug = get_augmenter(config)
+        image, labels = aug.random_transform_labels(image, labels)
 
-    shape = image.shape
-    image, window, scale, padding = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        max_dim=config.IMAGE_MAX_DIM,
-        padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    return load_image_gt_from_labels(dataset, config, image_id, image, labels, class_ids,
+                                     use_mini_mask = use_mini_mask, include_semantic = include_semantic)
 
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
 
-    # BBoxes may have become invalidated through resizing or augmenting
-    # Check for valid masks and remove any invalid
-    valid = check_valid_bbox(bbox)
-    mask = mask[:, :, valid]
-    bbox = bbox[valid]
-    class_ids = class_ids[valid]
+def load_image_gt_augment_nsb(dataset, config, image_id, augment=False,
+                  use_mini_mask=False, include_semantic=False):
+    # Load image and instance labels
+    image = dataset.load_image(image_id)
+    labels, class_ids = dataset.load_labels(image_id)
 
-    # Store off avg mask-instance size in pixels
-    if config.mask_size_filename is not None:
-        # Putting this in a try-except in case of lock conflicts if multiprocessing
-        try:
-            mask_sizes = np.load(config.mask_size_filename)
-            np.save(config.mask_size_filename, np.append(mask_sizes, np.mean(np.sum(mask, axis = (0, 1)))))
-        except:
-            pass
+    # Random augmentation
+    if augment:
+        image, labels = random_crop_gt_nsb(dataset, config, image_id, image, labels)
+        # Random transform
+        aug = get_augmenter(config)
+        image, labels = aug.random_transform_labels(image, labels)
+
+    return load_image_gt_from_labels(dataset, config, image_id, image, labels, class_ids,
+                                     use_mini_mask = use_mini_mask, include_semantic = include_semantic)
+
+
+def random_crop_gt(dataset, config, image_id, image, labels):
+    """Random crop policy of load_image_gt_augment"""
+    if np.random.random() < config.augmentation_crop:
+        if np.all(np.array(image.shape[:2]) > 256):
+            image, labels = random_crop(image, labels, 
+                                    (np.random.randint(256, min(512, image.shape[0])), np.random.randint(256, min(512, image.shape[1]))), 2)
+        elif np.all(np.array(image.shape[:2]) > 220):
+            image, labels = random_crop(image, labels, 
+                                    (np.random.randint(220, min(256, image.shape[0])), np.random.randint(220, min(256, image.shape[1]))), 2)
+    return image, labels
+
+
+def random_crop_gt_nsb(dataset, config, image_id, image, labels):
+    """Random crop policy of load_image_gt_augment_nsb: nsb images are always cropped"""
+    if 'nsb' in dataset.image_info[image_id]['path'].lower():
+        image, labels = random_crop(image, labels, 
+                                    (np.random.randint(256, min(680, image.shape[0])), np.random.randint(256, min(680, image.shape[1]))), 2)
+    else:
+        image, labels = random_crop_gt(dataset, config, image_id, image, labels)
+    return image, labels
 
-    # Active classes
-    # Different datasets have different classes, so track the
-    # classes supported in the dataset of this image.
-    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
-    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
-    active_class_ids[source_class_ids] = 1
 
-    if include_semantic:
-        semantic_mask = np.expand_dims((np.sum(mask, axis = -1) > 0).astype(np.int), -1)
+# Crop policy of each label based loader, used by load_image_gt_batch
+LOADER_CROP_FUNCTIONS = {'load_image_gt_augment': random_crop_gt,
+                         'load_image_gt_augment_nsb': random_crop_gt_nsb}
 
-    # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
-    # Image meta data
-    image_meta = compose_image_meta(image_id, shape, window, active_class_ids)
+def load_image_gt_batch(dataset, config, image_ids, augment=False,
+                        use_mini_mask=False, include_semantic=False):
+    """Batched version of the config.fn_load loader (load_image_gt_augment or
+    load_image_gt_augment_nsb). The images are loaded and cropped one by one,
+    then augmented together by XY_BatchImageDataGenerator.
 
-    if include_semantic:
-        output = image, image_meta, class_ids, bbox, mask, semantic_mask
-    else:
-        output = image, image_meta, class_ids, bbox, mask
+    Returns a list with the outputs of config.fn_load for each image id.
+    """
+    crop_fn = LOADER_CROP_FUNCTIONS[config.fn_load]
 
-    return output
+    images, labels, class_ids = [], [], []
+    for image_id in image_ids:
+        image = dataset.load_image(image_id)
+        _labels, _class_ids = dataset.load_labels(image_id)
+        if augment:
+            image, _labels = crop_fn(dataset, config, image_id, image, _labels)
+        images.append(image)
+        labels.append(_labels)
+        class_ids.append(_class_ids)
 
+    if augment:
+        images, labels = get_augmenter(config).random_transform_labels_batch(images, labels)
 
-def load_image_gt_augment_nsb(dataset, config, image_id, augment=False,
-                  use_mini_mask=False, include_semantic=False):
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    return [load_image_gt_from_labels(dataset, config, image_id, image, _labels, _class_ids,
+                                      use_mini_mask = use_mini_mask, include_semantic = include_semantic)
+            for image_id, image, _labels, _class_ids in zip(image_ids, images, labels, class_ids)]
+
+
+# One augmenter per augmentation_dict, rather than one per sample
+_augmenters = {}
 
-    # Random augmentation
-    if augment:
-        if 'nsb' in dataset.image_info[image_id]['path'].lower():
-            image, mask = random_crop(image, mask, 
-                                        (np.random.randint(256, min(680, image.shape[0])), np.random.randint(256, min(680, image.shape[1]))), 2)
-        else:
-            # Random crop
-            if np.random.random() < config.augmentation_crop:
-                if np.all(np.array(image.shape[:2]) > 256):
-                    image, mask = random_crop(image, mask, 
-                                            (np.random.randint(256, min(512, image.shape[0])), np.random.randint(256, min(512, image.shape[1]))), 2)
-                elif np.all(np.array(image.shape[:2]) > 220):
-                    image, mask = random_crop(image, mask, 
-                                            (np.random.randint(220, min(256, image.shape[0])), np.random.randint(220, min(256, image.shape[1]))), 2)
-        # Random transform
-        aug = XY_ImageDataGenerator(**config.augmentation_dict)
-        image, mask = aug.random_transform(image, mask)
-        # Remove any blank masks after random transform
-        valid = np.sum(mask, axis = (0, 1)) > 0
-        mask = mask[:, :, valid]
-        class_ids = class_ids[valid]
 
+def get_augmenter(config):
+    """Return the XY_BatchImageDataGenerator built from config.augmentation_dict.
+    It is created once and shared by every sample using the same settings.
+    """
+    key = repr(sorted(config.augmentation_dict.items()))
+    if key not in _augmenters:
+        _augmenters[key] = XY_BatchImageDataGenerator(**config.augmentation_dict)
+    return _augmenters[key]
+
+
+def load_image_gt_from_labels(dataset, config, image_id, image, labels, class_ids,
+                              use_mini_mask=False, include_semantic=False):
+    """Shared tail of the load_image_gt_augment* loaders: resizes the (cropped and
+    augmented) image and its label image [height, width] and builds the ground
+    truth. Instances stay in label form until the masks are minimised, so the
+    full [height, width, instance_count] stack is only built if use_mini_mask
+    is False. Returns the same outputs as load_image_gt_augment.
+    """
     shape = image.shape
     image, window, scale, padding = utils.resize_image(
         image,
         min_dim=config.IMAGE_MIN_DIM,
         max_dim=config.IMAGE_MAX_DIM,
         padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    labels = utils.resize_labels(labels, scale, padding)
 
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    bbox = utils.extract_bboxes_from_labels(labels, len(class_ids))
 
     # BBoxes may have become invalidated through resizing or augmenting
-    # Check for valid masks and remove any invalid
+    # Check for valid masks and remove any invalid, renumbering the labels
     valid = check_valid_bbox(bbox)
-    mask = mask[:, :, valid]
+    labels, class_ids = utils.compact_labels(labels, class_ids, valid)
     bbox = bbox[valid]
-    class_ids = class_ids[valid]
 
-    # Store off avg mask-instance size in pixels
-    if config.mask_size_filename is not None:
-        # Putting this in a try-except in case of lock conflicts if multiprocessing
-        try:
-            mask_sizes = np.load(config.mask_size_filename)
-            np.save(config.mask_size_filename, np.append(mask_sizes, np.mean(np.sum(mask, axis = (0, 1)))))
-        except:
-            pass
+    # Store off mask-instance sizes in pixels
+    mask_size_statistics = get_mask_size_statistics(config)
+    if mask_size_statistics is not None:
+        mask_size_statistics.add(np.bincount(labels.ravel(), minlength = len(class_ids) + 1)[1:len(class_ids) + 1])
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1457,11 +1774,13 @@ def load_image_gt_augment_nsb(dataset, config, image_id, augment=False,
     active_class_ids[source_class_ids] = 1
 
     if include_semantic:
-        semantic_mask = np.expand_dims((np.sum(mask, axis = -1) > 0).astype(np.int), -1)
+        semantic_mask = np.expand_dims((labels > 0).astype(np.int), -1)
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        mask = utils.minimize_mask_from_labels(bbox, labels, config.MINI_MASK_SHAPE)
+    else:
+        mask = utils.labels_to_masks(labels, len(class_ids))
 
     # Image meta data
     image_meta = compose_image_meta(image_id, shape, window, active_class_ids)
@@ -1894,36 +2213,52 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                                              config.BACKBONE_STRIDES,
                                              config.RPN_ANCHOR_STRIDE)
 
+    def next_image_id():
+        nonlocal image_index
+        # Increment index to pick next image. Shuffle if at the start of an epoch.
+        if not balance_by_cluster_id:
+            image_index = (image_index + 1) % len(image_ids)
+        
+            if shuffle and image_index == 0:
+                np.random.shuffle(image_ids)
+
+            return image_ids[image_index]
+        
+        else:
+            random_cluster_id = random.choice(unique_cluster_ids)
+
+            if len(running_lists_of_cluster_ids_to_image_id[random_cluster_id]) == 0:
+                running_lists_of_cluster_ids_to_image_id[random_cluster_id] = copy.copy(cluster_ids_to_image_id[random_cluster_id])
+                random.shuffle(running_lists_of_cluster_ids_to_image_id[random_cluster_id])
+            
+            return running_lists_of_cluster_ids_to_image_id[random_cluster_id].pop()
+
+    # With config.augmentation_batch, a batch of images is loaded and augmented
+    # together (see load_image_gt_batch) and then consumed one at a time below
+    batch_augment = augment and getattr(config, 'augmentation_batch', False)
+    loaded_gt = deque()
+
     # Keras requires a generator to run indefinately.
     while True:
         try:
-            # Increment index to pick next image. Shuffle if at the start of an epoch.
-            if not balance_by_cluster_id:
-                image_index = (image_index + 1) % len(image_ids)
-            
-                if shuffle and image_index == 0:
-                    np.random.shuffle(image_ids)
-
-                # Get GT bounding boxes and masks for image.
-                image_id = image_ids[image_index]
-            
+            # Get GT bounding boxes and masks for image.
+            if batch_augment:
+                if len(loaded_gt) == 0:
+                    batch_image_ids = [next_image_id() for _ in range(batch_size)]
+                    image_id = batch_image_ids[0]
+                    loaded_gt.extend(zip(batch_image_ids, 
+                                         load_image_gt_batch(dataset, config, batch_image_ids, augment=augment,
+                                                             use_mini_mask=config.USE_MINI_MASK, include_semantic = include_semantic)))
+                image_id, gt = loaded_gt.popleft()
             else:
-                random_cluster_id = random.choice(unique_cluster_ids)
-
-                if len(running_lists_of_cluster_ids_to_image_id[random_cluster_id]) == 0:
-                    running_lists_of_cluster_ids_to_image_id[random_cluster_id] = copy.copy(cluster_ids_to_image_id[random_cluster_id])
-                    random.shuffle(running_lists_of_cluster_ids_to_image_id[random_cluster_id])
-                
-                image_id = running_lists_of_cluster_ids_to_image_id[random_cluster_id].pop()
+                image_id = next_image_id()
+                gt = globals()[config.fn_load](dataset, config, image_id, augment=augment,
+                                               use_mini_mask=config.USE_MINI_MASK, include_semantic = include_semantic)
 
             if include_semantic:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks, gt_semantic = \
-                    globals()[config.fn_load](dataset, config, image_id, augment=augment,
-                                  use_mini_mask=config.USE_MINI_MASK, include_semantic = include_semantic)
+                image, image_meta, gt_class_ids, gt_boxes, gt_masks, gt_semantic = gt
             else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    globals()[config.fn_load](dataset, config, image_id, augment=augment,
-                                  use_mini_mask=config.USE_MINI_MASK, include_semantic = include_semantic)
+                image, image_meta, gt_class_ids, gt_boxes, gt_masks = gt
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
@@ -2642,6 +2977,8 @@ class MaskRCNN():
         as an input to the neural network.
         images: List of image matricies [height,width,depth]. Images can have
             different sizes.
+        mask_scale: None, or a list of len(images) scales for resize_image_scaled().
+            A None entry uses the normal resize for that image.
 
         Returns 3 Numpy matricies:
         molded_images: [N, h, w, 3]. Images resized and normalized.
@@ -2655,7 +2992,7 @@ class MaskRCNN():
         for i, image in enumerate(images):
             # Resize image to fit the model expected size
             # TODO: move resizing to mold_image()
-            if mask_scale is None:
+            if mask_scale is None or mask_scale[i] is None:
                 molded_image, window, scale, padding = utils.resize_image(
                     image,
                     min_dim=self.config.IMAGE_MIN_DIM,
@@ -2682,10 +3019,9 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
-    def unmold_detections(self, detections, mrcnn_mask, image_shape, window):
-        """Reformats the detections of one image from the format of the neural
-        network output to a format suitable for use in the rest of the
-        application.
+    def unmold_boxes(self, detections, mrcnn_mask, image_shape, window):
+        """Translates the detections of one image to the image domain, leaving
+        the masks as the small (typically 28x28) float masks of the network.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)]
         mrcnn_mask: [N, height, width, num_classes]
@@ -2697,7 +3033,7 @@ class MaskRCNN():
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [N, height, width] Float masks of the class_id, relative to the boxes
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2730,7 +3066,28 @@ class MaskRCNN():
             class_ids = np.delete(class_ids, exclude_ix, axis=0)
             scores = np.delete(scores, exclude_ix, axis=0)
             masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
+
+        return boxes, class_ids, scores, masks
+
+    def unmold_detections(self, detections, mrcnn_mask, image_shape, window):
+        """Reformats the detections of one image from the format of the neural
+        network output to a format suitable for use in the rest of the
+        application.
+
+        detections: [N, (y1, x1, y2, x2, class_id, score)]
+        mrcnn_mask: [N, height, width, num_classes]
+        image_shape: [height, width, depth] Original size of the image before resizing
+        window: [y1, x1, y2, x2] Box in the image where the real image is
+                excluding the padding.
+
+        Returns:
+        boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
+        class_ids: [N] Integer class IDs for each bounding box
+        scores: [N] Float probability scores of the class_id
+        masks: [height, width, num_instances] Instance masks
+        """
+        boxes, class_ids, scores, masks = self.unmold_boxes(detections, mrcnn_mask, image_shape, window)
+        N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
         full_masks = []
@@ -2743,16 +3100,19 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0, mask_scale = None):
+    def detect(self, images, verbose=0, mask_scale = None, unmold_masks = True):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
         mask_scale: List of len(images). Allows you to resize images to a given scale if provided.
+        unmold_masks: if False, the masks are returned as the float masks of the network
+            (mask_crops) rather than being pasted into full size masks
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (if unmold_masks)
+        mask_crops: [N, h, w] float masks relative to rois (if not unmold_masks)
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2774,6 +3134,17 @@ class MaskRCNN():
         # Process detections
         results = []
         for i, image in enumerate(images):
+            if not unmold_masks:
+                final_rois, final_class_ids, final_scores, final_mask_crops =\
+                    self.unmold_boxes(detections[i], mrcnn_mask[i],
+                                      image.shape, windows[i])
+                results.append({
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "mask_crops": final_mask_crops,
+                })
+                continue
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, windows[i])
@@ -3157,16 +3528,20 @@ class SemanticMaskRCNN(MaskRCNN):
             self.keras_model.metrics_tensors.append(tf.reduce_mean(
                 layer.output, keep_dims=True))
 
-    def detect(self, images, verbose=0, mask_scale = None, expand_semantic = False):
+    def detect(self, images, verbose=0, mask_scale = None, unmold_masks = True):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
         mask_scale: List of len(images). Allows you to resize images to a given scale if provided.
+        unmold_masks: if False, the masks are returned as the float masks of the network
+            (mask_crops) rather than being pasted into full size masks
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (if unmold_masks)
+        mask_crops: [N, h, w] float masks relative to rois (if not unmold_masks)
+        semantic_masks: [H, W] semantic mask, shared by the instances of the image
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -3188,6 +3563,19 @@ class SemanticMaskRCNN(MaskRCNN):
         # Process detections
         results = []
         for i, image in enumerate(images):
+            if not unmold_masks:
+                final_rois, final_class_ids, final_scores, final_mask_crops =\
+                    self.unmold_boxes(detections[i], mrcnn_mask[i],
+                                      image.shape, windows[i])
+                final_semantic_masks = np.squeeze(self.unmold_maskrcnn_mask(semantic_mask[i], image.shape, windows[i]))
+                results.append({
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "mask_crops": final_mask_crops,
+                    "semantic_masks": final_semantic_masks
+                })
+                continue
             final_rois, final_class_ids, final_scores, final_masks, final_semantic_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i], semantic_mask[i],
                                        image.shape, windows[i])
@@ -3196,7 +3584,7 @@ class SemanticMaskRCNN(MaskRCNN):
                 "class_ids": final_class_ids,
                 "scores": final_scores,
                 "masks": final_masks,
-                "semantic_masks": np.stack([final_semantic_masks] * max(1, final_masks.shape[-1]), axis = -1) if expand_semantic else final_semantic_masks
+                "semantic_masks": final_semantic_masks
             })
         return results
 
@@ -3217,39 +3605,9 @@ class SemanticMaskRCNN(MaskRCNN):
         scores: [N] Float probability scores of the class_id
         masks: [height, width, num_instances] Instance masks
         """
-        # How many detections do we have?
-        # Detections array is padded with zeros. Find the first class_id == 0.
-        zero_ix = np.where(detections[:, 4] == 0)[0]
-        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
-
-        # Extract boxes, class_ids, scores, and class-specific masks
-        boxes = detections[:N, :4]
-        class_ids = detections[:N, 4].astype(np.int32)
-        scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
-        
-        # Compute scale and shift to translate coordinates to image domain.
-        h_scale = image_shape[0] / (window[2] - window[0])
-        w_scale = image_shape[1] / (window[3] - window[1])
-        scale = min(h_scale, w_scale)
-        shift = window[:2]  # y, x
-        scales = np.array([scale, scale, scale, scale])
-        shifts = np.array([shift[0], shift[1], shift[0], shift[1]])
-
-        # Translate bounding boxes to image domain
-        boxes = np.multiply(boxes - shifts, scales).astype(np.int32)
-
-        # Filter out detections with zero area. Often only happens in early
-        # stages of training when the network weights are still a bit random.
-        # NB: semantic masks are not included in this screening
-        exclude_ix = np.where(
-            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
-        if exclude_ix.shape[0] > 0:
-            boxes = np.delete(boxes, exclude_ix, axis=0)
-            class_ids = np.delete(class_ids, exclude_ix, axis=0)
-            scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
-            N = class_ids.shape[0]
+        # NB: semantic masks are not included in the zero area screening
+        boxes, class_ids, scores, masks = self.unmold_boxes(detections, mrcnn_mask, image_shape, window)
+        N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
         full_masks = []
@@ -3484,6 +3842,40 @@ def random_crop(x, y, random_crop_size, channel_axis):
             
     return x, y
 
+# scipy.ndimage / keras fill modes -> OpenCV border modes
+CV2_BORDER_MODES = {'constant': cv2.BORDER_CONSTANT,
+                    'nearest': cv2.BORDER_REPLICATE,
+                    'reflect': cv2.BORDER_REFLECT,
+                    'mirror': cv2.BORDER_REFLECT_101,
+                    'wrap': cv2.BORDER_WRAP}
+
+def warp_affine(x, transform_matrix, output_shape, channel_axis, interpolation, fill_mode = 'nearest', cval = 0.):
+    """
+    Warp a single image with one cv2.warpAffine call.
+    transform_matrix: [3, 3] matrix mapping output (row, col) coordinates to input (row, col)
+        coordinates, as used by keras' apply_transform.
+    output_shape: (rows, cols) of the warped image
+    interpolation: cv2 interpolation flag, cv2.INTER_NEAREST preserves label values
+    """
+    # OpenCV works in (col, row) coordinates
+    swap = np.array([[0, 1, 0],
+                     [1, 0, 0],
+                     [0, 0, 1]])
+    matrix = np.dot(np.dot(swap, transform_matrix), swap)[:2]
+
+    x = np.moveaxis(x, channel_axis, -1)
+    n_channels = x.shape[-1]
+    if channel_axis != x.ndim - 1:
+        x = np.ascontiguousarray(x)
+
+    x = cv2.warpAffine(x, matrix, (output_shape[1], output_shape[0]),
+                       flags = interpolation | cv2.WARP_INVERSE_MAP,
+                       borderMode = CV2_BORDER_MODES[fill_mode], borderValue = cval)
+
+    # cv2 drops single channel axes
+    x = x.reshape(tuple(output_shape) + (n_channels,))
+    return np.moveaxis(x, -1, channel_axis)
+
 class XY_ImageDataGenerator(object):
     '''
     Extension of Keras' ImageDataGenerator to apply transforms to both X and Y masks.
@@ -3605,18 +3997,81 @@ class XY_ImageDataGenerator(object):
             return x
 
     def random_transform(self, x, y = None):
+        """
+        Apply the same random transform to x and to the masks y ([H, W, N], or a list of them).
+        Masks are collapsed to a label image via generate_labels(), transformed, and expanded
+        back to bool masks via labels_to_mask().
+        """
         # x is a single image, so it doesn't have image number at index 0
         img_row_index = self.row_index - 1
         img_col_index = self.col_index - 1
         img_channel_index = self.channel_index - 1
 
-        # Store copies of the originals so that if augmentations lead to masks being zero completely, 
-        # we revert back to the originals (to avoid nan in loss)
-        orig_y = y.copy()
-        orig_x = x.copy()
+        if y is None:
+            x, _ = self.transform_labels(x, None)
+            return x, None
 
-        if y is not None:
-            y, original_y_shape, reshape_required = self.reshape_y(y, x.shape, img_row_index, img_col_index, img_channel_index)
+        # Keep references to the originals so that if augmentations lead to masks being zero completely, 
+        # we revert back to the originals (to avoid nan in loss). No copy is needed as transform_labels()
+        # never modifies its inputs in place
+        orig_y = y
+        orig_x = x
+
+        y, original_y_shape, reshape_required = self.reshape_y(y, x.shape, img_row_index, img_col_index, img_channel_index)
+
+        x, y = self.transform_labels(x, y)
+
+        # If any masks have been completely zeroed, then revert back to original to avoid nans
+        if not all([np.any(_y > 0) for _y in y]):
+            return orig_x, orig_y
+
+        y = self.revert_y_shapes(y, original_y_shape, reshape_required, img_channel_index)
+        if isinstance(y, list) and len(y) == 1:
+            y = y[0]
+
+        return x, y
+
+    def random_transform_labels(self, x, labels):
+        """
+        Label image fast path of random_transform(): labels is an int16/int32 label image
+        [H, W] (or with a channel axis of size 1), see utils.masks_to_labels(). It is
+        transformed directly, without expanding to one mask per instance.
+        Returns x and labels, reverting to the inputs if every instance is transformed away.
+        """
+        img_channel_index = self.channel_index - 1
+
+        # Keep references to the originals so that if augmentations lead to masks being zero completely, 
+        # we revert back to the originals (to avoid nan in loss). No copy is needed as transform_labels()
+        # never modifies its inputs in place
+        orig_labels = labels
+        orig_x = x
+
+        squeeze = labels.ndim == 2
+        y = np.expand_dims(labels, img_channel_index) if squeeze else labels
+
+        x, y = self.transform_labels(x, [y])
+        y = y[0]
+
+        if not np.any(y > 0):
+            return orig_x, orig_labels
+
+        if squeeze:
+            y = np.squeeze(y, img_channel_index)
+
+        return x, y
+
+    def transform_labels(self, x, y):
+        """
+        Apply a random transform to x and to y, a list of label images (or None).
+        Label images have a channel axis of size 1 and are transformed with nearest
+        interpolation so that label values are preserved.
+        x and y are never modified in place: every op returns a new array (or x/y
+        themselves when it is skipped), so callers can roll back to their inputs.
+        """
+        # x is a single image, so it doesn't have image number at index 0
+        img_row_index = self.row_index - 1
+        img_col_index = self.col_index - 1
+        img_channel_index = self.channel_index - 1
 
         # use composition of homographies to generate final transform that needs to be applied
         if self.rotation_range:
@@ -3657,40 +4112,48 @@ class XY_ImageDataGenerator(object):
 
         transform_matrix = np.dot(np.dot(np.dot(rotation_matrix, translation_matrix), shear_matrix), zoom_matrix)
 
+        # Every geometric op is composed into transform_matrix, which maps output (row, col)
+        # coordinates to input coordinates, so x and each y are warped at most once
         h, w = x.shape[img_row_index], x.shape[img_col_index]
-        transform_matrix = transform_matrix_offset_center(transform_matrix, h, w)
-        x = apply_transform(x, transform_matrix, img_channel_index,
-                            fill_mode=self.fill_mode, cval = 0)
-        
-        if y is not None:
-            y = [apply_transform(_y, transform_matrix, img_channel_index,
-                                    fill_mode=self.fill_mode, cval = 0) for _y in y]
-
-        if self.channel_shift_range != 0:
-            x = random_channel_shift(x, self.channel_shift_range, img_channel_index)
+        if np.allclose(transform_matrix, np.eye(3)):
+            transform_matrix = np.eye(3)
+        else:
+            transform_matrix = transform_matrix_offset_center(transform_matrix, h, w)
 
         if self.horizontal_flip:
             if np.random.random() < 0.5:
-                x = flip_axis(x, img_col_index)
-                if y is not None:
-                    y = [flip_axis(_y, img_col_index) for _y in y]
+                transform_matrix = np.dot(transform_matrix, np.array([[1, 0, 0],
+                                                                      [0, -1, w - 1],
+                                                                      [0, 0, 1]]))
 
         if self.vertical_flip:
             if np.random.random() < 0.5:
-                x = flip_axis(x, img_row_index)
-                if y is not None:
-                    y = [flip_axis(_y, img_row_index) for _y in y]
+                transform_matrix = np.dot(transform_matrix, np.array([[-1, 0, h - 1],
+                                                                      [0, 1, 0],
+                                                                      [0, 0, 1]]))
 
         if self.rots:
             rot90_times = np.random.randint(0,4)
-            if rot90_times > 0:
-                x = np.rot90(x, rot90_times, (0,1))
-                if y is not None:
-                    y = [np.rot90(_y, rot90_times, (0,1)) for _y in y]
+            for _ in range(rot90_times):
+                # np.rot90: out[i, j] = in[j, w - 1 - i], and the output shape is (w, h)
+                transform_matrix = np.dot(transform_matrix, np.array([[0, 1, 0],
+                                                                      [-1, 0, w - 1],
+                                                                      [0, 0, 1]]))
+                h, w = w, h
 
         if self.random_crop_shape:
             if np.random.random() < 0.5:
-                x, y = self.random_crop(x, y, self.random_crop_shape, img_channel_index)
+                transform_matrix = np.dot(transform_matrix, self.crop_matrix(h, w, self.random_crop_shape))
+
+        if not np.allclose(transform_matrix, np.eye(3)):
+            x = warp_affine(x, transform_matrix, (h, w), img_channel_index, cv2.INTER_LINEAR,
+                            fill_mode = self.fill_mode, cval = 0)
+            if y is not None:
+                y = [warp_affine(_y, transform_matrix, (h, w), img_channel_index, cv2.INTER_NEAREST,
+                                 fill_mode = self.fill_mode, cval = 0) for _y in y]
+
+        if self.channel_shift_range != 0:
+            x = random_channel_shift(x, self.channel_shift_range, img_channel_index)
 
         if self.contrast_stretching: 
             if np.random.random() < 0.5: 
@@ -3709,7 +4172,8 @@ class XY_ImageDataGenerator(object):
             if np.random.random() < 0.5: 
                 sigma = np.random.uniform(self.gaussian_blur[0], self.gaussian_blur[1])
                 x = ndimage.filters.gaussian_filter(x, sigma = sigma)
-                y = [ndimage.filters.gaussian_filter(_y, sigma = sigma) for _y in y]
+                if y is not None:
+                    y = [ndimage.filters.gaussian_filter(_y, sigma = sigma) for _y in y]
 
         if self.random_invert:
             if np.random.random() < 0.5:
@@ -3723,15 +4187,6 @@ class XY_ImageDataGenerator(object):
                 sigma = np.random.uniform(self.y_gaussian_blur[0], self.y_gaussian_blur[1])
                 y = [ndimage.filters.gaussian_filter(_y, sigma = sigma) for _y in y]
 
-        if y is not None:
-            y = self.revert_y_shapes(y, original_y_shape, reshape_required, img_channel_index)
-            # If any masks have been completely zeroed, then revert back to original to avoid nans
-            if not all([np.max(np.sum(_y, axis = -1)) == 1 if required else np.max(_y) == 1 for _y, required in zip(y, reshape_required)]):
-                x = orig_x
-                y = orig_y
-            if isinstance(y, list) and len(y) == 1:
-                y = y[0]           
-
         return x, y
 
     def reshape_y(self, y, x_shape, img_row_index, img_col_index, img_channel_index):
@@ -3793,70 +4248,46 @@ class XY_ImageDataGenerator(object):
 
         return y
 
-    def random_crop(self, x, y, random_crop_size, channel_axis):
-    
-        channels_first = channel_axis == 0
-
-        if channels_first:
-            x = np.moveaxis(x, channel_axis, -1)
-            y = [np.moveaxis(_y, channel_axis, -1) for _y in y]
-            
-        w, h = x.shape[0], x.shape[1]
-        if (w, h) != random_crop_size:
-
-            rangew = (w - random_crop_size[0]) // 2
-            rangeh = (h - random_crop_size[1]) // 2
-            offsetw = 0 if rangew == 0 else np.random.randint(rangew)
-            offseth = 0 if rangeh == 0 else np.random.randint(rangeh)
-
-            x = resize_img(x[offsetw:offsetw+random_crop_size[0], offseth:offseth+random_crop_size[1]], w, h)
-
-            if y is not None:
-                y = [self.crop_y(_y, offsetw, offseth, w, h, random_crop_size) for _y in y]
-
-        if channels_first:
-            x = np.moveaxis(x, -1, channel_axis)
-            if y is not None:
-                y = [np.moveaxis(_y, -1, channel_axis) for _y in y]
-            
-        return x, y
-
-    def crop_y(self, y, offsetw, offseth, w, h, random_crop_size):
+    def crop_matrix(self, h, w, random_crop_size):
         """
-        Use ndimage.zoom with order = 0 for nearest interpolation: preserve distinct values in y
+        Transform matrix for a random crop of random_crop_size (rows, cols) resized back up to (h, w).
+        The resize matches ndimage.zoom, mapping the corner pixels of the crop onto the corners of the output.
         """
-        y_shape = y.shape
-        y = ndimage.zoom(y[offsetw:offsetw+random_crop_size[0], offseth:offseth+random_crop_size[1], 0], 
-                         (w / random_crop_size[0], h / random_crop_size[1]), order = 0).reshape(y_shape)
-        
-        return y
+        if (h, w) == tuple(random_crop_size):
+            return np.eye(3)
+
+        rangew = (h - random_crop_size[0]) // 2
+        rangeh = (w - random_crop_size[1]) // 2
+        offsetw = 0 if rangew == 0 else np.random.randint(rangew)
+        offseth = 0 if rangeh == 0 else np.random.randint(rangeh)
+
+        return np.array([[(random_crop_size[0] - 1) / max(1, h - 1), 0, offsetw],
+                         [0, (random_crop_size[1] - 1) / max(1, w - 1), offseth],
+                         [0, 0, 1]])
 
     def generate_labels(self, masks, channels_first):
         """
-        Generate labels from multiple masks
+        Generate labels from multiple masks (see utils.masks_to_labels)
         In the case of overlaps the last mask is assigned the winner.
         """
         if channels_first:
-            masks = list(masks)
-        else:
-            masks = list(np.moveaxis(masks, -1, 0))
+            masks = np.moveaxis(masks, 0, -1)
 
-        mask_shape = masks[0].shape
-
-        labels = np.zeros(mask_shape, dtype = np.int)
-        for i, mask in enumerate(masks):
-            labels[mask > 0] = (i + 1)
+        labels = utils.masks_to_labels(masks)
 
         labels = labels.reshape((1,) + labels.shape) if channels_first else labels.reshape(labels.shape + (1,))
 
         return labels
 
     def labels_to_mask(self, lab_img, max_masks, channels_first):
-        # NB: stack as type uint8 as numpy cannot allocate the array in place, so leaves a 
-        # large memory footprint in cases where max_masks is very large
-        mask = [(np.squeeze(lab_img) == i).astype(np.uint8) for i in range(1, max_masks + 1)]
-        mask = np.stack(mask, axis = 0 if channels_first else -1)
-        return mask.astype(np.int)
+        """
+        Expand labels back to max_masks bool masks in a single broadcast comparison
+        (see utils.labels_to_masks)
+        """
+        mask = utils.labels_to_masks(np.squeeze(lab_img), max_masks)
+        if channels_first:
+            mask = np.moveaxis(mask, -1, 0)
+        return mask
 
     def fit(self, X,
             augment=False,
@@ -3894,6 +4325,163 @@ class XY_ImageDataGenerator(object):
             U, S, V = linalg.svd(sigma)
             self.principal_components = np.dot(np.dot(U, np.diag(1. / np.sqrt(S + 10e-7))), U.T)
 
+class XY_BatchImageDataGenerator(XY_ImageDataGenerator):
+    '''
+    Batch level version of XY_ImageDataGenerator, configured with the same arguments.
+    random_transform_labels_batch() draws the random parameters of a whole batch at once, composes
+    the geometric ops into a [B, 3, 3] stack of transform matrices and then warps each image and
+    label image once with OpenCV. Images in a batch may have different shapes.
+    '''
+
+    def random_transform_labels_batch(self, xs, labels):
+        """
+        xs: list of B images
+        labels: list of B int16/int32 label images [H, W], see utils.masks_to_labels()
+        Returns lists of the transformed images and label images. As in random_transform_labels(),
+        a sample whose instances are all transformed away is returned untouched.
+        """
+        img_row_index = self.row_index - 1
+        img_col_index = self.col_index - 1
+        img_channel_index = self.channel_index - 1
+
+        B = len(xs)
+        h = np.array([x.shape[img_row_index] for x in xs])
+        w = np.array([x.shape[img_col_index] for x in xs])
+        zeros = np.zeros(B)
+        ones = np.ones(B)
+
+        # Random parameters for the whole batch
+        theta = np.pi / 180 * np.random.uniform(-self.rotation_range, self.rotation_range, B) if self.rotation_range else zeros
+        tx = np.random.uniform(-self.height_shift_range, self.height_shift_range, B) * h if self.height_shift_range else zeros
+        ty = np.random.uniform(-self.width_shift_range, self.width_shift_range, B) * w if self.width_shift_range else zeros
+        shear = np.random.uniform(-self.shear_range, self.shear_range, B) if self.shear_range else zeros
+        if self.zoom_range[0] == 1 and self.zoom_range[1] == 1:
+            zx, zy = ones, ones
+        else:
+            zx, zy = np.random.uniform(self.zoom_range[0], self.zoom_range[1], (2, B))
+        horizontal_flip = np.random.random(B) < 0.5 if self.horizontal_flip else zeros.astype(np.bool)
+        vertical_flip = np.random.random(B) < 0.5 if self.vertical_flip else zeros.astype(np.bool)
+        rot90_times = np.random.randint(0, 4, B) if self.rots else zeros.astype(np.int)
+        crop = np.random.random(B) < 0.5 if self.random_crop_shape else zeros.astype(np.bool)
+
+        # Rotation, shift, shear and zoom about the image centre
+        transform_matrix = np.matmul(np.matmul(np.matmul(
+                                batch_matrix(np.cos(theta), -np.sin(theta), zeros, np.sin(theta), np.cos(theta), zeros),
+                                batch_matrix(ones, zeros, tx, zeros, ones, ty)),
+                                batch_matrix(ones, -np.sin(shear), zeros, zeros, np.cos(shear), zeros)),
+                                batch_matrix(zx, zeros, zeros, zeros, zy, zeros))
+        o_x = h / 2 + 0.5
+        o_y = w / 2 + 0.5
+        transform_matrix = np.matmul(np.matmul(batch_matrix(ones, zeros, o_x, zeros, ones, o_y), transform_matrix),
+                                     batch_matrix(ones, zeros, -o_x, zeros, ones, -o_y))
+
+        # Flips
+        sign = np.where(horizontal_flip, -1, 1)
+        transform_matrix = np.matmul(transform_matrix, batch_matrix(ones, zeros, zeros, zeros, sign, horizontal_flip * (w - 1)))
+        sign = np.where(vertical_flip, -1, 1)
+        transform_matrix = np.matmul(transform_matrix, batch_matrix(sign, zeros, vertical_flip * (h - 1), zeros, ones, zeros))
+
+        # rot90, one quarter turn at a time for the samples that still need it
+        for quarter in range(3):
+            rotate = rot90_times > quarter
+            transform_matrix = np.matmul(transform_matrix, 
+                                         np.where(rotate[:, None, None], batch_matrix(zeros, ones, zeros, -ones, zeros, w - 1), np.eye(3)))
+            h, w = np.where(rotate, w, h), np.where(rotate, h, w)
+
+        # Crop + resize back to the full size
+        if self.random_crop_shape:
+            crop = crop & ((h != self.random_crop_shape[0]) | (w != self.random_crop_shape[1]))
+            offsetw = (np.random.random(B) * ((h - self.random_crop_shape[0]) // 2)).astype(np.int)
+            offseth = (np.random.random(B) * ((w - self.random_crop_shape[1]) // 2)).astype(np.int)
+            crop_matrix = batch_matrix((self.random_crop_shape[0] - 1) / np.maximum(1, h - 1), zeros, offsetw,
+                                       zeros, (self.random_crop_shape[1] - 1) / np.maximum(1, w - 1), offseth)
+            transform_matrix = np.matmul(transform_matrix, np.where(crop[:, None, None], crop_matrix, np.eye(3)))
+
+        # Identity transforms are skipped
+        warp = np.logical_not(np.all(np.isclose(transform_matrix, np.eye(3)), axis = (1, 2)))
+
+        # Photometric parameters
+        if self.channel_shift_range != 0:
+            n_channels = max([x.shape[img_channel_index] for x in xs])
+            channel_shift = np.random.uniform(-self.channel_shift_range, self.channel_shift_range, (B, n_channels))
+        contrast_stretching = np.random.random(B) < 0.5 if self.contrast_stretching else zeros.astype(np.bool)
+        adaptive_equalization = np.random.random(B) < 0.5 if self.adaptive_equalization else zeros.astype(np.bool)
+        histogram_equalization = np.random.random(B) < 0.5 if self.histogram_equalization else zeros.astype(np.bool)
+        if self.gaussian_blur:
+            blur_sigma = np.where(np.random.random(B) < 0.5, np.random.uniform(self.gaussian_blur[0], self.gaussian_blur[1], B), 0)
+        else:
+            blur_sigma = zeros
+        invert = np.random.random(B) < 0.5 if self.random_invert else zeros.astype(np.bool)
+        if self.y_gaussian_blur is not None:
+            y_blur_sigma = np.where(np.random.random(B) < 0.5, np.random.uniform(self.y_gaussian_blur[0], self.y_gaussian_blur[1], B), 0)
+        else:
+            y_blur_sigma = zeros
+
+        out_xs, out_labels = [], []
+        for i in range(B):
+            x = xs[i]
+            y = labels[i]
+
+            if warp[i]:
+                x = warp_affine(x, transform_matrix[i], (h[i], w[i]), img_channel_index, cv2.INTER_LINEAR,
+                                fill_mode = self.fill_mode, cval = 0)
+                y = warp_affine(y[:, :, np.newaxis], transform_matrix[i], (h[i], w[i]), 2, cv2.INTER_NEAREST,
+                                fill_mode = self.fill_mode, cval = 0)[:, :, 0]
+
+            if self.channel_shift_range != 0:
+                shift = channel_shift[i, :x.shape[img_channel_index]].reshape([-1 if a == img_channel_index else 1 for a in range(x.ndim)])
+                x = np.clip(x + shift, np.min(x), np.max(x))
+
+            if contrast_stretching[i]:
+                p_low, p_high = np.percentile(x, (np.random.randint(1, self.contrast_stretching), np.random.randint(100 - self.contrast_stretching, 100))) 
+                x = exposure.rescale_intensity(x, in_range=(p_low, p_high)) 
+            if adaptive_equalization[i]:
+                x = exposure.equalize_adapthist(x / 255 if np.max(x) > 1 else x, clip_limit=0.03) 
+            if histogram_equalization[i]:
+                x = exposure.equalize_hist(x) 
+
+            # Non-positive sigmas leave the image unchanged, as in ndimage.gaussian_filter
+            if blur_sigma[i] > 0:
+                x = ndimage.filters.gaussian_filter(x, sigma = blur_sigma[i])
+                y = ndimage.filters.gaussian_filter(y, sigma = blur_sigma[i])
+
+            if invert[i]:
+                min_x = max(0, -1 * np.min(x))
+                max_x = min_x + np.max(x)
+                x_dtype = x.dtype
+                x = (((1 - ((x + min_x) / max_x)) * max_x) - min_x).astype(x_dtype)
+
+            if y_blur_sigma[i] > 0:
+                y = ndimage.filters.gaussian_filter(y, sigma = y_blur_sigma[i])
+
+            # If all masks have been zeroed, revert back to the original to avoid nans
+            if not np.any(y > 0):
+                x = xs[i]
+                y = labels[i]
+
+            out_xs.append(x)
+            out_labels.append(y)
+
+        return out_xs, out_labels
+
+
+def batch_matrix(a11, a12, a13, a21, a22, a23):
+    """
+    Stack per-sample affine parameters (each an array of length B) into [B, 3, 3] matrices
+    [[a11, a12, a13], [a21, a22, a23], [0, 0, 1]]
+    """
+    a11 = np.asarray(a11, dtype = np.float64)
+    matrix = np.zeros(a11.shape + (3, 3))
+    matrix[..., 0, 0] = a11
+    matrix[..., 0, 1] = a12
+    matrix[..., 0, 2] = a13
+    matrix[..., 1, 0] = a21
+    matrix[..., 1, 1] = a22
+    matrix[..., 1, 2] = a23
+    matrix[..., 2, 2] = 1
+    return matrix
+
+
 class XY_NumpyArrayIterator(Iterator):
 
     """
@@ -386,6 +386,20 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_labels(self, image_id):
+        """Load instance masks for the given image as a single label image.
+
+        Override this if your dataset can produce labels more cheaply than
+        by collapsing load_mask(), e.g. from a cache.
+
+        Returns:
+            labels: An int16/int32 array of shape [height, width] where
+                instance i has label i + 1 and 0 is background.
+            class_ids: a 1D array of class IDs of the instances.
+        """
+        mask, class_ids = self.load_mask(image_id)
+        return masks_to_labels(mask), class_ids
+
 
 def resize_image(image, min_dim=None, max_dim=None, padding=False):
     """
@@ -511,6 +525,78 @@ def resize_mask(mask, scale, padding):
     return mask
 
 
+def masks_to_labels(masks):
+    """Collapse instance masks into a single label image.
+    masks: [height, width, num_instances]. Non-zero pixels belong to the instance.
+
+    Returns: labels [height, width] where instance i has label i + 1 and 0 is
+    background. Where masks overlap the last mask wins. The dtype is int16,
+    or int32 if there are too many instances for int16.
+    """
+    num_instances = masks.shape[-1]
+    dtype = np.int16 if num_instances < np.iinfo(np.int16).max else np.int32
+    if num_instances == 0:
+        return np.zeros(masks.shape[:2], dtype=dtype)
+    masks = masks > 0
+    # argmax over the reversed stack finds the last mask covering each pixel
+    last = np.argmax(masks[:, :, ::-1], axis=-1)
+    labels = (num_instances - last).astype(dtype)
+    labels[~np.any(masks, axis=-1)] = 0
+    return labels
+
+
+def labels_to_masks(labels, num_instances=None):
+    """Expand a label image back into instance masks. Reverses masks_to_labels().
+    labels: [height, width] integer label image, 0 is background.
+    num_instances: number of masks to return, defaults to labels.max()
+
+    Returns: bool masks [height, width, num_instances]
+    """
+    if num_instances is None:
+        num_instances = int(labels.max()) if labels.size else 0
+    return labels[:, :, np.newaxis] == np.arange(1, num_instances + 1, dtype=labels.dtype)
+
+
+def compact_labels(labels, class_ids, keep=None):
+    """Drop instances from a label image and renumber the rest 1..N.
+    keep: bool [num_instances] of instances to keep. Defaults to the
+        instances that still have pixels in labels, e.g. after cropping.
+
+    Returns: labels, class_ids
+    """
+    num_instances = len(class_ids)
+    if keep is None:
+        keep = np.bincount(labels.ravel(), minlength=num_instances + 1)[1:num_instances + 1] > 0
+    if np.all(keep):
+        return labels, class_ids
+    lookup = np.zeros(num_instances + 1, dtype=labels.dtype)
+    lookup[1:][keep] = np.arange(1, np.sum(keep) + 1)
+    return lookup[labels], class_ids[keep]
+
+
+def extract_bboxes_from_labels(labels, num_instances):
+    """Compute bounding boxes from a label image. Equivalent to
+    extract_bboxes(labels_to_masks(labels, num_instances)) without expanding
+    the masks.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)].
+    """
+    boxes = np.zeros([num_instances, 4], dtype=np.int32)
+    for i, slices in enumerate(scipy.ndimage.find_objects(labels, max_label=num_instances)):
+        if slices is not None:
+            boxes[i] = [slices[0].start, slices[1].start, slices[0].stop, slices[1].stop]
+    return boxes
+
+
+def resize_labels(labels, scale, padding):
+    """Label image equivalent of resize_mask().
+    labels: [height, width] integer label image
+    """
+    labels = scipy.ndimage.zoom(labels, zoom=[scale, scale], order=0)
+    labels = np.pad(labels, padding[:2], mode='constant', constant_values=0)
+    return labels
+
+
 def minimize_mask(bbox, mask, mini_shape):
     """Resize masks to a smaller version to cut memory load.
     Mini-masks can then resized back to image scale using expand_masks()
@@ -529,6 +615,21 @@ def minimize_mask(bbox, mask, mini_shape):
     return mini_mask
 
 
+def minimize_mask_from_labels(bbox, labels, mini_shape):
+    """Label image equivalent of minimize_mask(). Each instance mask is only
+    built inside its bounding box, so the full mask stack is never expanded.
+    """
+    mini_mask = np.zeros(mini_shape + (len(bbox),), dtype=bool)
+    for i in range(len(bbox)):
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = labels[y1:y2, x1:x2] == (i + 1)
+        if m.size == 0:
+            raise Exception("Invalid bounding box with area of zero")
+        m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
+        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+    return mini_mask
+
+
 def expand_mask(bbox, mini_mask, image_shape):
     """Resizes mini masks back to image size. Reverses the change
     of minimize_mask().
@@ -571,6 +672,56 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def unmold_mask_crops(masks, bboxes):
+    """Resizes the N masks generated by the neural network to their boxes and
+    thresholds them, as unmold_mask(), without painting them on the full image.
+    masks: [N, height, width] of type float. Small, typically 28x28, masks.
+    bboxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns:
+    crops: list of N uint8 binary masks, each cropped to its tight bbox.
+    tight_bboxes: [N, (y1, x1, y2, x2)]. Zeros (and an empty crop) for masks 
+        that are empty after thresholding.
+    """
+    threshold = 0.5
+    crops = []
+    tight_bboxes = np.zeros([masks.shape[0], 4], dtype=np.int32)
+    for i in range(masks.shape[0]):
+        y1, x1, y2, x2 = bboxes[i]
+        mask = scipy.misc.imresize(
+            masks[i], (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+        mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
+
+        vertical_indicies = np.where(np.any(mask, axis=1))[0]
+        horizontal_indicies = np.where(np.any(mask, axis=0))[0]
+        if vertical_indicies.shape[0]:
+            tight_bboxes[i] = [y1 + vertical_indicies[0], x1 + horizontal_indicies[0],
+                               y1 + vertical_indicies[-1] + 1, x1 + horizontal_indicies[-1] + 1]
+            crops.append(mask[vertical_indicies[0]:vertical_indicies[-1] + 1,
+                              horizontal_indicies[0]:horizontal_indicies[-1] + 1])
+        else:
+            crops.append(np.zeros((0, 0), dtype=np.uint8))
+    return crops, tight_bboxes
+
+
+def unmold_masks(masks, bboxes, image_shape):
+    """Converts the N masks generated by the neural network to full size masks,
+    as unmold_mask(). The tight bboxes of the thresholded masks are computed on the 
+    resized crops rather than on the full size masks (see unmold_mask_crops()).
+    masks: [N, height, width] of type float. Small, typically 28x28, masks.
+    bboxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns:
+    full_masks: [height, width, N] binary masks with the same size as the original image.
+    tight_bboxes: [N, (y1, x1, y2, x2)]. Zeros for masks that are empty after thresholding.
+    """
+    crops, tight_bboxes = unmold_mask_crops(masks, bboxes)
+    full_masks = np.zeros(tuple(image_shape[:2]) + (masks.shape[0],), dtype=np.uint8)
+    for i, (y1, x1, y2, x2) in enumerate(tight_bboxes):
+        full_masks[y1:y2, x1:x2, i] = crops[i]
+    return full_masks, tight_bboxes
+
+
 ############################################################
 #  Anchors
 ############################################################